@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+"""
+Daily reports from recorded command logs, in one pass and constant memory.
+
+Reads the logs server.py --record writes (see commandlog.py for the
+format) and reports:
+
+  - the ending mix per pony type, sessions that never finished included
+  - scene drop-off: for each node, how many sessions reached it and how
+    many stopped there, by ending or unfinished
+  - which crystals get used where (node and prompt site)
+  - the mean length of a fight, in turns, per enemy
+
+    python analytics.py sessions.log
+    python analytics.py sessions.log old.log --workers 8 --json report.json
+
+Logs are never read into memory. Each file is mapped (mmap) and cut into
+chunks of about --chunk-mb, one per worker task. A cut has to fall on a
+record boundary, and records carry no markers, so the cut is moved
+forward to the first byte from which the next records all parse as
+valid ones; the worker ending at that cut must then land on it exactly,
+or the file is rejected. Each worker streams its chunk through a
+generator pipeline: records -> tokens -> one small state per open
+session -> counters. Memory grows with the number of sessions open at
+once and the size of the story, not with the log.
+
+A session can start in one chunk and go on in the next. A worker hands
+back the states of the sessions still open at its end and the tokens of
+sessions it joined midway; the main process threads them together in
+chunk order. As with commandlog.parse(), a new start for a stream that
+is still open (a restarted server reusing its ids) ends the old session
+unfinished. An incomplete record at the very end of a file (a log still
+being written) is skipped.
+
+Scene drop-off counts a session where its last answer was given.
+Fights are counted from the first answer at a "fight" prompt to the
+next answer elsewhere, a new node or the ending; a fight in a session
+that was cut off mid-fight is left out. A turn is a fight, magic, flee
+or use item answer; "inv" and unknown answers are not turns.
+"""
+
+import argparse
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import commandlog
+import unicorn
+
+CHUNK_MB = 64
+SYNC_RECORDS = 32   # records that must parse after a candidate cut
+UNFINISHED = "unfinished"
+NO_PONY = "-"       # the session ended before a pony was picked
+TURNS = frozenset(("fight", "magic", "flee", "use item"))
+FIGHT_SITES = frozenset(("fight", "fight.item"))
+
+_NAME = re.compile(rb"[a-z_][a-z0-9_.]{0,63}\Z")  # site and ending names
+
+class AnalyticsError(ValueError):
+    pass
+
+# ---------------------------
+# What the story says
+# ---------------------------
+
+def fight_enemies(story=None):
+    """{node ID: enemy name} of the nodes that hold a fight."""
+    story = story or unicorn.STORY
+    enemies = {}
+    for node in story.nodes:
+        for step in unicorn.walk_steps(node.steps):
+            if step[0] == unicorn._FIGHT:
+                enemies[node.id] = story.enemies[step[1]]["name"]
+    return enemies
+
+def pony_choices(story=None):
+    """(pony site, {answer: pony type}) of the story's new_player step."""
+    story = story or unicorn.STORY
+    for node in story.nodes:
+        for step in unicorn.walk_steps(node.steps):
+            if step[0] == unicorn._NEW_PLAYER:
+                return step[4], {key: pony[0] for key, pony in step[7].items()}
+    return None, {}
+
+# ---------------------------
+# Records
+# ---------------------------
+# The same layouts commandlog writes, read straight out of the map.
+
+_START = commandlog._START
+_STEP = commandlog._STEP
+_END = commandlog._END
+_USE = commandlog._USE
+_LEN16 = commandlog._LEN16
+
+def _text(buf, pos, width=1):
+    if width == 1:
+        size = buf[pos]
+    else:
+        size, = _LEN16.unpack_from(buf, pos)
+    pos += width
+    end = pos + size
+    if end > len(buf):
+        raise IndexError("text runs past the end")
+    return buf[pos:end].decode("utf-8"), end
+
+def records(buf, pos, end):
+    """(kind, stream, stage, site, text, next position) for each record
+    starting in [pos, end): text is the command of a step, the ending of
+    an end and the crystal's catalog ID of a use."""
+    while pos < end:
+        kind = buf[pos]
+        if kind == 0x43:    # "C"
+            stream, stage, _, _, _ = _STEP.unpack_from(buf, pos + 1)
+            site, at = _text(buf, pos + 1 + _STEP.size)
+            size = buf[at]
+            command, at = _text(buf, at + 1 + size, 2)
+            yield "C", stream, stage, site, command, at
+            pos = at
+        elif kind == 0x55:  # "U"
+            stream, stage, item = _USE.unpack_from(buf, pos + 1)
+            site, pos = _text(buf, pos + 1 + _USE.size)
+            yield "U", stream, stage, site, item, pos
+        elif kind == 0x53:  # "S"
+            _, stream, _, _ = _START.unpack_from(buf, pos + 1)
+            pos += 1 + _START.size
+            yield "S", stream, 0, None, None, pos
+        elif kind == 0x45:  # "E"
+            stream, = _END.unpack_from(buf, pos + 1)
+            ending, pos = _text(buf, pos + 1 + _END.size)
+            yield "E", stream, 0, None, ending, pos
+        else:
+            raise AnalyticsError(f"unknown record {kind:#x} at byte {pos}")
+
+def _plausible(buf, pos, nodes, records_=SYNC_RECORDS):
+    """Whether the next records from pos all look like real ones."""
+    try:
+        for kind, _, stage, site, text, end in records(buf, pos, len(buf)):
+            if kind in "CU":
+                if stage >= nodes or not _NAME.match(site.encode()):
+                    return False
+                if kind == "U" and not (text < len(unicorn.CATALOG)
+                                        and unicorn.CATALOG[text].type == "crystal"):
+                    return False
+            elif kind == "E" and not _NAME.match(text.encode()):
+                return False
+            records_ -= 1
+            if not records_:
+                return True
+        return True   # ran exactly into the end of the file
+    except (AnalyticsError, struct.error, IndexError, UnicodeDecodeError):
+        return False
+
+def boundaries(buf, chunk_bytes, nodes):
+    """Record boundaries that cut buf into chunks of about chunk_bytes."""
+    cuts = [0]
+    target = chunk_bytes
+    while target < len(buf):
+        pos = max(target, cuts[-1] + 1)
+        while pos < len(buf) and not (buf[pos] in b"SCEU" and _plausible(buf, pos, nodes)):
+            pos += 1
+        if pos >= len(buf):
+            break
+        cuts.append(pos)
+        target = pos + chunk_bytes
+    cuts.append(len(buf))
+    return cuts
+
+# ---------------------------
+# Tokens and sessions
+# ---------------------------
+# Tokens are (code, stream, stage, value):
+#   S  a session starts
+#   A  an answer outside a fight          value: pony type picked, or None
+#   F  an answer at a fight prompt        value: True if it is a turn
+#   U  a crystal use                      value: (catalog ID, site)
+#   E  the session ends                   value: ending
+
+def tokens(recs, pony_site, ponies):
+    for kind, stream, stage, site, text, _ in recs:
+        if kind == "C":
+            if site in FIGHT_SITES:
+                yield "F", stream, stage, site == "fight" and text.strip().lower() in TURNS
+            elif site == pony_site:
+                yield "A", stream, stage, ponies.get(text.strip())
+            else:
+                yield "A", stream, stage, None
+        elif kind == "U":
+            yield "U", stream, stage, (text, site)
+        else:
+            yield kind, stream, stage, text
+
+class _Open:
+    """What is known so far about one session that has not ended."""
+    __slots__ = ("pony", "reached", "last", "fight", "turns")
+
+    def __init__(self):
+        self.pony = NO_PONY
+        self.reached = 0     # bit per node ID
+        self.last = -1       # node of the last answer
+        self.fight = -1      # node of the fight under way
+        self.turns = 0
+
+class Tally:
+    """Counters for the reports, and the sessions they are collected from."""
+
+    def __init__(self, enemies):
+        self.enemies = enemies
+        self.sessions = 0
+        self.endings = Counter()   # (pony, ending) -> sessions
+        self.reached = Counter()   # node -> sessions
+        self.stops = Counter()     # (node, ending) -> sessions
+        self.uses = Counter()      # (catalog ID, node, site) -> uses
+        self.fights = Counter()    # enemy -> fights
+        self.turns = Counter()     # enemy -> turns
+        self.skipped = 0           # records of a session whose start was not seen
+
+    def feed(self, open_, token):
+        """Apply one token to the sessions in open_ (stream -> _Open)."""
+        code, stream, stage, value = token
+        if code == "U":
+            self.uses[value[0], stage, value[1]] += 1
+            return
+        if code == "S":
+            previous = open_.get(stream)
+            if previous is not None:
+                self.finish(previous, UNFINISHED)
+            open_[stream] = _Open()
+            return
+        state = open_.get(stream)
+        if state is None:
+            self.skipped += 1
+            return
+        if code == "E":
+            del open_[stream]
+            self.finish(state, value)
+            return
+        if state.fight >= 0 and (code == "A" or stage != state.fight):
+            self._fought(state)
+        state.reached |= 1 << stage
+        state.last = stage
+        if code == "F":
+            state.fight = stage
+            state.turns += value
+        elif value is not None:
+            state.pony = value
+
+    def _fought(self, state):
+        enemy = self.enemies.get(state.fight, f"(node {state.fight})")
+        self.fights[enemy] += 1
+        self.turns[enemy] += state.turns
+        state.fight = -1
+        state.turns = 0
+
+    def finish(self, state, ending):
+        if state.fight >= 0 and ending != UNFINISHED:
+            self._fought(state)
+        self.sessions += 1
+        self.endings[state.pony, ending] += 1
+        self.stops[state.last, ending] += 1
+        reached = state.reached
+        while reached:
+            low = reached & -reached
+            self.reached[low.bit_length() - 1] += 1
+            reached ^= low
+
+    def merge(self, other):
+        self.sessions += other.sessions
+        self.skipped += other.skipped
+        for name in ("endings", "reached", "stops", "uses", "fights", "turns"):
+            getattr(self, name).update(getattr(other, name))
+
+# ---------------------------
+# Chunks
+# ---------------------------
+
+def _tally_chunk(path, start, end, last):
+    """Tally the records in [start, end) of a file.
+
+    Returns (tally, sessions still open {stream: _Open}, streams started,
+    tokens of sessions joined midway {stream: [token, ...]}, bytes of an
+    incomplete record left at the end).
+    """
+    story = unicorn.STORY
+    tally = Tally(fight_enemies(story))
+    pony_site, ponies = pony_choices(story)
+    open_ = {}
+    started = set()
+    joined = {}
+    where = [start]
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        try:
+            for token in tokens(_positions(records(buf, start, end), where), pony_site, ponies):
+                code, stream = token[0], token[1]
+                if code == "S":
+                    started.add(stream)
+                elif code != "U" and stream not in open_:
+                    joined.setdefault(stream, []).append(token)
+                    continue
+                tally.feed(open_, token)
+        except (struct.error, IndexError) as exc:
+            if not last:
+                raise AnalyticsError(f"{path}: broken record at byte {where[0]}: {exc}") from None
+        except UnicodeDecodeError:
+            raise AnalyticsError(f"{path}: bad text in the record at byte {where[0]}") from None
+        except AnalyticsError as exc:
+            raise AnalyticsError(f"{path}: {exc}") from None
+    if where[0] > end:
+        raise AnalyticsError(f"{path}: chunk cut at byte {end} is not a record boundary")
+    return tally, open_, started, joined, end - where[0]
+
+def _positions(recs, where):
+    """Pass records on, keeping where[0] at the end of the last one."""
+    for rec in recs:
+        where[0] = rec[5]
+        yield rec
+
+def analyze(paths, workers=None, chunk_mb=CHUNK_MB):
+    """A Tally over whole log files, plus the bytes of incomplete records
+    left at their ends."""
+    story = unicorn.STORY
+    enemies = fight_enemies(story)
+    chunk_bytes = max(1, int(chunk_mb * 1024 * 1024))
+    tasks = []
+    for path in paths:
+        if os.path.getsize(path) == 0:
+            continue
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            cuts = boundaries(buf, chunk_bytes, len(story.nodes))
+        tasks += [(path, a, b, b == cuts[-1]) for a, b in zip(cuts, cuts[1:])]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(tasks) <= 1:
+        results = (_tally_chunk(*task) for task in tasks)
+        return _stitch(tasks, results, enemies)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return _stitch(tasks, pool.map(_tally_chunk, *zip(*tasks)), enemies)
+
+def _stitch(tasks, results, enemies):
+    """Thread sessions through the chunks of each file, in order."""
+    total = Tally(enemies)
+    left = 0
+    open_ = {}
+    path = None
+    for (task_path, _, _, last), (tally, still_open, started, joined, rest) in zip(tasks, results):
+        if task_path != path:
+            path = task_path
+            open_ = {}
+        total.merge(tally)
+        # a chunk's joined tokens come before any start it has for the stream
+        for stream_tokens in joined.values():
+            for token in stream_tokens:
+                total.feed(open_, token)
+        for stream in started & open_.keys():
+            total.finish(open_.pop(stream), UNFINISHED)
+        open_.update(still_open)
+        if last:
+            for state in open_.values():
+                total.finish(state, UNFINISHED)
+            left += rest
+    return total, left
+
+# ---------------------------
+# Reports
+# ---------------------------
+
+def report(tally, story=None):
+    """The reports as plain data, with names instead of IDs."""
+    story = story or unicorn.STORY
+
+    def node(stage):
+        if stage < 0:
+            return "(no answer)"
+        return story.nodes[stage].name if stage < len(story.nodes) else f"#{stage}"
+
+    endings = list(story.endings) + [UNFINISHED]
+    endings += sorted({e for _, e in tally.endings} - set(endings))
+    ponies = sorted({p for p, _ in tally.endings})
+    mix = {pony: {e: tally.endings[pony, e] for e in endings if tally.endings[pony, e]}
+           for pony in ponies}
+    stages = sorted(set(tally.reached) | {s for s, _ in tally.stops})
+    dropoff = [{"node": node(s), "reached": tally.reached[s],
+                "stopped": {e: tally.stops[s, e] for e in endings if tally.stops[s, e]}}
+               for s in stages]
+    uses = [{"crystal": unicorn.CATALOG[item].name, "node": node(stage), "site": site,
+             "uses": count}
+            for (item, stage, site), count in sorted(tally.uses.items(),
+                                                     key=lambda kv: (-kv[1], kv[0]))]
+    fights = {enemy: {"fights": n, "mean_turns": tally.turns[enemy] / n}
+              for enemy, n in sorted(tally.fights.items())}
+    return {"sessions": tally.sessions, "endings": mix, "dropoff": dropoff,
+            "crystals": uses, "fights": fights, "skipped_records": tally.skipped}
+
+def format_report(data):
+    lines = [f"{data['sessions']} sessions"]
+    lines.append("\nEndings per pony:")
+    for pony, counts in data["endings"].items():
+        total = sum(counts.values())
+        mix = "  ".join(f"{e} {n / total:6.1%}" for e, n in counts.items())
+        lines.append(f"  {pony:<10} {total:>9}  {mix}")
+    lines.append("\nScene drop-off:")
+    for row in data["dropoff"]:
+        stopped = "  ".join(f"{e} {n}" for e, n in row["stopped"].items())
+        lines.append(f"  {row['node']:<12} reached {row['reached']:>9}  stopped: {stopped or '-'}")
+    lines.append("\nCrystal uses:")
+    for row in data["crystals"]:
+        lines.append(f"  {row['crystal']:<12} {row['node']:<12} {row['site']:<16} {row['uses']:>9}")
+    if not data["crystals"]:
+        lines.append("  none")
+    lines.append("\nFights:")
+    for enemy, row in data["fights"].items():
+        lines.append(f"  {enemy:<18} {row['fights']:>9} fights, {row['mean_turns']:.2f} turns each")
+    if not data["fights"]:
+        lines.append("  none")
+    if data["skipped_records"]:
+        lines.append(f"\n{data['skipped_records']} records belonged to sessions "
+                     f"whose start is not in the logs")
+    return "\n".join(lines)
+
+# ---------------------------
+# Command line
+# ---------------------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reports from recorded command logs.")
+    parser.add_argument("logs", nargs="+", help="log files written by server.py --record")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunk-mb", type=float, default=CHUNK_MB,
+                        help=f"size of the piece each worker reads (default {CHUNK_MB})")
+    parser.add_argument("--json", metavar="PATH", help="also write the reports as JSON")
+    args = parser.parse_args(argv)
+    began = time.perf_counter()
+    try:
+        tally, left = analyze(args.logs, args.workers, args.chunk_mb)
+    except (OSError, AnalyticsError) as exc:
+        print(f"analytics: {exc}", file=sys.stderr)
+        return 1
+    elapsed = time.perf_counter() - began
+    data = report(tally)
+    print(format_report(data))
+    size = sum(os.path.getsize(path) for path in args.logs)
+    print(f"\n({size / 1e6:.1f} MB in {elapsed:.2f}s"
+          + (f"; {left} bytes of an unfinished record skipped" if left else "") + ")")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=1)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""
+Vectorized fight() resolver for balance simulations.
+
+Resolves many duels at once with NumPy, one array operation per turn for
+all fights still running, using the same hit chances and damage formulas
+as unicorn.fight(). NumPy is only needed for this module; the game itself
+does not import it.
+
+    import batchfight, unicorn
+    bulldog = unicorn.Enemy("Bulldog Cerberus", 22, 6, 3, 2)
+    res = batchfight.resolve_enemy(health=48, strength=9, agility=5, magic=2,
+                                   weapon_damage=3, enemy=bulldog, n=50000)
+    res.summary()  # {'victory': ..., 'dead': ..., 'fled': ..., ...}
+"""
+
+import numpy as np
+
+import unicorn
+
+# scripted actions (per-fight policy codes)
+FIGHT = 0
+MAGIC = 1
+
+# per-fight outcomes
+ONGOING = -1
+VICTORY = 0
+DEAD = 1
+FLED = 2
+TIMEOUT = 3
+OUTCOME_NAMES = {VICTORY: "victory", DEAD: "dead", FLED: "fled", TIMEOUT: "timeout"}
+
+class BatchResult:
+    """Per-fight outcome code, turns taken and remaining HP on both sides."""
+    def __init__(self, outcome, turns, player_hp, enemy_hp):
+        self.outcome = outcome
+        self.turns = turns
+        self.player_hp = player_hp
+        self.enemy_hp = enemy_hp
+
+    def __len__(self):
+        return len(self.outcome)
+
+    def rate(self, outcome):
+        return float(np.mean(self.outcome == outcome)) if len(self) else 0.0
+
+    def summary(self):
+        out = {name: self.rate(code) for code, name in OUTCOME_NAMES.items()}
+        out["mean_turns"] = float(self.turns.mean()) if len(self) else 0.0
+        return out
+
+def _player_hit(p_agi, e_agi):
+    base, lo, hi = unicorn.PLAYER_HIT
+    return np.clip(base + (p_agi - e_agi) * unicorn.HIT_PER_AGILITY, lo, hi)
+
+def _enemy_hit(e_agi, p_agi):
+    base, lo, hi = unicorn.ENEMY_HIT
+    return np.clip(base + (e_agi - p_agi) * unicorn.HIT_PER_AGILITY, lo, hi)
+
+def _flee(p_agi, e_agi):
+    return unicorn.FLEE_BASE + (p_agi - e_agi) * unicorn.FLEE_PER_AGILITY
+
+def resolve(health, strength, agility, magic, weapon_damage,
+            enemy_health, enemy_strength, enemy_agility,
+            action=FIGHT, flee_below=0, n=None, rng=None, max_turns=1000):
+    """Resolve a batch of fights and return a BatchResult.
+
+    Every stat may be a scalar or an array; they are broadcast to a common
+    length (or to `n` when all of them are scalars). `action` picks FIGHT
+    or MAGIC per fight, and a fight flees instead whenever the player's HP
+    is below its `flee_below` threshold, so the scripted policies are
+    "always fight", "always magic" and "flee below X HP" as masks.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    arrays = np.broadcast_arrays(*(np.asarray(a, dtype=np.int64) for a in (
+        health, strength, agility, magic, weapon_damage,
+        enemy_health, enemy_strength, enemy_agility, action, flee_below)))
+    if n is not None and arrays[0].ndim == 0:
+        arrays = [np.full(n, a, dtype=np.int64) for a in arrays]
+    (p_hp, p_str, p_agi, p_mag, w_dmg,
+     e_hp, e_str, e_agi, act, flee_at) = [np.array(a, dtype=np.int64).ravel() for a in arrays]
+    size = len(p_hp)
+
+    # per-fight constants, computed once
+    strike = unicorn.PLAYER_BASE_DAMAGE + p_str + w_dmg
+    blast = unicorn.MAGIC_BASE_DAMAGE + p_mag
+    bite = unicorn.ENEMY_BASE_DAMAGE + e_str
+    p_hit = _player_hit(p_agi, e_agi)
+    e_hit = _enemy_hit(e_agi, p_agi)
+    escape = _flee(p_agi, e_agi)
+
+    outcome = np.full(size, ONGOING, dtype=np.int8)
+    outcome[p_hp <= 0] = DEAD
+    outcome[(p_hp > 0) & (e_hp <= 0)] = VICTORY
+    turns = np.zeros(size, dtype=np.int64)
+    live = np.flatnonzero(outcome == ONGOING)
+
+    for _ in range(max_turns):
+        if not len(live):
+            break
+        turns[live] += 1
+        hp = p_hp[live]
+        fleeing = hp < flee_at[live]
+        fighting = ~fleeing & (act[live] == FIGHT)
+        casting = ~fleeing & (act[live] == MAGIC) & (p_mag[live] > 0)
+
+        # player's move
+        u = rng.random(len(live))
+        dmg = np.where(fighting & (u < p_hit[live]), strike[live], 0)
+        # magic blast: 1 + magic + randint(0, magic)
+        extra = np.floor(rng.random(len(live)) * (p_mag[live] + 1)).astype(np.int64)
+        dmg = np.where(casting, blast[live] + extra, dmg)
+        e_hp[live] -= dmg
+        fled = fleeing & (u < escape[live])
+        outcome[live[fled]] = FLED
+
+        # enemy's move if it is still standing and the player stayed
+        attacks = ~fled & (e_hp[live] > 0)
+        hits = attacks & (rng.random(len(live)) < e_hit[live])
+        p_hp[live] -= np.where(hits, bite[live], 0)
+
+        outcome[live[e_hp[live] <= 0]] = VICTORY
+        outcome[live[p_hp[live] <= 0]] = DEAD
+        live = live[outcome[live] == ONGOING]
+
+    outcome[live] = TIMEOUT
+    return BatchResult(outcome, turns, p_hp, e_hp)
+
+def resolve_enemy(health, strength, agility, magic, weapon_damage, enemy, n=None, **kwargs):
+    """resolve() against a unicorn.Enemy instead of raw enemy stat arrays."""
+    return resolve(health, strength, agility, magic, weapon_damage,
+                   enemy.health, enemy.strength, enemy.agility, n=n, **kwargs)
+
+def resolve_player(player, enemy, n, **kwargs):
+    """resolve() n copies of one unicorn.Player against one unicorn.Enemy."""
+    weapon = player.weapon.base_damage if player.weapon else 0
+    return resolve(player.health, player.strength, player.agility, player.magic,
+                   weapon, enemy.health, enemy.strength, enemy.agility, n=n, **kwargs)
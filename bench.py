@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the game's hot paths, with a tracked baseline.
+
+Each benchmark measures one number (a rate, a per-call cost or a size),
+the results are written as JSON, and they are compared with a stored
+baseline: any benchmark worse than the baseline by more than the
+threshold is reported and the run exits non-zero.
+
+    python bench.py                              # run, compare with bench_baseline.json
+    python bench.py --out results.json           # also write the results
+    python bench.py --save-baseline              # accept the current numbers
+    python bench.py --only fight_turns --seconds 3
+
+Baselines are only comparable on the same machine and Python version;
+both are stored with the numbers so a mismatch is visible.
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import simulate
+import unicorn
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(HERE, "bench_baseline.json")
+THRESHOLD = 0.25  # allowed slowdown (or growth) relative to the baseline
+SEED = 20240601
+
+HIGHER = "higher"
+LOWER = "lower"
+
+class _BenchConsole(unicorn.Console):
+    """Console that discards output, never sleeps and repeats one answer."""
+    def __init__(self, answer, rng):
+        self.answer = answer
+        self.rng = rng
+        self.prompts = 0
+
+    def write(self, text):
+        pass
+
+    def pause(self, seconds):
+        pass
+
+    def read(self, site, text="> ", player=None, enemy=None):
+        self.prompts += 1
+        return self.answer
+
+def _timed(body, seconds):
+    """Call body() until `seconds` pass; return (units of work, elapsed).
+
+    body() returns how much work it did (turns, games, calls, ...).
+    """
+    done = 0
+    began = time.perf_counter()
+    deadline = began + seconds
+    while True:
+        done += body()
+        now = time.perf_counter()
+        if now >= deadline:
+            return done, now - began
+
+def _best_rate(body, seconds, repeat):
+    return max(done / elapsed for done, elapsed in
+               (_timed(body, seconds / repeat) for _ in range(repeat)))
+
+def _earth_pony():
+    return unicorn.Player("Bench", "Earth Pony", magic=2, strength=9, agility=5)
+
+# ---------------------------
+# Benchmarks
+# ---------------------------
+# bench(seconds, repeat) -> (value, unit, which direction is better)
+
+def bench_fight_turns(seconds, repeat):
+    """fight() turns per second, earth pony trading blows with the bulldog."""
+    console = _BenchConsole("fight", unicorn.Stream(SEED))
+
+    def body():
+        player = _earth_pony()
+        player.health = player.max_health = 10_000
+        enemy = unicorn.Enemy("Bulldog Cerberus", health=10_000, strength=6, agility=3, magic=2)
+        console.prompts = 0
+        unicorn.run(unicorn.fight(player, enemy))
+        return console.prompts
+
+    previous = unicorn.use_console(console)
+    try:
+        return _best_rate(body, seconds, repeat), "turns/s", HIGHER
+    finally:
+        unicorn.use_console(previous)
+
+def bench_playthroughs(seconds, repeat):
+    """Complete headless games per second (simulate.play, brave policy)."""
+    games = iter(range(1 << 62))
+
+    def body():
+        simulate.play("earth", simulate.brave_policy, rng=unicorn.Stream(SEED, next(games)))
+        return 1
+
+    return _best_rate(body, seconds, repeat), "games/s", HIGHER
+
+def bench_item_dispatch(seconds, repeat):
+    """Cost of one use_item_in_fight() call through the crystal tables."""
+    player = _earth_pony()
+    jade = unicorn.new_item("Jade")
+    jade.charges = 1 << 30
+    number = player.inventory.add(jade)
+    enemy = unicorn.Enemy("Target", health=10, strength=1, agility=1, magic=0)
+    console = _BenchConsole(str(number), unicorn.Stream(SEED))
+    batch = 1000
+
+    def body():
+        for _ in range(batch):
+            unicorn.run(unicorn.use_item_in_fight(player, enemy))
+        return batch
+
+    previous = unicorn.use_console(console)
+    try:
+        return 1e6 / _best_rate(body, seconds, repeat), "us/call", LOWER
+    finally:
+        unicorn.use_console(previous)
+
+def bench_wrapped(seconds, repeat):
+    """Cost of wrapping and writing one paragraph of scene text."""
+    paragraph = (
+        "While grazing for berries late at night in the peaceful village of Rainbowtopia, "
+        "you are suddenly seized and find yourself trapped in a dungeon deep inside a crystal cavern.")
+    console = _BenchConsole("", unicorn.Stream(SEED))
+    batch = 200
+
+    def body():
+        for _ in range(batch):
+            unicorn.say(unicorn.wrapped(paragraph))
+        return batch
+
+    previous = unicorn.use_console(console)
+    try:
+        return 1e6 / _best_rate(body, seconds, repeat), "us/call", LOWER
+    finally:
+        unicorn.use_console(previous)
+
+def bench_session_bytes(seconds, repeat, sessions=2000):
+    """Memory held per session parked at its first prompt after the cavern."""
+    def park(n):
+        session = unicorn.Session(rng=unicorn.Stream(SEED, n))
+        unicorn.start(session)
+        for command in ("Bench", "1"):
+            unicorn.step(session, command)
+        session.drain()
+        return session
+
+    park(0)  # warm module-level caches out of the measurement
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        parked = [park(n) for n in range(sessions)]
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    return used / len(parked), "bytes", LOWER
+
+def bench_startup(seconds, repeat):
+    """Cold import time of unicorn.py in a fresh interpreter."""
+    code = ("import sys, time; sys.dont_write_bytecode = True; t = time.perf_counter(); "
+            "import unicorn; print(time.perf_counter() - t)")
+    times = []
+    for _ in range(max(repeat, 10)):
+        out = subprocess.run([sys.executable, "-c", code], cwd=HERE, check=True,
+                             capture_output=True, text=True).stdout
+        times.append(float(out))
+    return min(times) * 1000, "ms", LOWER
+
+BENCHMARKS = {
+    "fight_turns": bench_fight_turns,
+    "playthroughs": bench_playthroughs,
+    "item_dispatch": bench_item_dispatch,
+    "wrapped": bench_wrapped,
+    "session_bytes": bench_session_bytes,
+    "startup": bench_startup,
+}
+
+# ---------------------------
+# Results and baselines
+# ---------------------------
+
+def environment():
+    return {"python": platform.python_version(), "implementation": platform.python_implementation(),
+            "machine": platform.machine(), "system": platform.system()}
+
+def run_benchmarks(names=None, seconds=1.0, repeat=5):
+    results = {}
+    for name in names or BENCHMARKS:
+        value, unit, better = BENCHMARKS[name](seconds, repeat)
+        results[name] = {"value": round(value, 3), "unit": unit, "better": better}
+    return {"environment": environment(), "results": results}
+
+def compare(report, baseline, threshold=THRESHOLD):
+    """Return [(name, baseline value, value, relative change)] for regressions.
+
+    The change is signed so that positive always means worse.
+    """
+    regressions = []
+    for name, now in report["results"].items():
+        then = baseline["results"].get(name)
+        if not then or not then["value"]:
+            continue
+        change = (now["value"] - then["value"]) / then["value"]
+        if now["better"] == HIGHER:
+            change = -change
+        if change > threshold:
+            regressions.append((name, then["value"], now["value"], change))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the game's hot paths.")
+    parser.add_argument("--only", choices=sorted(BENCHMARKS), action="append",
+                        help="benchmark to run (repeatable, default: all)")
+    parser.add_argument("--seconds", type=float, default=1.0, help="time budget per benchmark")
+    parser.add_argument("--repeat", type=int, default=5, help="timed rounds; the best one counts")
+    parser.add_argument("--out", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="allowed relative regression (default %(default)s)")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store these results as the new baseline")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.only, args.seconds, args.repeat)
+    for name, r in report["results"].items():
+        print(f"{name:<14} {r['value']:>14,.3f} {r['unit']:<8} ({r['better']} is better)")
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        print(f"baseline saved to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline}; run with --save-baseline to create one")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("environment") != report["environment"]:
+        print(f"warning: baseline was taken on {baseline.get('environment')}")
+    regressions = compare(report, baseline, args.threshold)
+    for name, then, now, change in regressions:
+        print(f"REGRESSION {name}: {then:,.3f} -> {now:,.3f} ({change:+.1%} worse)")
+    if not regressions:
+        print(f"no regressions beyond {args.threshold:.0%} of the baseline")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
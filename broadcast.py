@@ -0,0 +1,255 @@
+"""
+Spectator mode: live sessions fanned out to many watching connections.
+
+Every session the server runs gets a Channel. Each turn the server
+encodes once (the narrative, fight HP lines, inventory listings and the
+prompt) is published to that channel as one immutable bytes frame.
+Every viewer queues a reference to the same frame, and the bytes go out
+with sendmsg() over memoryviews, so nothing is copied or re-rendered
+per viewer; the only copy is the kernel's, into each socket.
+
+A viewer that cannot keep up never holds up the game. Frames wait in
+its queue up to `max_pending` bytes; past that the oldest frames not yet
+started are dropped, a frame already on its way is finished, and the
+viewer is told it skipped ahead. The newest frame is always kept, so a
+slow viewer catches up with the player instead of falling ever behind.
+
+Viewers connect to the spectator port and answer one prompt with the
+number of the adventure to watch, or an empty line for the newest one.
+
+    broadcast = broadcast.Broadcast()
+    channel = broadcast.open(sid)
+    channel.publish(data)      # each turn, the very bytes sent to the player
+    broadcast.close(sid)
+    await broadcast.serve("127.0.0.1", 4001)
+"""
+
+import asyncio
+import logging
+import socket
+from collections import deque
+
+log = logging.getLogger("pony.broadcast")
+
+MAX_PENDING = 64 * 1024  # bytes a viewer may fall behind before frames are dropped
+LISTED = 10              # adventures named in the greeting
+ADMIT_TIMEOUT = 60.0     # seconds a new viewer has to pick one
+_IOV = 64                # frames per sendmsg() call
+
+SKIPPED = "\n(... skipping ahead to catch up ...)\n".encode("utf-8")
+OVER = "\n(The adventure is over.)\n".encode("utf-8")
+
+_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+class Viewer:
+    """One spectator connection and the frames it has yet to receive."""
+    __slots__ = ("sock", "loop", "channel", "queue", "offset", "pending", "dropped",
+                 "writing", "closing")
+
+    def __init__(self, sock, loop):
+        self.sock = sock
+        self.loop = loop
+        self.channel = None
+        self.queue = deque()   # shared frames; the first is sent from offset
+        self.offset = 0
+        self.pending = 0       # bytes queued and not yet sent
+        self.dropped = 0       # frames it has skipped, all told
+        self.writing = False
+        self.closing = False
+
+    def send(self, frame, limit=MAX_PENDING):
+        queue = self.queue
+        if self.pending + len(frame) > limit:
+            self._drop(self.pending + len(frame) - limit)
+        queue.append(frame)
+        self.pending += len(frame)
+        if not self.writing:
+            self._flush()
+
+    def _drop(self, excess):
+        """Drop the oldest unstarted frames until `excess` bytes are freed."""
+        queue = self.queue
+        started = queue.popleft() if self.offset else None  # never cut a frame in two
+        dropped = 0
+        while queue and excess > 0:
+            frame = queue.popleft()
+            self.pending -= len(frame)
+            excess -= len(frame)
+            if frame is not SKIPPED:
+                dropped += 1
+        if dropped:
+            queue.appendleft(SKIPPED)
+            self.pending += len(SKIPPED)
+            self.dropped += dropped
+        if started is not None:
+            queue.appendleft(started)
+
+    def _flush(self):
+        queue = self.queue
+        while queue:
+            views = [memoryview(queue[0])[self.offset:]]
+            try:
+                if _SENDMSG:
+                    views += [queue[i] for i in range(1, min(len(queue), _IOV))]
+                    sent = self.sock.sendmsg(views)
+                else:
+                    sent = self.sock.send(views[0])
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                self.close()
+                return
+            self.pending -= sent
+            sent += self.offset
+            while queue and sent >= len(queue[0]):
+                sent -= len(queue.popleft())
+            self.offset = sent
+        if queue and not self.writing:
+            self.loop.add_writer(self.sock.fileno(), self._flush)
+            self.writing = True
+        elif not queue:
+            if self.writing:
+                self.loop.remove_writer(self.sock.fileno())
+                self.writing = False
+            if self.closing:
+                self.close()
+
+    def _readable(self):
+        # viewers only watch; anything they type is read and ignored
+        try:
+            data = self.sock.recv(256)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.close()
+
+    def watch(self, channel):
+        self.channel = channel
+        channel.viewers.add(self)
+        self.loop.add_reader(self.sock.fileno(), self._readable)
+
+    def finish(self):
+        """Close once everything queued has gone out."""
+        self.closing = True
+        if not self.queue:
+            self.close()
+
+    def close(self):
+        if self.sock is None:
+            return
+        if self.channel is not None:
+            self.channel.viewers.discard(self)
+            self.channel.broadcast.viewers -= 1
+        fd = self.sock.fileno()
+        self.loop.remove_reader(fd)
+        if self.writing:
+            self.loop.remove_writer(fd)
+        self.sock.close()
+        self.sock = None
+        self.queue.clear()
+
+class Channel:
+    """The frames of one session, and the viewers watching it."""
+    __slots__ = ("sid", "broadcast", "viewers", "last")
+
+    def __init__(self, sid, broadcast):
+        self.sid = sid
+        self.broadcast = broadcast
+        self.viewers = set()
+        self.last = None  # the latest turn, for viewers who join mid-game
+
+    def publish(self, frame, turn=True):
+        """Send `frame` (bytes, never changed afterwards) to every viewer.
+        A turn frame is also what viewers who join later see first."""
+        if turn:
+            self.last = frame
+        limit = self.broadcast.max_pending
+        for viewer in tuple(self.viewers):
+            viewer.send(frame, limit)
+
+class Broadcast:
+    """The channels of a server's live sessions, by session id."""
+
+    def __init__(self, max_pending=MAX_PENDING):
+        self.max_pending = max_pending
+        self.channels = {}
+        self.viewers = 0
+
+    def open(self, sid):
+        channel = self.channels[sid] = Channel(sid, self)
+        return channel
+
+    def close(self, sid):
+        """End a session's channel; its viewers are sent OVER and let go."""
+        channel = self.channels.pop(sid, None)
+        if channel is None:
+            return
+        for viewer in tuple(channel.viewers):
+            viewer.send(OVER, self.max_pending)
+            viewer.finish()
+
+    def newest(self):
+        return next(reversed(self.channels), None)
+
+    def greeting(self):
+        live = list(self.channels)
+        newest = ", ".join(str(sid) for sid in reversed(live[-LISTED:]))
+        text = (f"{len(live)} adventure{'' if len(live) == 1 else 's'} on now"
+                + (f"; the newest: {newest}" if live else ""))
+        return f"{text}\nWatch which one? (number, or Enter for the newest) ".encode("utf-8")
+
+    async def serve(self, host, port, ready=None):
+        """Accept spectators until cancelled."""
+        loop = asyncio.get_running_loop()
+        listener = socket.create_server((host, port), backlog=4096)
+        listener.setblocking(False)
+        log.info("spectators on %s", listener.getsockname())
+        if ready is not None:
+            ready.set_result(listener)
+        admitting = set()
+        try:
+            while True:
+                sock, _ = await loop.sock_accept(listener)
+                task = loop.create_task(self._admit(sock))
+                admitting.add(task)
+                task.add_done_callback(admitting.discard)
+        finally:
+            listener.close()
+            for task in admitting:
+                task.cancel()
+
+    async def _admit(self, sock):
+        loop = asyncio.get_running_loop()
+        sock.setblocking(False)
+        try:
+            await loop.sock_sendall(sock, self.greeting())
+            line = await asyncio.wait_for(_read_line(loop, sock), ADMIT_TIMEOUT)
+        except (asyncio.TimeoutError, OSError):
+            sock.close()
+            return
+        answer = line.decode("utf-8", "replace").strip()
+        if not answer:
+            channel = self.channels.get(self.newest())
+        else:
+            channel = self.channels.get(int(answer)) if answer.isdigit() else None
+        viewer = Viewer(sock, loop)
+        if channel is None:
+            viewer.send(b"There is no adventure on under that number.\n", self.max_pending)
+            viewer.finish()
+            return
+        self.viewers += 1
+        viewer.watch(channel)
+        viewer.send(f"(Watching adventure {channel.sid}.)\n".encode("utf-8"), self.max_pending)
+        if channel.last is not None:
+            viewer.send(channel.last, self.max_pending)
+
+async def _read_line(loop, sock, limit=64):
+    data = b""
+    while b"\n" not in data and len(data) < limit:
+        chunk = await loop.sock_recv(sock, limit)
+        if not chunk:
+            break
+        data += chunk
+    return data.split(b"\n", 1)[0]
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Command logs: record what real sessions were asked and answered, and
+replay them at full speed to catch changes in outcome.
+
+A Recorder wraps unicorn.start()/step() and appends one small binary
+record per command to a log file: the stage and prompt site it answered,
+the prompt text, the command, the dice stream position before it ran and
+CRC32 fingerprints of the output and of the session state after it. The
+server writes one with --record; many sessions can share a file, since
+every record carries its session's stream id.
+
+Replaying rebuilds each session from its seed and stream and feeds the
+commands back through unicorn.step(). Sessions never sleep and never touch
+the terminal, so replay runs as fast as the game logic does, and it stops
+at the first step whose prompt, dice position, output or state differs
+from the recording.
+
+    python server.py --record sessions.log
+    python commandlog.py sessions.log --workers 8
+"""
+
+import argparse
+import os
+import struct
+import sys
+import time
+import zlib
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import unicorn
+
+# ---------------------------
+# Log format
+# ---------------------------
+# Records are appended as sessions run; the stream id ties them together.
+#
+#   start  b"S", seed u64, stream u64, output crc u32, state crc u32
+#   step   b"C", stream u64, stage u8, rng counter u32, output crc u32,
+#          state crc u32, site (u8 length + utf-8), prompt (u8 + utf-8),
+#          command (u16 length + utf-8)
+#   end    b"E", stream u64, ending (u8 length + utf-8)
+#   use    b"U", stream u64, stage u8, crystal catalog id u8,
+#          site (u8 length + utf-8)
+#
+# The counter is the stream position before the command ran; the CRCs are
+# of the text written while it ran and of the session packed afterwards.
+# A use record follows the step that spent a crystal's charge, one per
+# crystal; replay does not need it, reports (analytics.py) do.
+
+_START = struct.Struct("<QQII")
+_STEP = struct.Struct("<QBIII")
+_END = struct.Struct("<Q")
+_USE = struct.Struct("<QBB")
+_LEN16 = struct.Struct("<H")
+
+Step = namedtuple("Step", "stage site prompt command counter output state")
+Use = namedtuple("Use", "stage site item")
+Divergence = namedtuple("Divergence", "seed stream step field expected actual")
+
+class LogError(ValueError):
+    pass
+
+def _text8(text):
+    data = unicorn.clip_utf8(text, 255)
+    return bytes((len(data),)) + data
+
+def _text16(text):
+    data = unicorn.clip_utf8(text, 0xFFFF)
+    return _LEN16.pack(len(data)) + data
+
+def fingerprint(session, mark=0):
+    """CRC32s of the output written since `mark` and of the session state."""
+    output = "\n".join(session.output[mark:]).encode("utf-8")
+    return zlib.crc32(output), zlib.crc32(unicorn._pack_session(session))
+
+class CommandLog:
+    """One session's recording: its dice stream, steps and ending."""
+    __slots__ = ("seed", "stream", "output", "state", "steps", "uses", "ending")
+
+    def __init__(self, seed, stream, output=0, state=0):
+        self.seed = seed
+        self.stream = stream
+        self.output = output
+        self.state = state
+        self.steps = []
+        self.uses = []
+        self.ending = None
+
+    def __len__(self):
+        return len(self.steps)
+
+    def commands(self):
+        return [s.command for s in self.steps]
+
+# ---------------------------
+# Recording
+# ---------------------------
+
+class Recorder:
+    """Steps sessions like unicorn.start()/step() and logs every command.
+
+    `out` is a binary file opened for appending; it is flushed whenever a
+    session ends so a crash loses at most the sessions still running.
+    """
+
+    def __init__(self, out):
+        self.out = out
+
+    def start(self, session):
+        mark = len(session.output)
+        request = unicorn.start(session)
+        output, state = fingerprint(session, mark)
+        self.out.write(b"S" + _START.pack(session.rng.seed, session.rng.stream, output, state))
+        self._check_end(session)
+        return request
+
+    def step(self, session, command):
+        request = session.waiting
+        if request is None or (unicorn._hints is not None
+                               and command.strip().lower() == unicorn.HINT_COMMAND):
+            # a hint changes nothing, and replay has no hints to give
+            return unicorn.step(session, command)
+        stage = session.stage
+        counter = session.rng.counter
+        mark = len(session.output)
+        before = _crystals(session.player)
+        waiting = unicorn.step(session, command)
+        output, state = fingerprint(session, mark)
+        self.out.write(b"".join((
+            b"C", _STEP.pack(session.rng.stream, stage, counter, output, state),
+            _text8(request.site), _text8(request.text), _text16(command))))
+        if before and request.site != "inventory.discard":
+            after = _crystals(session.player)
+            for number, (item, charges) in before.items():
+                # a spent crystal shatters: gone from the inventory means 0 left
+                if after.get(number, (item, 0))[1] < charges:
+                    self.out.write(b"U" + _USE.pack(session.rng.stream, stage, item)
+                                   + _text8(request.site))
+        self._check_end(session)
+        return waiting
+
+    def _check_end(self, session):
+        if session.finished:
+            self.out.write(b"E" + _END.pack(session.rng.stream) + _text8(session.ending))
+            self.out.flush()
+
+def _crystals(player):
+    """{inventory number: (catalog id, charges)} of a player's crystals."""
+    if player is None:
+        return {}
+    return {number: (item.kind.id, item.charges)
+            for number, item in player.inventory.numbered()
+            if isinstance(item, unicorn.Crystal) and item.kind.id is not None}
+
+# ---------------------------
+# Reading
+# ---------------------------
+
+def _read_text(data, pos, width=1):
+    if width == 1:
+        size = data[pos]
+    else:
+        size, = _LEN16.unpack_from(data, pos)
+    pos += width
+    return bytes(data[pos:pos + size]).decode("utf-8"), pos + size
+
+def parse(data):
+    """Split a log into CommandLogs, in the order their sessions started.
+
+    A session that was still running when the log was cut off keeps the
+    steps it has and no ending. A new start for a stream that is already
+    open (a restarted server reusing its ids) begins a new log.
+    """
+    logs = []
+    open_logs = {}
+    pos = 0
+    try:
+        while pos < len(data):
+            kind = data[pos]
+            pos += 1
+            if kind == 0x53:    # "S"
+                seed, stream, output, state = _START.unpack_from(data, pos)
+                pos += _START.size
+                log = open_logs[stream] = CommandLog(seed, stream, output, state)
+                logs.append(log)
+            elif kind == 0x43:  # "C"
+                stream, stage, counter, output, state = _STEP.unpack_from(data, pos)
+                pos += _STEP.size
+                site, pos = _read_text(data, pos)
+                prompt, pos = _read_text(data, pos)
+                command, pos = _read_text(data, pos, 2)
+                open_logs[stream].steps.append(
+                    Step(stage, site, prompt, command, counter, output, state))
+            elif kind == 0x55:  # "U"
+                stream, stage, item = _USE.unpack_from(data, pos)
+                pos += _USE.size
+                site, pos = _read_text(data, pos)
+                open_logs[stream].uses.append(Use(stage, site, item))
+            elif kind == 0x45:  # "E"
+                stream, = _END.unpack_from(data, pos)
+                pos += _END.size
+                open_logs.pop(stream).ending, pos = _read_text(data, pos)
+            else:
+                raise LogError(f"unknown record {kind:#x} at byte {pos - 1}")
+    except (struct.error, IndexError, UnicodeDecodeError) as exc:
+        raise LogError(f"truncated log at byte {pos}: {exc}") from None
+    except KeyError as exc:
+        raise LogError(f"record for stream {exc} before its start") from None
+    return logs
+
+def read_logs(path):
+    with open(path, "rb") as f:
+        return parse(f.read())
+
+# ---------------------------
+# Replay
+# ---------------------------
+
+def replay_log(log):
+    """Replay one CommandLog; return the first Divergence, or None."""
+    def diverged(step, field, expected, actual):
+        return Divergence(log.seed, log.stream, step, field, expected, actual)
+
+    session = unicorn.Session(rng=unicorn.Stream(log.seed, log.stream))
+    unicorn.start(session)
+    output, state = fingerprint(session)
+    if output != log.output:
+        return diverged(-1, "output", log.output, output)
+    if state != log.state:
+        return diverged(-1, "state", log.state, state)
+    for i, step in enumerate(log.steps):
+        request = session.waiting
+        if request is None:
+            return diverged(i, "ended", step.site, session.ending)
+        if request.site != step.site or request.text != step.prompt:
+            return diverged(i, "prompt", (step.site, step.prompt), (request.site, request.text))
+        if session.stage != step.stage:
+            return diverged(i, "stage", step.stage, session.stage)
+        if session.rng.counter != step.counter:
+            return diverged(i, "rng", step.counter, session.rng.counter)
+        session.output.clear()
+        unicorn.step(session, step.command)
+        output, state = fingerprint(session)
+        if output != step.output:
+            return diverged(i, "output", step.output, output)
+        if state != step.state:
+            return diverged(i, "state", step.state, state)
+    if log.ending is not None and session.ending != log.ending:
+        return diverged(len(log.steps), "ending", log.ending, session.ending)
+    return None
+
+def _replay_chunk(logs):
+    return [d for d in map(replay_log, logs) if d is not None]
+
+def replay_logs(logs, workers=None, chunk_size=500):
+    """Replay many logs, across a process pool; return their Divergences."""
+    chunks = [logs[i:i + chunk_size] for i in range(0, len(logs), chunk_size)]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(chunks) <= 1:
+        return [d for chunk in chunks for d in _replay_chunk(chunk)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return [d for found in pool.map(_replay_chunk, chunks) for d in found]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded command logs.")
+    parser.add_argument("logs", nargs="+", help="log files written by a Recorder")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args(argv)
+    logs = [log for path in args.logs for log in read_logs(path)]
+    began = time.perf_counter()
+    divergences = replay_logs(logs, args.workers)
+    elapsed = time.perf_counter() - began
+    steps = sum(len(log) for log in logs)
+    print(f"replayed {len(logs)} sessions, {steps} commands in {elapsed:.2f}s "
+          f"({len(logs) / elapsed if elapsed else 0:.0f} sessions/s)")
+    for d in divergences:
+        print(f"  seed {d.seed} stream {d.stream} step {d.step}: {d.field} "
+              f"expected {d.expected!r}, got {d.actual!r}")
+    return 1 if divergences else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
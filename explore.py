@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""
+Exact ending probabilities for a scripted policy, from the whole story tree.
+
+simulate.py estimates how often each ending comes up by playing games;
+this explorer computes the exact chances instead. It walks the compiled
+story as a probability tree for one pony and one policy: every roll()
+check branches with its exact chance (the amulet search in the caves,
+the gates, the princess), the cloaked figure's offer and every other
+prompt follows the policy's answer, and fights are expanded turn by
+turn. The walk reuses policysolver's symbolic interpreter. Its state keys
+(node, place in the node, player, enemy) make the transposition table:
+branches that reach the same state are explored once, and the few loops
+(a missed turn, a failed sneak) are settled exactly.
+
+    python explore.py --policy brave
+    python explore.py --pony unicorn --policy careful --paths
+
+For each pony the report gives the chance of each ending and, with
+--paths, the single most likely way to reach it. With --cache FILE,
+results are kept there per content version: the story's version and
+digest plus the combat tuning numbers. Change any of them and the tree
+is explored again. Only simulate's named policies are cached.
+
+Policies must be deterministic; simulate's random policy cannot be
+explored. Item numbers a policy types are taken in inventory order,
+as if no item had been removed before.
+"""
+
+import argparse
+import heapq
+import json
+import os
+import sys
+import time
+import zlib
+
+import policysolver
+import simulate
+import unicorn
+
+STUCK = "stuck"  # a policy answer that repeats forever (an unknown command, say)
+
+# ---------------------------
+# Explorer
+# ---------------------------
+
+class Explorer(policysolver.PolicySolver):
+    """Every state one pony reaches under one policy, with its endings.
+
+    table maps each state key to {ending: probability of reaching it from
+    there}; moves maps it to (the policy's answer, {next state key or
+    ending: probability}). Players are kept whole (trim=False), since a
+    policy may read any of the player's fields.
+    """
+
+    def __init__(self, pony, policy, story=None):
+        if pony not in simulate.PONIES:
+            raise ValueError(f"unknown pony {pony!r}; pick one of {', '.join(simulate.PONIES)}")
+        super().__init__(story, trim=False)
+        self.pony = pony
+        self.policy = policy
+        self.moves = {}
+
+    def explore(self):
+        """{ending: probability} from the start of the game."""
+        previous = unicorn.use_console(policysolver._Quiet())
+        try:
+            return dict(self.solve(self.start()))
+        finally:
+            unicorn.use_console(previous)
+
+    def _end(self, ending):
+        return ending
+
+    # the policy's answers
+
+    def _choices(self, key):
+        move = self.moves.get(key)
+        if move is None:
+            options = self.options(key)
+            answer = self._answer(key, [choice for choice, _ in options])
+            move = next((option for option in options if option[0] == answer),
+                        (answer, {STUCK: 1.0}))
+            self.moves[key] = move
+        return [move]
+
+    def prompt(self, key):
+        """(site, prompting step) of a state key."""
+        bid, i, _ = self._frames[key[1]][-1]
+        step = self._blocks[bid][i]
+        op = step[0]
+        if op == unicorn._FIGHT:
+            return "fight", step
+        if op == unicorn._USE_ITEM:
+            return step[2], step
+        if op == unicorn._NEW_PLAYER:
+            return step[4], step
+        return step[1], step
+
+    def _answer(self, key, answers):
+        """The option the policy picks, as options() names it (an answer no
+        option has means the prompt is asked again and again)."""
+        _, _, player, foe = key
+        site, step = self.prompt(key)
+        op = step[0]
+        if op == unicorn._NEW_PLAYER:
+            return simulate.PONIES[self.pony]
+        body = policysolver.thaw(player)
+        enemy = None
+        if foe is not None:
+            enemy = self.story.enemy(foe[0])
+            enemy.health, enemy.agility = foe[1], foe[2]
+        choice = self.policy(site, body, enemy).strip().lower()
+        if op == unicorn._FIGHT:
+            if choice == "use item":
+                return self._item(self.policy("fight.item", body, enemy), body, answers,
+                                  policysolver.PASS)
+            return choice
+        if op == unicorn._MENU:
+            branch = step[5].get(choice)
+            return next((a for a, b in step[5].items() if b is branch), None)
+        if op == unicorn._ASK:
+            branch = step[3].get(choice, step[4])
+            return next((a for a, b in step[3].items() if b is branch),
+                        policysolver._other_answer(step[3]))
+        return self._item(choice, body, answers, "back")
+
+    def _item(self, choice, body, answers, back):
+        """The option for an item number typed at an item prompt; `back`
+        when it picks nothing that has an effect there."""
+        choice = choice.strip()
+        item = body.inventory.get(int(choice)) if choice.isdigit() else None
+        if item is None:
+            return back
+        answer = (item.kind, item.charges if isinstance(item, unicorn.Crystal) else 0)
+        return answer if answer in answers else back
+
+    # settling
+
+    def _settle(self, component, edges):
+        table = self.table
+        moves = {v: edges.pop(v)[0][1] for v in component}
+        values = {v: {} for v in component}
+
+        def spread(v, out):
+            stay = 0.0
+            total = {}
+            for t, p in out.items():
+                if t.__class__ is str:
+                    policysolver._add(total, t, p)
+                elif t == v:
+                    stay += p
+                else:
+                    found = values.get(t)
+                    for ending, q in (table[t] if found is None else found).items():
+                        policysolver._add(total, ending, p * q)
+            if stay >= 1.0 - policysolver.TOLERANCE:
+                return {STUCK: 1.0}
+            return {ending: q / (1.0 - stay) for ending, q in total.items()}
+
+        if len(component) > 1:
+            for _ in range(policysolver.MAX_SWEEPS):
+                change = 0.0
+                for v in component:
+                    now = spread(v, moves[v])
+                    before = values[v]
+                    change = max([change] + [q - before.get(e, 0.0) for e, q in now.items()])
+                    values[v] = now
+                if change < policysolver.TOLERANCE:
+                    break
+        for v in component:
+            ends = spread(v, moves[v])
+            # chance that circles the component for ever never reaches an ending
+            missing = 1.0 - sum(ends.values())
+            if missing > 1e-9:
+                policysolver._add(ends, STUCK, missing)
+            table[v] = values[v] = ends
+
+    # paths
+
+    def likeliest(self):
+        """{ending: (probability, [(node name, site, answer, probability), ...])}:
+        the single most likely sequence of moves to each ending."""
+        root = self.start()
+        if root not in self.moves:
+            self.explore()
+        # the probability of a path only shrinks as it grows, so states can
+        # be taken best first, Dijkstra style, and each is final once taken
+        best = {root: 1.0}
+        came = {}
+        ends = {}
+        done = set()
+        heap = [(-1.0, 0, root)]
+        pushed = 1
+        while heap:
+            p, _, v = heapq.heappop(heap)
+            if v in done:
+                continue
+            done.add(v)
+            for t, q in self.moves[v][1].items():
+                reach = -p * q
+                if t.__class__ is str:
+                    if reach > ends.get(t, (0.0,))[0]:
+                        ends[t] = (reach, v, q)
+                elif reach > best.get(t, 0.0):
+                    best[t] = reach
+                    came[t] = (v, q)
+                    heapq.heappush(heap, (-reach, pushed, t))
+                    pushed += 1
+        paths = {}
+        for ending, (p, v, q) in ends.items():
+            steps = []
+            while True:
+                steps.append(self.describe(v) + (q,))
+                if v not in came:
+                    break
+                v, q = came[v]
+            paths[ending] = (p, steps[::-1])
+        return paths
+
+    def describe(self, key):
+        """(node name, site, answer text) of the policy's move at a state."""
+        site, _ = self.prompt(key)
+        answer = self.moves[key][0]
+        if isinstance(answer, tuple):
+            kind = answer[0]
+            answer = f"use item, then {kind.name}" if site == "fight" else kind.name
+        elif answer is None:
+            answer = "(no such answer)"
+        return self.story.nodes[key[0]].name, site, answer
+
+# ---------------------------
+# Cached results
+# ---------------------------
+
+def content_version(story=None):
+    """What the exact chances depend on besides the policy: the story's
+    version and digest, and the combat tuning numbers."""
+    story = story or unicorn.STORY
+    stats = range(21)
+    tuning = (unicorn.PLAYER_BASE_DAMAGE, unicorn.MAGIC_BASE_DAMAGE, unicorn.ENEMY_BASE_DAMAGE,
+              [(unicorn.player_hit_chance(a, b), unicorn.enemy_hit_chance(a, b),
+                unicorn.flee_chance(a, b)) for a in stats for b in stats],
+              [(effect, [amount(unicorn.Player("", "", magic=m, strength=0, agility=0))
+                         for m in stats])
+               for effect, amount in sorted(unicorn.CRYSTAL_AMOUNTS.items())])
+    return f"{story.version}:{story.digest:08x}:{zlib.crc32(repr(tuning).encode()):08x}"
+
+def _policy_name(policy):
+    """The policy's name in simulate.POLICIES, or None for any other
+    (two lambdas or closures can share a __name__ and not a behavior)."""
+    return next((k for k, v in simulate.POLICIES.items() if v is policy), None)
+
+def explore(pony, policy=simulate.brave_policy, paths=False, cache=None, story=None):
+    """Exact {ending: probability} for one pony and policy, plus
+    {ending: (probability, steps)} with `paths` (None without).
+
+    With a `cache` file, results are looked up there under the content
+    version, pony and policy name, and stored after a fresh exploration.
+    Policies not in simulate.POLICIES are always explored afresh.
+    """
+    if policy is simulate.random_policy:
+        raise ValueError("the random policy cannot be explored; simulate it instead")
+    story = story or unicorn.STORY
+    name = _policy_name(policy)
+    if name is None:
+        cache = None
+    key = f"{content_version(story)}/{pony}/{name}"
+    entries = _read_cache(cache) if cache else {}
+    found = entries.get(key)
+    if found is not None and (found.get("paths") is not None or not paths):
+        likeliest = found.get("paths") if paths else None
+        if likeliest is not None:
+            likeliest = {e: (p, [tuple(step) for step in steps])
+                         for e, (p, steps) in likeliest.items()}
+        return found["endings"], likeliest
+    explorer = Explorer(pony, policy, story)
+    endings = explorer.explore()
+    likeliest = explorer.likeliest() if paths else None
+    if cache:
+        entries[key] = {"endings": endings, "states": len(explorer.table), "paths": likeliest}
+        _write_cache(cache, entries)
+    return endings, likeliest
+
+def _read_cache(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _write_cache(path, entries):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(entries, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+# ---------------------------
+# Command line
+# ---------------------------
+
+def report(pony, policy_name, endings, paths=None):
+    lines = [f"{pony} / {policy_name}: exact"]
+    names = list(simulate.ENDINGS) + sorted(set(endings) - set(simulate.ENDINGS))
+    for ending in names:
+        lines.append(f"  {ending:<10} {endings.get(ending, 0.0):.6f}")
+    for ending in names:
+        if not paths or ending not in paths:
+            continue
+        p, steps = paths[ending]
+        lines.append(f"  likeliest path to {ending} ({p:.6g}):")
+        for node, site, answer, q, repeats in _runs(steps):
+            times = f" x{repeats}" if repeats > 1 else ""
+            lines.append(f"    {node:<12} {site:<14} {answer}{times}  ({q:.4f}{' each' if times else ''})")
+    return "\n".join(lines)
+
+def _runs(steps):
+    """Steps with repeats of the same move and chance folded together."""
+    runs = []
+    for node, site, answer, q in steps:
+        if runs and tuple(runs[-1][:4]) == (node, site, answer, q):
+            runs[-1][4] += 1
+        else:
+            runs.append([node, site, answer, q, 1])
+    return runs
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Exact ending probabilities for a policy.")
+    parser.add_argument("--pony", choices=sorted(simulate.PONIES), action="append",
+                        help="pony type to explore (repeatable, default: all)")
+    parser.add_argument("--policy", choices=sorted(set(simulate.POLICIES) - {"random"}),
+                        default="brave")
+    parser.add_argument("--paths", action="store_true",
+                        help="also show the most likely path to each ending")
+    parser.add_argument("--cache", metavar="FILE",
+                        help="keep results in FILE and reuse them while the content is unchanged")
+    args = parser.parse_args(argv)
+    policy = simulate.POLICIES[args.policy]
+    for pony in args.pony or list(simulate.PONIES):
+        began = time.perf_counter()
+        endings, paths = explore(pony, policy, args.paths, args.cache)
+        print(report(pony, args.policy, endings, paths))
+        print(f"  ({time.perf_counter() - began:.2f}s)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Exact fight() outcomes by dynamic programming instead of sampling.
+
+A fight is a small Markov chain: player HP, enemy HP, enemy agility (rose
+quartz lowers it) and the remaining charges of each crystal. The solver
+builds the transition probabilities from the same roll() chances and
+damage formulas fight() uses and memoizes, per policy, the exact chance of
+each way the fight can end plus the expected number of turns.
+
+    python fightsolver.py --pony earth
+
+The equipped weapon is fixed for a solve (it is part of the solver, not
+the state); switching weapons mid-fight is not modelled.
+"""
+
+import argparse
+import sys
+from collections import namedtuple
+
+import simulate
+import unicorn
+
+FightState = namedtuple("FightState", "player_hp enemy_hp enemy_agility charges")
+
+VICTORY = "victory"
+DEAD = "dead"
+FLED = "fled"
+
+# ---------------------------
+# Policies
+# ---------------------------
+# policy(state, solver) -> "fight" | "magic" | "flee" | ("use", crystal_index)
+
+def always(action):
+    def policy(state, solver):
+        return action
+    policy.__name__ = f"always_{action}"
+    return policy
+
+def flee_below(threshold, action="fight"):
+    def policy(state, solver):
+        return "flee" if state.player_hp < threshold else action
+    policy.__name__ = f"flee_below_{threshold}"
+    return policy
+
+def heal_below(threshold, action="fight"):
+    """Use a healing crystal while hurt, otherwise `action`."""
+    def policy(state, solver):
+        if state.player_hp < threshold:
+            for i, effect in enumerate(solver.effects):
+                if effect == unicorn.HEALING and state.charges[i] > 0:
+                    return ("use", i)
+        return action
+    policy.__name__ = f"heal_below_{threshold}"
+    return policy
+
+ALWAYS_FIGHT = always("fight")
+ALWAYS_MAGIC = always("magic")
+
+# ---------------------------
+# Solver
+# ---------------------------
+
+def _clamp01(p):
+    return max(0.0, min(1.0, p))
+
+class FightResult:
+    """Exact outcome probabilities and expected turns from one state.
+
+    `exits` maps (outcome, final FightState) to its probability, so callers
+    can carry the player's remaining HP and charges into the next scene.
+    """
+    __slots__ = ("exits", "turns")
+
+    def __init__(self, exits, turns):
+        self.exits = exits
+        self.turns = turns
+
+    def probability(self, outcome):
+        return sum(p for (o, _), p in self.exits.items() if o == outcome)
+
+    def summary(self):
+        return {VICTORY: self.probability(VICTORY), DEAD: self.probability(DEAD),
+                FLED: self.probability(FLED), "expected_turns": self.turns}
+
+class FightSolver:
+    """Memoized exact solver for one player build against one enemy."""
+
+    def __init__(self, player, enemy):
+        self.max_health = player.max_health
+        self.magic = player.magic
+        self.agility = player.agility
+        self.strike = player.attack_damage()
+        self.blast = player.magic_power()
+        self.bite = enemy.attack_damage()
+        crystals = [it for it in player.inventory if isinstance(it, unicorn.Crystal)]
+        self.effects = tuple(c.effect for c in crystals)
+        self.amounts = tuple(unicorn.CRYSTAL_AMOUNTS[c.effect](player)
+                             if c.effect in unicorn.CRYSTAL_AMOUNTS else 0 for c in crystals)
+        self.start = FightState(player.health, enemy.health, enemy.agility,
+                                tuple(c.charges for c in crystals))
+        self._tables = {}
+
+    def actions(self, state):
+        acts = ["fight", "magic", "flee"]
+        acts.extend(("use", i) for i, c in enumerate(state.charges) if c > 0)
+        return acts
+
+    def _player_move(self, state, action):
+        """Yield (probability, enemy_hp, player_hp, enemy_agility, charges, fled)."""
+        hp, ehp, eagi, charges = state
+        if action == "fight":
+            p = unicorn.player_hit_chance(self.agility, eagi)
+            yield p, ehp - self.strike, hp, eagi, charges, False
+            yield 1 - p, ehp, hp, eagi, charges, False
+        elif action == "magic":
+            if self.magic <= 0:
+                yield 1.0, ehp, hp, eagi, charges, False
+                return
+            share = 1.0 / (self.magic + 1)
+            for extra in range(self.magic + 1):
+                yield share, ehp - self.blast - extra, hp, eagi, charges, False
+        elif action == "flee":
+            p = _clamp01(unicorn.flee_chance(self.agility, eagi))
+            yield p, ehp, hp, eagi, charges, True
+            yield 1 - p, ehp, hp, eagi, charges, False
+        else:
+            i = action[1]
+            effect, amount = self.effects[i], self.amounts[i]
+            left = charges[:i] + (charges[i] - 1,) + charges[i + 1:]
+            if effect in (unicorn.TELEKINESIS, unicorn.FIRE, unicorn.PROJECTILE):
+                ehp -= amount
+            elif effect == unicorn.HEALING:
+                hp = min(self.max_health, hp + amount)
+            elif effect == unicorn.CHARISMA:
+                eagi = max(0, eagi - amount)
+            yield 1.0, ehp, hp, eagi, left, False
+
+    def transitions(self, state, action):
+        """List of (probability, outcome or None, next FightState)."""
+        out = []
+        for p, ehp, hp, eagi, charges, fled in self._player_move(state, action):
+            if p <= 0:
+                continue
+            if fled:
+                out.append((p, FLED, FightState(hp, ehp, eagi, charges)))
+                continue
+            if ehp <= 0:
+                out.append((p, VICTORY, FightState(hp, ehp, eagi, charges)))
+                continue
+            q = unicorn.enemy_hit_chance(eagi, self.agility)
+            hurt = hp - self.bite
+            out.append((p * q, DEAD if hurt <= 0 else None, FightState(hurt, ehp, eagi, charges)))
+            out.append((p * (1 - q), None, FightState(hp, ehp, eagi, charges)))
+        return out
+
+    def solve(self, policy=ALWAYS_FIGHT, state=None):
+        """Exact FightResult from `state` (default: the starting state)."""
+        table = self._tables.setdefault(policy, {})
+        return self._value(table, policy, state or self.start)
+
+    def _value(self, table, policy, state):
+        found = table.get(state)
+        if found is not None:
+            return found
+        action = policy(state, self)
+        stay = 0.0
+        turns = 1.0
+        exits = {}
+        for p, outcome, nxt in self.transitions(state, action):
+            if outcome is not None:
+                key = (outcome, nxt)
+                exits[key] = exits.get(key, 0.0) + p
+            elif nxt == state:
+                stay += p
+            else:
+                sub = self._value(table, policy, nxt)
+                turns += p * sub.turns
+                for key, q in sub.exits.items():
+                    exits[key] = exits.get(key, 0.0) + p * q
+        if stay >= 1.0:
+            raise ValueError(f"policy never leaves state {state} with action {action!r}")
+        if stay:
+            # a miss-miss turn returns to the same state: geometric repeat
+            scale = 1.0 / (1.0 - stay)
+            turns *= scale
+            exits = {k: v * scale for k, v in exits.items()}
+        result = FightResult(exits, turns)
+        table[state] = result
+        return result
+
+# ---------------------------
+# Content
+# ---------------------------
+
+def game_enemies():
+    """The enemies the story puts in front of the player, in story order."""
+    return [unicorn.STORY.enemy(key) for key in unicorn.STORY.enemies]
+
+def game_ponies(story=None):
+    """{pony: (pony type, magic, strength, agility)} as the story's
+    new_player step hands them out, e.g. "earth": ("Earth Pony", 2, 9, 5)."""
+    story = story or unicorn.STORY
+    ponies = next(step[7] for node in story.nodes for step in unicorn.walk_steps(node.steps)
+                  if step[0] == unicorn._NEW_PLAYER)
+    return {pony: ponies[key][:4] for pony, key in simulate.PONIES.items()}
+
+def fresh_player(pony, story=None):
+    name, magic, strength, agility = game_ponies(story)[pony]
+    return unicorn.Player("Solver", name, magic=magic, strength=strength, agility=agility)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Exact fight outcome solver.")
+    parser.add_argument("--pony", choices=sorted(simulate.PONIES), action="append")
+    parser.add_argument("--weapon", type=int, default=0, help="equipped weapon damage")
+    parser.add_argument("--flee-below", type=int, default=0)
+    parser.add_argument("--magic", action="store_true", help="cast magic instead of fighting")
+    args = parser.parse_args(argv)
+    action = "magic" if args.magic else "fight"
+    policy = flee_below(args.flee_below, action) if args.flee_below else always(action)
+    for pony in args.pony or list(simulate.PONIES):
+        player = fresh_player(pony)
+        if args.weapon:
+            player.weapon = unicorn.Weapon("Weapon", base_damage=args.weapon)
+        for enemy in game_enemies():
+            s = FightSolver(player, enemy).solve(policy).summary()
+            print(f"{pony:<8} vs {enemy.name:<17} victory {s[VICTORY]:.6f}  "
+                  f"dead {s[DEAD]:.6f}  fled {s[FLED]:.6f}  turns {s['expected_turns']:.3f}")
+
+if __name__ == "__main__":
+    sys.exit(main())
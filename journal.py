@@ -0,0 +1,496 @@
+"""
+Session journal: every change to every session, appended to disk, so the
+sessions of a crashed server can be brought back.
+
+A Journal steps sessions like unicorn.start()/step() (wrapping unicorn or
+a commandlog.Recorder) and records, per session, a stream of small typed
+events:
+
+    start    the session's dice seed
+    node     it entered a story node: the stage and its save game
+    command  a command it answered
+    item     an item added to or removed from its inventory
+    charge   a crystal spent a charge (and how many are left)
+    value    health, has_amulet, charisma_bonus, shielded or another stat set
+    end      the game ended, or the player left
+
+The state changes come from the hooks unicorn calls (use_journal()).
+Events are buffered in memory and written in batches. Each batch is one
+CRC-checked frame, appended and fsynced once however many sessions it
+holds, so a torn write at a crash is detected and dropped. The log is
+split into segment files. compact() folds closed segments into a
+snapshot in the background and deletes them: per live session, its seed,
+its last node's save and the commands since.
+
+Recovering is a fold of the latest snapshot and the segments after it
+into that same (seed, save, commands) per session. It reads a few
+dozen bytes per session and replays nothing, so millions of sessions
+recover in seconds. A session is rebuilt only when its player comes
+back (resume()): load the save, replay the commands with the session's
+own dice, and check that the replay produced the recorded item, charge
+and value events.
+
+    journal = journal.Journal("journal", game=unicorn)
+    request = journal.start(session)
+    request = journal.step(session, "fight")
+    journal.commit()       # periodically: write and fsync the batch
+    journal.compact()      # now and then, in a background thread
+"""
+
+import hashlib
+import os
+import re
+import struct
+import threading
+import zlib
+
+import sessionstore
+import unicorn
+
+SEGMENT_BYTES = 64 << 20  # a segment is closed once it grows past this
+FRAME_BYTES = 1 << 20     # records per snapshot frame, roughly
+FIELDS = ("health", "max_health", "magic", "strength", "agility", "has_amulet",
+          "charisma_bonus", "shielded")
+LEFT = "left"             # the ending recorded for a player who disconnected
+
+# ---------------------------
+# Format
+# ---------------------------
+# Segment and snapshot files are sequences of frames:
+#
+#   frame    payload length u32, crc32 u32, records
+#   record   code (1 byte), session u64 (its dice stream id), body
+#
+#   S start    seed u64
+#   N node     stage u8, save (u16 length + bytes)
+#   C command  u16 length + utf-8
+#   A item     number u16, catalog id u16 (0xFFFF for an item not in it)
+#   R removed  number u16
+#   U charge   number u16, charges left u8
+#   V value    field u8 (index in FIELDS), value i16
+#   E end      ending (u8 length + utf-8)
+#   P parked   seed u64, events crc u32, length u32 + sessionstore snapshot
+#
+# P records only appear in snapshots. The events crc covers the A, R, U
+# and V records (code and body) since the session's last N.
+
+_FRAME = struct.Struct("<II")
+_RECORD = struct.Struct("<cQ")
+_U64 = struct.Struct("<Q")
+_NUMBER = struct.Struct("<H")
+_ADDED = struct.Struct("<HH")
+_CHARGE = struct.Struct("<HB")
+_VALUE = struct.Struct("<Bh")
+_FIXED = {b"S": 8, b"A": _ADDED.size, b"R": _NUMBER.size, b"U": _CHARGE.size,
+          b"V": _VALUE.size}
+# variable records: a prefix whose last field is the length of what follows
+_SIZED = {b"C": struct.Struct("<H"), b"N": struct.Struct("<BH"), b"E": struct.Struct("<B"),
+          b"P": struct.Struct("<QII")}
+_EVENTS = frozenset((b"A", b"R", b"U", b"V"))
+_FIELD = {name: i for i, name in enumerate(FIELDS)}
+_NO_ID = 0xFFFF
+
+_SEGMENT = re.compile(r"seg-(\d{8})\.log$")
+_SNAPSHOT = re.compile(r"snap-(\d{8})\.snap$")
+
+class JournalError(ValueError):
+    pass
+
+def resume_code(sid, seed):
+    """The code a player types to get session `sid` back: its id and a
+    check keyed by its secret dice seed."""
+    check = hashlib.blake2b(_U64.pack(sid), digest_size=4, key=_U64.pack(seed)).hexdigest()
+    return f"{sid}-{check}"
+
+def _frame(payload):
+    return _FRAME.pack(len(payload), zlib.crc32(payload)) + payload
+
+def _frames(data):
+    """Payloads of the intact frames in `data`; stops at a torn or corrupt one."""
+    pos = 0
+    while pos + _FRAME.size <= len(data):
+        size, crc = _FRAME.unpack_from(data, pos)
+        payload = data[pos + _FRAME.size:pos + _FRAME.size + size]
+        if len(payload) < size or zlib.crc32(payload) != crc:
+            return
+        yield payload
+        pos += _FRAME.size + size
+
+def records(payload):
+    """(code, session, body) for each record in a frame's payload."""
+    pos = 0
+    while pos < len(payload):
+        code, sid = _RECORD.unpack_from(payload, pos)
+        pos += _RECORD.size
+        size = _FIXED.get(code)
+        if size is None:
+            prefix = _SIZED.get(code)
+            if prefix is None:
+                raise JournalError(f"unknown record {code!r}")
+            size = prefix.size + prefix.unpack_from(payload, pos)[-1]
+        yield code, sid, payload[pos:pos + size]
+        pos += size
+
+def read(path):
+    """Every (code, session, body) in a segment or snapshot file."""
+    with open(path, "rb") as f:
+        data = f.read()
+    for payload in _frames(data):
+        yield from records(payload)
+
+# ---------------------------
+# Folding
+# ---------------------------
+
+class Parked:
+    """What a session needs to be rebuilt: its dice seed, the save taken
+    as it entered its node, the commands since and the events crc."""
+    __slots__ = ("seed", "checkpoint", "commands", "crc")
+
+    def __init__(self, seed, checkpoint=None, commands=None, crc=0):
+        self.seed = seed
+        self.checkpoint = checkpoint
+        self.commands = commands if commands is not None else []
+        self.crc = crc
+
+def fold(sessions, entries):
+    """Apply (code, session, body) records to {session: Parked}."""
+    for code, sid, body in entries:
+        if code == b"S":
+            sessions[sid] = Parked(_U64.unpack(body)[0])
+            continue
+        if code == b"P":
+            seed, crc, _ = _SIZED[b"P"].unpack_from(body)
+            checkpoint, commands = sessionstore.unpack_snapshot(body[_SIZED[b"P"].size:])
+            sessions[sid] = Parked(seed, checkpoint, commands, crc)
+            continue
+        parked = sessions.get(sid)
+        if parked is None:
+            continue
+        if code == b"C":
+            parked.commands.append(bytes(body[_NUMBER.size:]).decode("utf-8"))
+        elif code == b"N":
+            parked.checkpoint = bytes(body[_SIZED[b"N"].size:])
+            parked.commands = []
+            parked.crc = 0
+        elif code == b"E":
+            del sessions[sid]
+        else:
+            parked.crc = zlib.crc32(code + body, parked.crc)
+    return sessions
+
+# ---------------------------
+# Following sessions
+# ---------------------------
+
+class _Follower:
+    """Turns unicorn's journal hooks into records for the one session
+    being stepped (`session`); changes to anyone else are ignored."""
+    session = None
+
+    def _player(self):
+        return self.session.player if self.session is not None else None
+
+    def item_added(self, inventory, number, item):
+        player = self._player()
+        if player is not None and inventory is player.inventory:
+            catalog = item.kind.id
+            self._emit(b"A", _ADDED.pack(number, _NO_ID if catalog is None else catalog))
+
+    def item_removed(self, inventory, number):
+        player = self._player()
+        if player is not None and inventory is player.inventory:
+            self._emit(b"R", _NUMBER.pack(number))
+
+    def charge_used(self, item):
+        player = self._player()
+        if player is None:
+            return
+        for number, held in player.inventory.numbered():
+            if held is item:
+                self._emit(b"U", _CHARGE.pack(number, max(0, min(item.charges, 255))))
+                return
+
+    def changed(self, player, field):
+        index = _FIELD.get(field)
+        if index is not None and player is self._player():
+            value = int(getattr(player, field))
+            self._emit(b"V", _VALUE.pack(index, max(-0x8000, min(value, 0x7FFF))))
+
+    def node(self, session):
+        if session is self.session:
+            self._node(session)
+
+class _Check(_Follower):
+    """Recomputes the events crc of a session being replayed."""
+
+    def __init__(self, session):
+        self.session = session
+        self.crc = 0
+
+    def _emit(self, code, body):
+        self.crc = zlib.crc32(code + body, self.crc)
+
+    def _node(self, session):
+        self.crc = 0
+
+# ---------------------------
+# Journal
+# ---------------------------
+
+class Journal(_Follower):
+    """An append-only journal of sessions in the directory `path`.
+
+    Opening it recovers what an earlier run left there: `parked` maps each
+    session that never ended (the server crashed under it) to its Parked
+    state, until resume() or close(). New records go to a new segment.
+    `game` steps the sessions (unicorn, or a commandlog.Recorder).
+
+    Records are buffered until take() and write(), or commit() for both;
+    a server takes on its event loop and writes (which fsyncs) on a
+    thread. compact() may run on another thread at the same time.
+    """
+
+    def __init__(self, path, game=unicorn, segment_bytes=SEGMENT_BYTES):
+        self.path = path
+        self.game = game
+        self.segment_bytes = segment_bytes
+        self._pending = bytearray()
+        self._sid = None
+        self._live = set()
+        self._lock = threading.Lock()   # the open segment and its number
+        self._file = None
+        self._size = 0
+        os.makedirs(path, exist_ok=True)
+        snapshots, segments = self._files()
+        self._seq = max(snapshots + [s + 1 for s in segments], default=0)
+        self.parked = self._fold_from(snapshots, segments, self._seq)
+
+    # stepping
+
+    def start(self, session):
+        """Start a session and record it; returns the Ask it waits on."""
+        sid = session.rng.stream
+        self._live.add(sid)
+        self._record(sid, b"S", _U64.pack(session.rng.seed))
+        request = self._follow(session, self.game.start, session)
+        self._check_end(sid, session)
+        return request
+
+    def step(self, session, command):
+        """Answer a prompt and record the command and what it changed."""
+        if session.finished:
+            return self.game.step(session, command)
+        sid = session.rng.stream
+        mark = len(self._pending)
+        data = unicorn.clip_utf8(command, 0xFFFF)
+        self._record(sid, b"C", _NUMBER.pack(len(data)) + data)
+        waiting = session.waiting
+        request = self._follow(session, self.game.step, session, command)
+        if session.waiting is waiting and not session.finished:
+            # a hint leaves the same prompt waiting and is not replayed
+            del self._pending[mark:]
+        self._check_end(sid, session)
+        return request
+
+    def leave(self, sid):
+        """Record that a player left before the game ended."""
+        if sid in self._live:
+            self._live.discard(sid)
+            self._end(sid, LEFT)
+
+    def _follow(self, session, call, *args):
+        self.session, self._sid = session, session.rng.stream
+        previous = unicorn.use_journal(self)
+        try:
+            return call(*args)
+        finally:
+            unicorn.use_journal(previous)
+            self.session = self._sid = None
+
+    def _check_end(self, sid, session):
+        if session.finished:
+            self._live.discard(sid)
+            self._end(sid, session.ending)
+
+    def _end(self, sid, ending):
+        data = unicorn.clip_utf8(ending, 255)
+        self._record(sid, b"E", bytes((len(data),)) + data)
+
+    def _record(self, sid, code, body):
+        self._pending += _RECORD.pack(code, sid)
+        self._pending += body
+
+    def _emit(self, code, body):
+        self._record(self._sid, code, body)
+
+    def _node(self, session):
+        checkpoint = session.checkpoint
+        self._emit(b"N", _SIZED[b"N"].pack(session.stage, len(checkpoint)) + checkpoint)
+
+    # writing
+
+    def take(self):
+        """The records buffered since the last take(), as bytes."""
+        data, self._pending = self._pending, bytearray()
+        return bytes(data)
+
+    def write(self, data):
+        """Append records from take() as one frame and fsync once."""
+        if not data:
+            return
+        frame = _frame(data)
+        with self._lock:
+            if self._file is None:
+                self._file = open(self._name("seg", self._seq), "ab")
+                self._size = self._file.tell()
+            self._file.write(frame)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._size += len(frame)
+            if self._size >= self.segment_bytes:
+                self._close_segment()
+
+    def commit(self):
+        """Write and fsync everything buffered."""
+        self.write(self.take())
+
+    def _close_segment(self):
+        # the caller holds the lock; the next write opens the next segment
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._seq += 1
+
+    # compaction
+
+    def compact(self):
+        """Fold the closed segments, and the segment being written, into a
+        new snapshot and delete what it replaces. Returns the number of
+        sessions in the snapshot, or None if there was nothing to fold."""
+        with self._lock:
+            self._close_segment()
+            upto = self._seq
+        snapshots, segments = self._files()
+        base = max((s for s in snapshots if s <= upto), default=None)
+        covered = [s for s in segments if s < upto and (base is None or s >= base)]
+        if not covered:
+            return None
+        sessions = self._fold_from(snapshots, segments, upto)
+        self._write_snapshot(upto, sessions)
+        for s in segments:
+            if s < upto:
+                os.remove(self._name("seg", s))
+        for s in snapshots:
+            if s < upto:
+                os.remove(self._name("snap", s))
+        return len(sessions)
+
+    def _write_snapshot(self, seq, sessions):
+        path = self._name("snap", seq)
+        tmp = path + ".tmp"
+        prefix = _SIZED[b"P"]
+        with open(tmp, "wb") as f:
+            payload = bytearray()
+            for sid, parked in sessions.items():
+                snapshot = sessionstore.pack_snapshot(parked.checkpoint, parked.commands)
+                payload += _RECORD.pack(b"P", sid)
+                payload += prefix.pack(parked.seed, parked.crc, len(snapshot))
+                payload += snapshot
+                if len(payload) >= FRAME_BYTES:
+                    f.write(_frame(bytes(payload)))
+                    payload.clear()
+            if payload:
+                f.write(_frame(bytes(payload)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        self._sync_dir()
+
+    # recovery
+
+    def _fold_from(self, snapshots, segments, upto):
+        """{session: Parked} from the newest snapshot below `upto` and the
+        segments after it."""
+        base = max((s for s in snapshots if s <= upto), default=None)
+        sessions = {}
+        if base is not None:
+            fold(sessions, read(self._name("snap", base)))
+        for s in sorted(segments):
+            if s < upto and (base is None or s >= base):
+                fold(sessions, read(self._name("seg", s)))
+        return {sid: p for sid, p in sessions.items() if p.checkpoint is not None}
+
+    def resume(self, code, session_class=unicorn.Session):
+        """(session id, rebuilt Session, commands since its checkpoint) for
+        a resume code of a parked session, or None if there is none."""
+        sid, _, _ = code.partition("-")
+        if not sid.isdigit():
+            return None
+        sid = int(sid)
+        parked = self.parked.get(sid)
+        if parked is None or resume_code(sid, parked.seed) != code:
+            return None
+        session = self.restore(parked, session_class)
+        del self.parked[sid]
+        self._live.add(sid)
+        return sid, session, list(parked.commands)
+
+    @staticmethod
+    def restore(parked, session_class=unicorn.Session):
+        """Rebuild a parked session by replaying it (JournalError if the
+        replay does not match what was recorded). Its output holds the
+        text of its last turn, what the player saw before the crash."""
+        session = unicorn.load(parked.checkpoint, cls=session_class)
+        check = _Check(session)
+        # replaying what the player already did is not new play: keep it
+        # out of the metrics, the journal and all but the last turn's output
+        journal = unicorn.use_journal(check)
+        metrics = unicorn.use_metrics(None)
+        try:
+            unicorn.start(session)
+            for command in parked.commands:
+                session.drain()
+                unicorn.step(session, command)
+        finally:
+            unicorn.use_journal(journal)
+            unicorn.use_metrics(metrics)
+        if session.checkpoint != parked.checkpoint or check.crc != parked.crc:
+            raise JournalError("session does not replay to its recorded events")
+        return session
+
+    def close(self):
+        """Write everything buffered. Sessions still running and parked ones
+        nobody resumed are not ended: the next Journal on this directory
+        recovers them."""
+        self.commit()
+        with self._lock:
+            self._close_segment()
+
+    # files
+
+    def _name(self, kind, seq):
+        ext = "log" if kind == "seg" else "snap"
+        return os.path.join(self.path, f"{kind}-{seq:08d}.{ext}")
+
+    def _files(self):
+        snapshots, segments = [], []
+        for name in os.listdir(self.path):
+            found = _SNAPSHOT.match(name)
+            if found:
+                snapshots.append(int(found.group(1)))
+                continue
+            found = _SEGMENT.match(name)
+            if found:
+                segments.append(int(found.group(1)))
+        return snapshots, segments
+
+    def _sync_dir(self):
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            return  # not every platform opens directories
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
@@ -0,0 +1,188 @@
+"""
+Per-scene latency and outcome metrics in Prometheus text format.
+
+Install a Metrics object with unicorn.use_metrics() and the game feeds it
+scene wall times, per-command processing times, choice counts, fight
+turns and endings; a server's scheduler adds how long lines waited and
+how many were refused. Histograms have fixed buckets and counters are plain
+dicts, so recording is a bisect and a couple of increments. render()
+produces the Prometheus text exposition format, write() saves it to a
+file (for the node exporter's textfile collector, say) and serve_http()
+answers GET /metrics from the running asyncio loop.
+
+    import metrics, unicorn
+    m = metrics.Metrics()
+    unicorn.use_metrics(m)
+    ...
+    m.write("/var/lib/node_exporter/pony.prom")
+"""
+
+import asyncio
+import os
+from bisect import bisect_left
+
+# seconds; scenes include the time the player spends thinking
+SCENE_BUCKETS = (0.001, 0.01, 0.1, 1, 5, 15, 30, 60, 120, 300, 600, 1800)
+COMMAND_BUCKETS = (5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 5e-3, 0.025, 0.1)
+QUEUE_BUCKETS = (1e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+# Free-text answers (names, typos) must not become label values: only
+# short answers are counted as themselves, and each site keeps at most
+# MAX_CHOICES distinct ones before the rest are counted as "other".
+PRIVATE_SITES = frozenset({"name"})
+MAX_CHOICE_LENGTH = 16
+MAX_CHOICES = 32
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus style."""
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        running = 0
+        for bound, n in zip(self.bounds + (float("inf"),), self.counts):
+            running += n
+            le = "+Inf" if bound == float("inf") else repr(float(bound))
+            yield f"{name}_bucket{_labels(labels + (('le', le),))} {running}"
+        yield f"{name}_sum{_labels(labels)} {self.sum!r}"
+        yield f"{name}_count{_labels(labels)} {self.count}"
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+class Metrics:
+    """The sink unicorn's instrumentation hooks report to."""
+
+    def __init__(self, prefix="pony"):
+        self.prefix = prefix
+        self.scenes = {}    # scene -> Histogram
+        self.commands = {}  # site -> Histogram
+        self.choices = {}   # site -> {choice: count}
+        self.turns = {}     # (enemy, action) -> count
+        self.endings = {}   # ending -> count
+        self.queue = Histogram(QUEUE_BUCKETS)
+        self.refused = {}   # reason -> count
+
+    # hooks called by the game
+
+    def scene(self, name, seconds):
+        hist = self.scenes.get(name)
+        if hist is None:
+            hist = self.scenes[name] = Histogram(SCENE_BUCKETS)
+        hist.observe(seconds)
+
+    def command(self, site, command, seconds):
+        hist = self.commands.get(site)
+        if hist is None:
+            hist = self.commands[site] = Histogram(COMMAND_BUCKETS)
+        hist.observe(seconds)
+        if command is None or site in PRIVATE_SITES:
+            return
+        counts = self.choices.setdefault(site, {})
+        choice = command.strip().lower()
+        if len(choice) > MAX_CHOICE_LENGTH or (choice not in counts and len(counts) >= MAX_CHOICES):
+            choice = "other"
+        counts[choice] = counts.get(choice, 0) + 1
+
+    def fight_turn(self, enemy, action):
+        if action not in ("fight", "magic", "flee", "use item", "inv", "inventory"):
+            action = "other"
+        key = (enemy, action)
+        self.turns[key] = self.turns.get(key, 0) + 1
+
+    def ending(self, name):
+        self.endings[name] = self.endings.get(name, 0) + 1
+
+    # hooks called by the server's scheduler
+
+    def queued(self, seconds):
+        self.queue.observe(seconds)
+
+    def shed(self, reason):
+        self.refused[reason] = self.refused.get(reason, 0) + 1
+
+    # export
+
+    def render(self):
+        """The metrics in Prometheus text exposition format."""
+        p = self.prefix
+        out = [f"# HELP {p}_scene_seconds Wall time spent in each scene, player input included.",
+               f"# TYPE {p}_scene_seconds histogram"]
+        for name, hist in sorted(self.scenes.items()):
+            out.extend(hist.lines(f"{p}_scene_seconds", (("scene", name),)))
+        out += [f"# HELP {p}_command_seconds Server time spent processing one command.",
+                f"# TYPE {p}_command_seconds histogram"]
+        for site, hist in sorted(self.commands.items()):
+            out.extend(hist.lines(f"{p}_command_seconds", (("site", site),)))
+        out += [f"# HELP {p}_choices_total Answers given at each prompt site.",
+                f"# TYPE {p}_choices_total counter"]
+        for site, counts in sorted(self.choices.items()):
+            for choice, n in sorted(counts.items()):
+                out.append(f"{p}_choices_total{_labels((('site', site), ('choice', choice)))} {n}")
+        out += [f"# HELP {p}_fight_turns_total Fight turns by enemy and action.",
+                f"# TYPE {p}_fight_turns_total counter"]
+        for (enemy, action), n in sorted(self.turns.items()):
+            out.append(f"{p}_fight_turns_total{_labels((('enemy', enemy), ('action', action)))} {n}")
+        out += [f"# HELP {p}_endings_total Games finished, by ending.",
+                f"# TYPE {p}_endings_total counter"]
+        for ending, n in sorted(self.endings.items()):
+            out.append(f"{p}_endings_total{_labels((('ending', ending),))} {n}")
+        if self.queue.count or self.refused:
+            out += [f"# HELP {p}_queue_seconds Time a line waited for its turn to be played.",
+                    f"# TYPE {p}_queue_seconds histogram"]
+            out.extend(self.queue.lines(f"{p}_queue_seconds", ()))
+            out += [f"# HELP {p}_refused_total Lines refused by admission control, by reason.",
+                    f"# TYPE {p}_refused_total counter"]
+            for reason, n in sorted(self.refused.items()):
+                out.append(f"{p}_refused_total{_labels((('reason', reason),))} {n}")
+        return "\n".join(out) + "\n"
+
+    def write(self, path):
+        """Write render() to `path` atomically (write, then rename)."""
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+async def serve_http(metrics, host="127.0.0.1", port=9100, ready=None):
+    """Answer GET /metrics with metrics.render() until cancelled."""
+    async def handle(reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass  # skip the headers
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] == b"/metrics":
+                body = metrics.render().encode("utf-8")
+                head = "200 OK\r\nContent-Type: text/plain; version=0.0.4"
+            else:
+                body = b"not found\n"
+                head = "404 Not Found\r\nContent-Type: text/plain"
+            writer.write(f"HTTP/1.1 {head}\r\nContent-Length: {len(body)}\r\n"
+                         f"Connection: close\r\n\r\n".encode("ascii") + body)
+            await writer.drain()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    if ready is not None:
+        ready.set_result(server)
+    async with server:
+        await server.serve_forever()
@@ -0,0 +1,844 @@
+#!/usr/bin/env python3
+"""
+The policy that maximizes the chance of the good ending, and hints from it.
+
+The solver walks the compiled story the way unicorn's interpreter plays it,
+but symbolically: a state is the story node, the interpreter's position in
+it, the player (stats, items, charges, equipped weapon) and the enemy last
+met. roll() checks branch with their exact chances, fights are expanded
+turn by turn from the same hit chances and damage formulas fight() uses,
+and every prompt (fight turns, menus, item pickers, the pony choice) is a
+decision between its answers. States are settled strongly connected
+component by component: most components are a single state, solved in one
+pass (a miss-miss fight turn or a failed sneak is a geometric repeat), and
+the few real cycles are solved by value iteration.
+
+Every settled state goes into a lookup table of (chance of the good ending,
+best answer), so a hint is a dict lookup. States off the table (reached by
+wasting a turn, say) are solved on demand and memoized too.
+
+    python policysolver.py              # optimal odds per pony
+    python policysolver.py --play       # play in the terminal; type "hint"
+
+    hints = policysolver.Hints()
+    hints.prepare()                     # solve the game first; no hints before
+    unicorn.use_hints(hints)
+
+The player's name is not part of a state: content whose checks read the
+name is solved as if every player had the same one.
+"""
+
+import argparse
+import sys
+import time
+
+import unicorn
+
+GOAL = "good"
+PASS = "use item;back"  # the fight answer that does nothing
+TOLERANCE = 1e-12
+TIE = 1e-9  # answers this close in value are equally good
+MAX_SWEEPS = 100_000
+
+# frame kinds: what a block does with its flow when it finishes
+_NODE, _BLOCK, _MENU, _SCENE = range(4)
+
+# player state: the stats below, then the equipped weapon's ItemKind and
+# the items as ((ItemKind, charges), ...) in inventory order
+_STATS = ("health", "max_health", "magic", "strength", "agility", "has_amulet",
+          "charisma_bonus", "shielded", "pony_type")
+_FIELD = {name: i for i, name in enumerate(_STATS)}
+(_HEALTH, _MAX_HEALTH, _MAGIC, _STRENGTH, _AGILITY, _AMULET, _CHARISMA, _SHIELDED,
+ _PONY) = range(len(_STATS))
+_WEAPON = len(_STATS)
+_ITEMS = _WEAPON + 1
+
+_DAMAGE_EFFECTS = frozenset((unicorn.TELEKINESIS, unicorn.FIRE, unicorn.PROJECTILE))
+_HEALTH_NAMES = frozenset(("health", "max_health"))
+
+def _clamp01(p):
+    return max(0.0, min(1.0, p))
+
+def _replace(state, index, value):
+    return state[:index] + (value,) + state[index + 1:]
+
+def freeze(player):
+    """A Player as a hashable solver state (None before the pony is picked)."""
+    if player is None:
+        return None
+    weapon = player.weapon
+    return tuple(getattr(player, name) for name in _STATS) + (
+        weapon.kind if weapon is not None else None,
+        tuple((item.kind, item.charges if isinstance(item, unicorn.Crystal) else 0)
+              for item in player.inventory))
+
+def thaw(state):
+    """A fresh Player matching a solver state."""
+    player = unicorn.Player("", state[_PONY], state[_MAGIC], state[_STRENGTH], state[_AGILITY])
+    for name, value in zip(_STATS, state):
+        setattr(player, name, value)
+    for kind, charges in state[_ITEMS]:
+        item = kind.make()
+        if isinstance(item, unicorn.Crystal):
+            item.charges = charges
+        player.inventory.add(item)
+        if kind is state[_WEAPON] and player.weapon is None:
+            player.weapon = item
+    if state[_WEAPON] is not None and player.weapon is None:
+        player.weapon = state[_WEAPON].make()
+    return player
+
+class _Quiet(unicorn.Console):
+    """Swallows what effect handlers say while the solver applies them."""
+    def __init__(self):
+        pass
+
+    def write(self, text):
+        pass
+
+    def pause(self, seconds):
+        pass
+
+# ---------------------------
+# Solver
+# ---------------------------
+
+class PolicySolver:
+    """Memoized optimal policy for one compiled story.
+
+    A state key is (node ID, place, player state, foe). A place stands
+    for the interpreter's stack at a prompt, frames of (block ID, step
+    index, frame kind); prompts with equal steps and the same way on
+    (the four spirit fights of the forest, say) share one place. The foe
+    is (enemy key, health, agility) or None. table maps each settled key
+    to (chance of reaching `goal`, best answer); an answer is the text to
+    type, or the (ItemKind, charges) of the item to use.
+
+    Before a state is keyed, what the rest of the story can no longer
+    read is dropped from its player: health, the weapon and charges once
+    no fight lies ahead, crystals no later step can use, and items that
+    are never more than inventory listings. `trim=False` keeps them, for
+    subclasses whose choices read the whole player.
+
+    Subclasses can change what a state chooses between (_choices()), how
+    a component is settled (_settle()) and what an ending is worth
+    (_end()); explore.py follows one scripted policy that way.
+    """
+
+    def __init__(self, story=None, goal=GOAL, trim=True):
+        self.story = story or unicorn.STORY
+        self.goal = goal
+        self.trim = trim
+        self.table = {}
+        self._blocks = []    # block ID -> steps
+        self._block_ids = {} # id(steps) -> block ID
+        self._node_of = {self._bid(node.steps): node.id for node in self.story.nodes}
+        self._steps = []     # distinct prompting steps
+        self._frames = []    # place -> the frames first seen there
+        self._shapes = {}    # (step, way on, way out on "leave") -> place
+        self._places = {}    # frames -> place
+        self._needs = []     # place -> (fight ahead, health read, crystal effects used)
+        self.prompts = {}    # id(prompting step) -> (node ID, frames)
+        for node in self.story.nodes:
+            self._index(node.id, ((self._bid(node.steps), 0, _NODE),))
+        self._stats = {}
+        self._exits = {}
+
+    # where prompts live
+
+    def _bid(self, steps):
+        bid = self._block_ids.get(id(steps))
+        if bid is None:
+            bid = self._block_ids[id(steps)] = len(self._blocks)
+            self._blocks.append(steps)
+        return bid
+
+    def _index(self, node, frames):
+        """Record the frames of every prompting step under `frames`."""
+        bid, _, kind = frames[-1]
+        outer = frames[:-1]
+        for i, step in enumerate(self._blocks[bid]):
+            here = outer + ((bid, i, kind),)
+            after = outer + ((bid, i + 1, kind),)
+            op = step[0]
+            if op in (unicorn._FIGHT, unicorn._MENU, unicorn._ASK, unicorn._USE_ITEM,
+                      unicorn._NEW_PLAYER):
+                self.prompts[id(step)] = (node, here)
+            for branch, parent, push in self._children(step, here, after):
+                self._index(node, parent + ((self._bid(branch), 0, push),))
+
+    def _children(self, step, here, after):
+        op = step[0]
+        if op == unicorn._IF or op == unicorn._ROLL:
+            return ((step[2], after, _BLOCK), (step[3], after, _BLOCK))
+        if op == unicorn._FIGHT:
+            return tuple((branch, after, _BLOCK) for branch in step[2].values())
+        if op == unicorn._MENU:
+            return tuple((branch, here, _MENU) for branch in _distinct(step[5].values()))
+        if op == unicorn._ASK:
+            return tuple((branch, after, _BLOCK)
+                         for branch in _distinct(list(step[3].values()) + [step[4]]))
+        if op == unicorn._SPEND:
+            return ((step[4], after, _BLOCK),)
+        if op == unicorn._SCENE:
+            return ((step[2], after, _SCENE),)
+        return ()
+
+    def place(self, frames):
+        """The place of the prompt `frames` stop at."""
+        place = self._places.get(frames)
+        if place is None:
+            bid, i, kind = frames[-1]
+            step = self._blocks[bid][i]
+            after = frames[:-1] + ((bid, i + 1, kind),)
+            shape = (self._step_id(step), self._way_on(after, False), self._way_on(frames, True))
+            place = self._shapes.get(shape)
+            if place is None:
+                place = self._shapes[shape] = len(self._frames)
+                self._frames.append(frames)
+                self._needs.append(self._ahead(frames))
+            self._places[frames] = place
+        return place
+
+    def _ahead(self, frames):
+        """What the steps from `frames` to the end of the game may read."""
+        needs = {"fight": False, "health": False, "effects": set(), "nodes": set()}
+        node = None
+        for bid, i, kind in frames:
+            self._reads(self._blocks[bid][i:], needs)
+            if kind == _NODE:
+                node = self._node_of[bid]
+        needs["nodes"].add(self.story.nodes[node].next)
+        seen = set()
+        while needs["nodes"] - seen:
+            n = min(needs["nodes"] - seen)
+            seen.add(n)
+            if n < len(self.story.nodes):
+                self._reads(self.story.nodes[n].steps, needs)
+                needs["nodes"].add(self.story.nodes[n].next)
+        return needs["fight"], needs["health"], frozenset(needs["effects"])
+
+    def _reads(self, steps, needs):
+        for step in steps:
+            op = step[0]
+            if op == unicorn._FIGHT:
+                needs["fight"] = True
+            elif op == unicorn._IF or op == unicorn._ROLL:
+                needs["health"] |= not _HEALTH_NAMES.isdisjoint(step[1].co_names)
+            elif op == unicorn._USE_ITEM:
+                for effect, handler in unicorn.CRYSTAL_EFFECTS[step[1]].items():
+                    needs["effects"].add(effect)
+                    needs["health"] |= not _HEALTH_NAMES.isdisjoint(handler.__code__.co_names)
+            elif op == unicorn._SPEND:
+                needs["effects"].add(step[1])
+            elif op == unicorn._GOTO:
+                needs["nodes"].add(step[1])
+            for branch, _, _ in self._children(step, (), ()):
+                self._reads(branch, needs)
+
+    def _trim(self, place, player):
+        """`player` without what nothing after `place` reads."""
+        if player is None or not self.trim:
+            return player
+        fight, health, effects = self._needs[place]
+        items = tuple(item for item in player[_ITEMS]
+                      if (item[0].type == "crystal" and (fight or item[0].effect in effects))
+                      or (fight and item[0].type == "weapon"))
+        if fight:
+            return player[:_ITEMS] + (items,) if items != player[_ITEMS] else player
+        return (player[:_HEALTH] + ((player[_HEALTH] if health else None),)
+                + player[_HEALTH + 1:_WEAPON] + (None, items))
+
+    def _step_id(self, step):
+        for n, known in enumerate(self._steps):
+            if known is step or known == step:
+                return n
+        self._steps.append(step)
+        return len(self._steps) - 1
+
+    def _way_on(self, frames, left):
+        """Frames from the next step that does anything, or ("end", node
+        block) once the node is done: what happens from `frames` onwards."""
+        while True:
+            bid, i, kind = frames[-1]
+            steps = self._blocks[bid]
+            if left or i >= len(steps):
+                if kind == _NODE:
+                    return ("end", bid)
+                frames, left = _unwind(frames, left)
+                continue
+            op = steps[i][0]
+            if op <= unicorn._PAUSE or op == unicorn._SHOW_INVENTORY:
+                frames = frames[:-1] + ((bid, i + 1, kind),)
+            elif op == unicorn._LEAVE:
+                left = True
+            else:
+                return frames
+
+    # running the story symbolically
+
+    def _foe(self, foe, key):
+        if key is None or (foe is not None and foe[0] == key):
+            return foe
+        enemy = self.story.enemies[key]
+        return (key, enemy["health"], enemy["agility"])
+
+    def _end(self, ending):
+        return 1.0 if ending == self.goal else 0.0
+
+    def _walk(self, node, frames, player, foe, p, out, left=False):
+        """Play from `frames` until each branch prompts or ends.
+
+        Adds p * (chance of the branch) to out[next state key], or to
+        out[value] for a branch that ends the game. With `left`, the
+        innermost block has just returned "leave".
+        """
+        nodes = self.story.nodes
+        while True:
+            bid, i, kind = frames[-1]
+            steps = self._blocks[bid]
+            if left or i >= len(steps):
+                # the innermost block is done: pop frames as its flow says
+                frames, left = _unwind(frames, left)
+                if frames is None:
+                    node = nodes[node].next
+                    if node >= len(nodes):
+                        _add(out, self._end("unknown"), p)
+                        return
+                    frames, foe = ((self._bid(nodes[node].steps), 0, _NODE),), None
+                continue
+            step = steps[i]
+            op = step[0]
+            after = frames[:-1] + ((bid, i + 1, kind),)
+            if op <= unicorn._PAUSE or op == unicorn._SHOW_INVENTORY:
+                frames = after
+            elif op == unicorn._GIVE:
+                item = step[1]
+                charges = item.charges if item.type == "crystal" else 0
+                player = player[:_ITEMS] + (player[_ITEMS] + ((item, charges),),)
+                frames = after
+            elif op == unicorn._SET:
+                for field, value in step[1]:
+                    if field in _FIELD:
+                        player = _replace(player, _FIELD[field], value)
+                frames = after
+            elif op == unicorn._IF:
+                branch = step[2] if self._eval(step[1], player) else step[3]
+                frames = after + ((self._bid(branch), 0, _BLOCK),)
+            elif op == unicorn._ROLL:
+                chance = _clamp01(self._eval(step[1], player))
+                for branch, q in ((step[2], chance), (step[3], 1.0 - chance)):
+                    if q > 0:
+                        self._walk(node, after + ((self._bid(branch), 0, _BLOCK),),
+                                   player, foe, p * q, out)
+                return
+            elif op == unicorn._FIGHT:
+                foe = self._foe(foe, step[1])
+                if player[_HEALTH] > 0 and foe[1] > 0:
+                    place = self.place(frames)
+                    _add(out, (node, place, self._trim(place, player), foe), p)
+                    return
+                # over before the first turn (a foe already beaten here)
+                frames = self._after_fight(step, after,
+                                           "dead" if player[_HEALTH] <= 0 else "victory")
+            elif op == unicorn._SPEND:
+                pos = _charged(player, step[1])
+                if pos is None:
+                    frames = after
+                else:
+                    player = _spend_charge(player, pos)
+                    frames = after + ((self._bid(step[4]), 0, _BLOCK),)
+            elif op == unicorn._SCENE:
+                frames = after + ((self._bid(step[2]), 0, _SCENE),)
+            elif op == unicorn._LEAVE:
+                left = True
+            elif op == unicorn._END:
+                _add(out, self._end(step[1]), p)
+                return
+            elif op == unicorn._GOTO:
+                node = step[1]
+                if node >= len(nodes):
+                    _add(out, self._end("unknown"), p)
+                    return
+                frames, foe = ((self._bid(nodes[node].steps), 0, _NODE),), None
+            else:  # a prompt: _MENU, _ASK, _USE_ITEM or _NEW_PLAYER
+                if op == unicorn._MENU:
+                    foe = self._foe(foe, step[4])
+                elif op == unicorn._ASK:
+                    foe = self._foe(foe, step[2])
+                elif op == unicorn._USE_ITEM:
+                    foe = self._foe(foe, step[3])
+                place = self.place(frames)
+                _add(out, (node, place, self._trim(place, player), foe), p)
+                return
+
+    def start(self):
+        """The state key of the game's first prompt."""
+        out = {}
+        self._walk(0, ((self._bid(self.story.nodes[0].steps), 0, _NODE),), None, None, 1.0, out)
+        (key, _), = out.items()
+        return key
+
+    def _eval(self, code, player):
+        fields = {"name": ""}
+        fields.update(zip(_STATS, player))
+        return eval(code, unicorn._EXPR_GLOBALS, fields)
+
+    def _after_fight(self, step, after, outcome):
+        branch = step[2].get(outcome)
+        return after + ((self._bid(branch), 0, _BLOCK),) if branch else after
+
+    # decisions
+
+    def options(self, key):
+        """[(answer, {next state key or ending value: probability})] at a prompt."""
+        node, place, player, foe = key
+        frames = self._frames[place]
+        bid, i, kind = frames[-1]
+        step = self._blocks[bid][i]
+        op = step[0]
+        after = frames[:-1] + ((bid, i + 1, kind),)
+        options = []
+        if op == unicorn._FIGHT:
+            return self._fight_options(key, step, after)
+        if op == unicorn._MENU:
+            seen = set()
+            for answer, branch in step[5].items():
+                if id(branch) not in seen:
+                    seen.add(id(branch))
+                    out = {}
+                    self._walk(node, frames + ((self._bid(branch), 0, _MENU),), player, foe, 1.0, out)
+                    options.append((answer, out))
+        elif op == unicorn._ASK:
+            seen = set()
+            choices = list(step[3].items())
+            choices.append((_other_answer(step[3]), step[4]))
+            for answer, branch in choices:
+                if id(branch) not in seen:
+                    seen.add(id(branch))
+                    out = {}
+                    self._walk(node, after + ((self._bid(branch), 0, _BLOCK),), player, foe, 1.0, out)
+                    options.append((answer, out))
+        elif op == unicorn._USE_ITEM:
+            effects = unicorn.CRYSTAL_EFFECTS[step[1]]
+            for pos, (kind_, charges) in enumerate(player[_ITEMS]):
+                if kind_.type != "crystal" or charges <= 0 or kind_.effect not in effects:
+                    continue
+                out = {}
+                used = self._apply(player, pos, effects[kind_.effect])
+                if step[7]:
+                    self._walk(node, frames, used, foe, 1.0, out, left=True)
+                else:
+                    self._walk(node, after, used, foe, 1.0, out)
+                options.append(((kind_, charges), out))
+            out = {}
+            self._walk(node, after, player, foe, 1.0, out)
+            options.append(("back", out))
+        elif op == unicorn._NEW_PLAYER:
+            for answer, (pony_type, magic, strength, agility, _) in step[7].items():
+                out = {}
+                fresh = freeze(unicorn.Player("", pony_type, magic=magic, strength=strength,
+                                              agility=agility))
+                self._walk(node, after, fresh, foe, 1.0, out)
+                options.append((answer, out))
+        return options
+
+    def _apply(self, player, pos, effect):
+        """The player after using the crystal at `pos` through a scene handler."""
+        body = thaw(player)
+        number, item = list(body.inventory.numbered())[pos]
+        item.use()
+        previous = unicorn.use_console(_Quiet())
+        try:
+            effect(body, item)
+        finally:
+            unicorn.use_console(previous)
+        if item.charges <= 0:
+            body.inventory.pop(number)
+        return freeze(body)
+
+    def _fight_options(self, key, step, after):
+        node, place, player, foe = key
+        foe_key, foe_hp, foe_agility = foe
+        agility, magic = player[_AGILITY], player[_MAGIC]
+        weapon = player[_WEAPON]
+        bite = unicorn.ENEMY_BASE_DAMAGE + self.story.enemies[foe_key]["strength"]
+
+        # each action's player move: [(p, player, foe hp, foe agility, fled)]
+        moves = []
+        hit = unicorn.player_hit_chance(agility, foe_agility)
+        strike = unicorn.PLAYER_BASE_DAMAGE + player[_STRENGTH] + (
+            weapon.base_damage if weapon is not None else 0)
+        moves.append(("fight", [(hit, player, foe_hp - strike, foe_agility, False),
+                                (1.0 - hit, player, foe_hp, foe_agility, False)]))
+        if magic <= 0:
+            moves.append(("magic", [(1.0, player, foe_hp, foe_agility, False)]))
+        else:
+            share = 1.0 / (magic + 1)
+            blast = unicorn.MAGIC_BASE_DAMAGE + magic
+            moves.append(("magic", [(share, player, foe_hp - blast - extra, foe_agility, False)
+                                    for extra in range(magic + 1)]))
+        for pos, (kind_, charges) in enumerate(player[_ITEMS]):
+            if kind_.type == "crystal" and charges > 0:
+                moves.append(((kind_, charges),
+                              [self._fight_crystal(player, pos, foe_hp, foe_agility)]))
+            elif kind_.type == "weapon" and kind_ is not weapon:
+                moves.append(((kind_, charges), [(1.0, _replace(player, _WEAPON, kind_), foe_hp,
+                                                  foe_agility, False)]))
+        flee = _clamp01(unicorn.flee_chance(agility, foe_agility))
+        moves.append(("flee", [(flee, player, foe_hp, foe_agility, True),
+                               (1.0 - flee, player, foe_hp, foe_agility, False)]))
+        # opening the item menu and backing out still gives the enemy its turn
+        moves.append((PASS, [(1.0, player, foe_hp, foe_agility, False)]))
+
+        options = []
+        for answer, results in moves:
+            out = {}
+            for p, body, enemy_hp, enemy_agility, fled in results:
+                if p <= 0:
+                    continue
+                # a beaten foe's health below 0 is as good as 0
+                then = (foe_key, max(enemy_hp, 0), enemy_agility)
+                if fled or enemy_hp <= 0:
+                    self._exit(node, self._after_fight(step, after, "fled" if fled else "victory"),
+                               body, then, p, out)
+                    continue
+                q = unicorn.enemy_hit_chance(enemy_agility, agility)
+                if q > 0:
+                    hurt = _replace(body, _HEALTH, body[_HEALTH] - bite)
+                    if hurt[_HEALTH] <= 0:
+                        self._exit(node, self._after_fight(step, after, "dead"), hurt, then,
+                                   p * q, out)
+                    else:
+                        _add(out, (node, place, hurt, then), p * q)
+                if q < 1:
+                    _add(out, (node, place, body, then), p * (1.0 - q))
+            options.append((answer, out))
+        return options
+
+    def _exit(self, node, frames, player, foe, p, out):
+        """_walk() on from the end of a fight, memoized: many different
+        turns end a fight in the same state."""
+        key = (frames, player, foe)
+        found = self._exits.get(key)
+        if found is None:
+            ways = {}
+            self._walk(node, frames, player, foe, 1.0, ways)
+            found = self._exits[key] = tuple(ways.items())
+        for target, q in found:
+            _add(out, target, p * q)
+
+    def _fight_crystal(self, player, pos, foe_hp, foe_agility):
+        """(1.0, player, foe hp, foe agility, False) after a crystal in a fight."""
+        effect = player[_ITEMS][pos][0].effect
+        body = _spend_charge(player, pos)
+        if effect not in unicorn.FIGHT_EFFECTS:
+            pass  # the charge is spent, nothing happens
+        elif effect == unicorn.SHIELD:
+            body = _replace(body, _SHIELDED, True)
+        elif effect in _DAMAGE_EFFECTS:
+            foe_hp -= self._amount(effect, player[_MAGIC])
+        elif effect == unicorn.HEALING:
+            heal = self._amount(effect, player[_MAGIC])
+            body = _replace(body, _HEALTH, min(body[_MAX_HEALTH], body[_HEALTH] + heal))
+        elif effect == unicorn.CHARISMA:
+            foe_agility = max(0, foe_agility - self._amount(effect, player[_MAGIC]))
+        return (1.0, body, foe_hp, foe_agility, False)
+
+    def _amount(self, effect, magic):
+        found = self._stats.get((effect, magic))
+        if found is None:
+            probe = unicorn.Player("", "", magic=magic, strength=0, agility=0)
+            found = self._stats[(effect, magic)] = unicorn.CRYSTAL_AMOUNTS[effect](probe)
+        return found
+
+    # settling states
+
+    def solve(self, key):
+        """(chance of the goal, best answer) from a state key, memoized."""
+        found = self.table.get(key)
+        if found is None:
+            self._settle_from(key)
+            found = self.table[key]
+        return found
+
+    def _settle_from(self, root):
+        # Tarjan's strongly connected components, iteratively; components
+        # come out successors first, so each is settled after what it reaches
+        table = self.table
+        edges = {}
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+
+        def successors(v):
+            options = edges[v] = self._choices(v)
+            return iter([t for _, out in options for t in out
+                         if t.__class__ is tuple and t not in table])
+
+        index[root] = low[root] = 0
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, successors(root))]
+        while work:
+            v, pending = work[-1]
+            for w in pending:
+                if w not in index:
+                    index[w] = low[w] = len(index)
+                    stack.append(w)
+                    on_stack.add(w)
+                    work.append((w, successors(w)))
+                    break
+                if w in on_stack:
+                    low[v] = min(low[v], index[w])
+            else:
+                work.pop()
+                if work:
+                    u = work[-1][0]
+                    low[u] = min(low[u], low[v])
+                if low[v] == index[v]:
+                    component = []
+                    while True:
+                        w = stack.pop()
+                        on_stack.discard(w)
+                        component.append(w)
+                        if w == v:
+                            break
+                    self._settle(component, edges)
+        self._exits.clear()
+
+    def _choices(self, key):
+        """The options a state is settled over (all of them, here)."""
+        return self.options(key)
+
+    def _settle(self, component, edges):
+        table = self.table
+        options = {v: edges.pop(v) for v in component}
+        values = dict.fromkeys(component, 0.0)
+
+        def value(v, out):
+            stay = total = 0.0
+            for t, p in out.items():
+                if t.__class__ is float:
+                    total += p * t
+                elif t == v:
+                    stay += p
+                else:
+                    found = values.get(t)
+                    total += p * (table[t][0] if found is None else found)
+            # an answer that may lead straight back here is repeated until it doesn't
+            return None if stay >= 1.0 - TOLERANCE else total / (1.0 - stay)
+
+        if len(component) > 1:
+            for _ in range(MAX_SWEEPS):
+                change = 0.0
+                for v in component:
+                    best = max((x for x in (value(v, out) for _, out in options[v])
+                                if x is not None), default=0.0)
+                    change = max(change, best - values[v])
+                    values[v] = best
+                if change < TOLERANCE:
+                    break
+        scores = {}
+        for v in component:
+            scored = [(choice, out, value(v, out)) for choice, out in options[v]]
+            best = max((x for _, _, x in scored if x is not None), default=0.0)
+            scores[v] = [(choice, out) for choice, out, x in scored
+                         if x is not None and x >= best - TIE]
+            values[v] = best
+        # Answers that score the same can differ in whether they get
+        # anywhere: at the forest, "use item" with nothing to use goes to
+        # an item menu whose "back" returns to the same prompt. Answers are
+        # taken in rounds, each one leading out of the component or to a
+        # state answered in an earlier round, so following them always
+        # leaves the cycle.
+        settled = set()
+        while len(settled) < len(component):
+            found = {}
+            for v in component:
+                if v in settled:
+                    continue
+                for choice, out in scores[v]:
+                    if any(t.__class__ is float or t in settled or t not in values
+                           for t in out):
+                        found[v] = max(values[v], 0.0), choice
+                        break
+            if not found:
+                break  # what is left cannot reach an ending anyway
+            table.update(found)
+            settled.update(found)
+        for v in component:
+            if v not in settled:
+                table[v] = (max(values[v], 0.0), scores[v][0][0] if scores[v] else None)
+
+def _distinct(branches):
+    seen = {}
+    for branch in branches:
+        seen.setdefault(id(branch), branch)
+    return seen.values()
+
+def _other_answer(choices):
+    return next(a for a in ("no", "n", "skip", "nothing") if a not in choices)
+
+def _add(out, target, p):
+    out[target] = out.get(target, 0.0) + p
+
+def _charged(player, effect):
+    """Position of the newest crystal with charges left for an effect code."""
+    items = player[_ITEMS]
+    for pos in range(len(items) - 1, -1, -1):
+        kind_, charges = items[pos]
+        if kind_.type == "crystal" and charges > 0 and kind_.effect == effect:
+            return pos
+    return None
+
+def _spend_charge(player, pos):
+    """The player after one charge of the crystal at `pos`; it shatters at 0."""
+    items = player[_ITEMS]
+    kind_, charges = items[pos]
+    if charges > 1:
+        items = items[:pos] + ((kind_, charges - 1),) + items[pos + 1:]
+    else:
+        items = items[:pos] + items[pos + 1:]
+    return player[:_ITEMS] + (items,)
+
+def _unwind(frames, left):
+    """Pop finished blocks; returns (frames, flow still "leave") or (None, _)
+    once the node itself is done."""
+    while True:
+        bid, i, kind = frames[-1]
+        frames = frames[:-1]
+        if kind == _NODE:
+            return None, False
+        if kind == _SCENE:
+            return frames, False
+        if kind == _MENU:
+            if left:
+                # "leave" ends the menu: carry on after it
+                bid, i, kind = frames[-1]
+                return frames[:-1] + ((bid, i + 1, kind),), False
+            return frames, False  # back to the menu's prompt
+        if not left:
+            return frames, False
+
+# ---------------------------
+# Hints
+# ---------------------------
+
+class Hints:
+    """Hint provider for unicorn.use_hints(), backed by PolicySolver tables.
+
+    prepare() solves the game, which takes a while; until then, and for
+    a story other than the one prepared, there is no hint to give.
+    """
+
+    def __init__(self, goal=GOAL):
+        self.goal = goal
+        self.solver = None
+
+    def prepare(self, story=None):
+        """Solve the whole game up front; returns the number of states."""
+        solver = PolicySolver(story or unicorn.STORY, self.goal)
+        solver.solve(solver.start())
+        self.solver = solver
+        return len(solver.table)
+
+    def key(self, session):
+        """The solver state a session is waiting in, or None if unknown."""
+        visit = session.visit
+        solver = self.solver
+        if visit is None or solver is None or visit.story is not solver.story:
+            return None
+        prompt = solver.prompts.get(id(visit.at))
+        if prompt is None:
+            return None
+        node, frames = prompt
+        foe = None
+        if visit.foe_key is not None:
+            foe = (visit.foe_key, max(visit.foe.health, 0), visit.foe.agility)
+        place = solver.place(frames)
+        return (node, place, solver._trim(place, freeze(session.player)), foe)
+
+    def best(self, session, request):
+        """(answer to type, chance of the good ending), or None."""
+        key = self.key(session)
+        if key is None:
+            return None
+        previous = unicorn.use_console(_Quiet())
+        try:
+            value, answer = self.solver.solve(key)
+        finally:
+            unicorn.use_console(previous)
+        text = None if answer is None else self._render(answer, session, request)
+        if text is None:
+            return None
+        return text, value
+
+    def hint(self, session, request):
+        found = self.best(session, request)
+        if found is None:
+            return "Hint: no hint for this prompt."
+        text, value = found
+        return f"Hint: {text} ({value:.1%} chance of the {self.goal} ending)"
+
+    def _render(self, answer, session, request):
+        site = request.site if request is not None else ""
+        if isinstance(answer, tuple):
+            kind, charges = answer
+            number, item = next(((n, item) for n, item in session.player.inventory.numbered()
+                                 if item.kind is kind and getattr(item, "charges", 0) == charges),
+                                (None, None))
+            if item is None:
+                return None  # the solved state holds an item the player no longer has
+            if site == "fight":
+                return f"use item, then {number} ({item.name})"
+            return f"{number} ({item.name})"
+        if site == "fight.item":
+            return "back"  # the best move this turn is not an item
+        step = session.visit.at
+        if step[0] == unicorn._NEW_PLAYER:
+            pony = f"{answer} ({step[7][answer][0]})"
+            return f"any name, then {pony}" if site == step[1] else pony
+        return answer
+
+# ---------------------------
+# Command line
+# ---------------------------
+
+def _play():
+    hints = Hints()
+    print("Solving the game for hints...", flush=True)
+    hints.prepare()
+    unicorn.use_hints(hints)
+    try:
+        unicorn.main()
+    except unicorn.GameOver:
+        pass
+    except KeyboardInterrupt:
+        unicorn.say("\nGame interrupted. Goodbye.")
+    unicorn._console.flush()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Optimal policy for the good ending.")
+    parser.add_argument("--play", action="store_true",
+                        help="play in the terminal with the hint command enabled")
+    args = parser.parse_args(argv)
+    if args.play:
+        _play()
+        return 0
+    hints = Hints()
+    began = time.perf_counter()
+    states = hints.prepare()
+    elapsed = time.perf_counter() - began
+    solver = hints.solver
+    print(f"solved {states} states in {elapsed:.2f}s")
+    first = solver.start()
+    for answer, out in solver.options(first):
+        (key, _), = out.items()
+        value, _ = solver.solve(key)
+        print(f"pony {answer}: {value:.6f} chance of the {solver.goal} ending")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
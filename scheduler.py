@@ -0,0 +1,173 @@
+"""
+Fair scheduling and admission control for stepping sessions.
+
+Without a scheduler the server steps a session the moment its line
+arrives, so under a burst every player waits behind everything that
+came in first, bots answering fight after fight or "sneak" after
+"sneak" included, and everyone slows down together. A Scheduler puts
+itself between the lines and the game:
+
+  - admission: each session has a token bucket of `rate` commands a
+    second, up to `burst` at once, and at most `max_queue` commands may
+    wait across all sessions. A line over either limit is refused with
+    Busy, before any of it is played, and the player is told to retry.
+  - fairness: waiting lines are played in deficit round robin. Each
+    round every waiting session is credited `quantum` commands and its
+    line is played once its credit covers the line's commands, so a long
+    pipelined line waits more rounds and a one-command answer is played
+    in the next one.
+
+A line is played whole, as unicorn.pipeline() would play it. The
+dispatcher steps for at most SLICE seconds at a time before letting
+the event loop read and write sockets again. Since the queue is
+bounded, so is the time a line can wait.
+
+    scheduler = Scheduler(rate=20, burst=40, max_queue=2000)
+    request = await scheduler.run(sid, play, cost)   # or raises Busy
+    scheduler.leave(sid)
+"""
+
+import asyncio
+import time
+from collections import deque
+
+RATE = 20.0        # commands a second a session may keep up
+BURST = 40         # commands a session may send at once after a pause
+MAX_QUEUE = 2000   # commands waiting to be played, across sessions
+QUANTUM = 1        # commands credited to each waiting session per round
+SLICE = 0.002      # seconds of play before the event loop gets a turn
+
+class Busy(Exception):
+    """A line was refused before any of it was played. `reason` is "rate"
+    (the session sends too fast) or "queue" (the server is full), and
+    str() is the note for the player."""
+
+    def __init__(self, reason, note):
+        super().__init__(note)
+        self.reason = reason
+
+_SLOW_DOWN = "(Slow down! That line was not played; wait a moment and send it again.)"
+_TOO_LONG = "(That line was not played: send at most {} commands at once.)"
+_BUSY = "(The server is busy. That line was not played; try again in a moment.)"
+
+class _Flow:
+    """One session's rate bucket and the line it has waiting."""
+    __slots__ = ("tokens", "stamp", "deficit", "job")
+
+    def __init__(self, tokens, stamp):
+        self.tokens = tokens
+        self.stamp = stamp
+        self.deficit = 0
+        self.job = None
+
+class _Job:
+    __slots__ = ("play", "cost", "future", "queued")
+
+    def __init__(self, play, cost, future, queued):
+        self.play = play
+        self.cost = cost
+        self.future = future
+        self.queued = queued
+
+class Scheduler:
+    """Admission limits and a deficit round robin over waiting sessions.
+
+    `metrics` (a metrics.Metrics) is told how long each line waited and
+    why lines were refused.
+    """
+
+    def __init__(self, rate=RATE, burst=BURST, max_queue=MAX_QUEUE, quantum=QUANTUM,
+                 metrics=None):
+        self.rate = rate
+        self.burst = burst
+        self.max_queue = max_queue
+        self.quantum = quantum
+        self.metrics = metrics
+        self.depth = 0            # commands waiting
+        self.played = 0
+        self.refused = {"rate": 0, "queue": 0}
+        self._flows = {}          # sid -> _Flow
+        self._waiting = deque()   # sids with a line waiting, in round order
+        self._wake = None
+        self._task = None
+
+    async def run(self, sid, play, cost=1):
+        """Play a line for session `sid` in its turn: `play()` steps it and
+        its result is returned. `cost` is the line's number of commands.
+        Raises Busy if the line is refused."""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        flow = self._flows.get(sid)
+        if flow is None:
+            flow = self._flows[sid] = _Flow(self.burst, now)
+        flow.tokens = min(self.burst, flow.tokens + (now - flow.stamp) * self.rate)
+        flow.stamp = now
+        if flow.tokens < cost:
+            self._refuse("rate")
+            if cost > self.burst:
+                raise Busy("rate", _TOO_LONG.format(self.burst))
+            raise Busy("rate", _SLOW_DOWN)
+        if self.depth + cost > self.max_queue or flow.job is not None:
+            self._refuse("queue")
+            raise Busy("queue", _BUSY)
+        flow.tokens -= cost
+        flow.job = _Job(play, cost, loop.create_future(), time.perf_counter())
+        self.depth += cost
+        self._waiting.append(sid)
+        if self._task is None or self._task.done():
+            self._wake = asyncio.Event()
+            self._task = loop.create_task(self._dispatch())
+        self._wake.set()
+        return await flow.job.future
+
+    def leave(self, sid):
+        """Forget a session that has gone; a line it had waiting is dropped."""
+        flow = self._flows.pop(sid, None)
+        if flow is not None and flow.job is not None:
+            self.depth -= flow.job.cost
+            self._waiting.remove(sid)
+            flow.job.future.cancel()
+
+    def _refuse(self, reason):
+        self.refused[reason] += 1
+        if self.metrics is not None:
+            self.metrics.shed(reason)
+
+    async def _dispatch(self):
+        waiting = self._waiting
+        while True:
+            if not waiting:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            began = time.perf_counter()
+            while waiting and time.perf_counter() - began < SLICE:
+                self._visit()
+            await asyncio.sleep(0)
+
+    def _visit(self):
+        """Give the session at the head of the round its credit, and play
+        its line if that covers it."""
+        waiting = self._waiting
+        sid = waiting.popleft()
+        flow = self._flows[sid]
+        job = flow.job
+        flow.deficit += self.quantum
+        if flow.deficit < job.cost:
+            waiting.append(sid)
+            return
+        # nothing else waits for this session, so its credit starts over
+        flow.deficit = 0
+        flow.job = None
+        self.depth -= job.cost
+        if job.future.done():
+            return  # the player went away meanwhile
+        if self.metrics is not None:
+            self.metrics.queued(time.perf_counter() - job.queued)
+        self.played += 1
+        try:
+            result = job.play()
+        except Exception as exc:
+            job.future.set_exception(exc)
+        else:
+            job.future.set_result(result)
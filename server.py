@@ -0,0 +1,570 @@
+#!/usr/bin/env python3
+"""
+Multi-session line-protocol server for Magic Pony Sparkle Land.
+
+Every TCP connection gets its own unicorn.Session, stepped one line at a
+time, so a waiting player costs one parked session and one idle stream
+instead of a blocked thread or process.
+
+    python server.py --port 4000
+    nc localhost 4000
+
+Protocol: the server sends the text of the turn followed by the prompt
+(e.g. "> ", without a newline); the client answers with one line. A line
+may hold several commands separated by ";" ("use item;2;fight"): they
+answer the next prompts in turn, and a command the game rejects drops
+the rest. Each line's turns go out as a single write; with --typewriter
+the story's dramatic pauses are kept, as asyncio sleeps between the
+parts of the turn.
+
+With --store, sessions live in a sessionstore.SessionStore instead of
+the connection handler: players idle for --evict-after seconds, or the
+least recently used ones once --hot-sessions / --hot-mb is exceeded, are
+spilled to a SQLite file and restored on their next line.
+
+With --journal, every session's commands and state changes go to an
+append-only journal.Journal, written in batches every --journal-interval
+seconds. After a crash or a restart the server recovers the sessions
+that were still running; a player gets theirs back by answering the
+first prompt with "resume CODE", the code shown when the adventure
+began.
+
+With --spectate-port, viewers can watch live sessions: each turn is
+encoded once and fanned out to every viewer of that session by a
+broadcast.Broadcast, and viewers that fall behind skip frames rather
+than slow the player down.
+
+With --schedule, lines are not played the moment they arrive but by a
+scheduler.Scheduler: each session may send --rate commands a second
+(--burst at once), at most --max-queue commands wait in all, and waiting
+lines are played in deficit round robin. A line over a limit is refused
+with a "server busy" note and the prompt is asked again.
+
+With --hints, the game is solved at startup (see policysolver.py) and
+typing "hint" at any prompt shows the best answer and its odds.
+
+With --workers N the content is loaded once and N worker processes are
+forked from it; see "Prefork" below.
+"""
+
+import argparse
+import asyncio
+import functools
+import gc
+import logging
+import os
+import signal
+import socket
+import struct
+import sys
+import time
+
+import broadcast
+import commandlog
+import journal
+import metrics
+import policysolver
+import scheduler
+import sessionstore
+import unicorn
+
+log = logging.getLogger("pony.server")
+
+class PacedSession(unicorn.Session):
+    """Session that remembers where the story paused in its output, so the
+    server can pace delivery without blocking the event loop."""
+    __slots__ = ("marks",)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.marks = []
+
+    def pause(self, seconds):
+        self.marks.append((len(self.output), seconds))
+
+    def drain(self):
+        self.marks.clear()
+        return super().drain()
+
+    def drain_paced(self):
+        """Return [(text, seconds to wait after it)] and clear the output."""
+        chunks = []
+        first = 0
+        for end, seconds in self.marks:
+            chunks.append(("\n".join(self.output[first:end]), seconds))
+            first = end
+        chunks.append(("\n".join(self.output[first:]), 0))
+        self.output.clear()
+        self.marks.clear()
+        return chunks
+
+class GameServer:
+    def __init__(self, idle_timeout=None, max_line=1024, seed=None, recorder=None,
+                 typewriter=False, store=None, journal=None, broadcast=None, scheduler=None):
+        self.idle_timeout = idle_timeout
+        self.max_line = max_line
+        self.seed = seed if seed is not None else unicorn.Stream().seed
+        self.recorder = recorder
+        self.typewriter = typewriter
+        self.store = store
+        self.journal = journal
+        self.broadcast = broadcast
+        self.scheduler = scheduler
+        self.sessions = 0
+        self.started = 0
+
+    async def handle(self, reader, writer, sid=None):
+        self.sessions += 1
+        self.started += 1
+        # session n of this server rolls from stream n of the server's seed;
+        # a prefork worker is told n by the parent that accepted it
+        kind = PacedSession if self.typewriter else unicorn.Session
+        sid = sid if sid is not None else self.started
+        session = kind(rng=unicorn.Stream(self.seed, sid))
+        game = self.journal or self.recorder or unicorn
+        store = self.store
+        request = game.start(session) if store is None else store.start(sid, session)
+        fresh = self.journal is not None
+        note = None
+        if fresh and request is not None:
+            code = journal.resume_code(sid, self.seed)
+            note = (f"(Adventure code {code}. If the server goes down, reconnect "
+                    f"and answer the first prompt with: resume {code})")
+            session.write(note)
+        # viewers watch the connection under the id it started with
+        channel = self.broadcast.open(sid) if self.broadcast is not None else None
+        left = True
+        try:
+            while True:
+                if store is not None:
+                    session = store.get(sid)
+                if self.typewriter:
+                    *paced, (text, _) = session.drain_paced()
+                    for part, seconds in paced:
+                        if part:
+                            data = part.encode("utf-8") + b"\n"
+                            writer.write(data)
+                            if channel is not None:
+                                channel.publish(data, turn=False)
+                        await writer.drain()
+                        await asyncio.sleep(seconds)
+                else:
+                    text = session.drain()
+                out = text + "\n" if text else ""
+                if request is not None:
+                    out += request.text
+                data = out.encode("utf-8")
+                writer.write(data)
+                if channel is not None:
+                    if note is not None:
+                        # the resume code is for the player's eyes only
+                        data = out.replace(note + "\n", "", 1).encode("utf-8")
+                        note = None
+                    channel.publish(data)
+                await writer.drain()
+                if request is None:
+                    break
+                if store is not None:
+                    session = None  # the store may spill it while the player thinks
+                try:
+                    line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+                except (ValueError, asyncio.LimitOverrunError):
+                    break  # a line over max_line
+                if not line:
+                    break
+                # a line may pipeline several commands: "use item;2;fight"
+                command = line.decode("utf-8", "replace").rstrip("\r\n")
+                if fresh:
+                    fresh = False
+                    words = command.split()
+                    if len(words) == 2 and words[0].lower() == "resume":
+                        sid, session, request = self._resume(sid, session, words[1], kind)
+                        continue
+                if channel is not None:
+                    channel.publish(line, turn=False)
+                if store is None:
+                    play = functools.partial(unicorn.pipeline, session, command,
+                                             functools.partial(game.step, session))
+                else:
+                    # fetched when played: the store may spill it while it waits
+                    def play():
+                        return unicorn.pipeline(store.get(sid), command,
+                                                functools.partial(store.step, sid))
+                if self.scheduler is None:
+                    request = play()
+                else:
+                    try:
+                        request = await self.scheduler.run(
+                            sid, play, len(unicorn.split_commands(command)))
+                    except scheduler.Busy as busy:
+                        (session if store is None else store.get(sid)).write(str(busy))
+        except (asyncio.TimeoutError, ConnectionError):
+            # idle too long, or the client went away
+            pass
+        except asyncio.CancelledError:
+            # the server is shutting down; the player has not left, and the
+            # journal keeps the session for them to resume after the restart
+            left = False
+            raise
+        except Exception:
+            log.exception("session crashed")
+        finally:
+            self.sessions -= 1
+            if store is not None:
+                store.discard(sid)
+            if self.journal is not None and left:
+                self.journal.leave(sid)
+            if channel is not None:
+                self.broadcast.close(channel.sid)
+            if self.scheduler is not None:
+                self.scheduler.leave(sid)
+            writer.close()
+
+    def _resume(self, sid, session, code, kind):
+        """(session id, session, request) after a resume command: the
+        recovered session for `code`, or the fresh one with a note."""
+        store = self.store
+        if store is not None:
+            session = store.get(sid)
+        try:
+            found = self.journal.resume(code, kind)
+        except journal.JournalError:
+            log.exception("could not rebuild session %s", code)
+            found = None
+        if found is None:
+            session.write("There is no adventure to resume under that code.")
+            return sid, session, session.waiting
+        if store is not None:
+            store.discard(sid)
+        self.journal.leave(sid)
+        sid, session, tail = found
+        if store is not None:
+            store.put(sid, session, tail)
+        session.write("(Welcome back! Your adventure continues where you left it.)")
+        return sid, session, session.waiting
+
+    async def serve(self, host, port, ready=None):
+        server = await asyncio.start_server(self.handle, host, port,
+                                            limit=self.max_line, backlog=4096)
+        log.info("listening on %s", ", ".join(str(s.getsockname()) for s in server.sockets))
+        if ready is not None:
+            ready.set_result(server)
+        async with server:
+            await server.serve_forever()
+
+async def _write_metrics(sink, path, interval):
+    while True:
+        await asyncio.sleep(interval)
+        sink.write(path)
+
+async def _maintain_store(store, interval):
+    # spill idle players and write changed sessions in one batch per interval
+    while True:
+        await asyncio.sleep(interval)
+        store.evict_idle()
+        store.flush()
+
+async def _maintain_journal(journal_, interval, snapshot_interval):
+    # one batch and one fsync per interval, off the event loop; compaction
+    # runs on another thread and never holds up the batches
+    loop = asyncio.get_running_loop()
+    compacting = None
+    last = loop.time()
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            await loop.run_in_executor(None, journal_.write, journal_.take())
+            if compacting is None and loop.time() - last >= snapshot_interval:
+                compacting = loop.run_in_executor(None, journal_.compact)
+            if compacting is not None and compacting.done():
+                if compacting.exception() is not None:
+                    log.error("journal compaction failed", exc_info=compacting.exception())
+                compacting, last = None, loop.time()
+    finally:
+        if compacting is not None:
+            await asyncio.wait([compacting])
+
+async def _serve_all(server, args, sink, serving):
+    tasks = []
+    if server.store is not None:
+        tasks.append(asyncio.create_task(_maintain_store(server.store, args.flush_interval)))
+    if server.journal is not None:
+        tasks.append(asyncio.create_task(
+            _maintain_journal(server.journal, args.journal_interval, args.snapshot_interval)))
+    if server.broadcast is not None:
+        tasks.append(asyncio.create_task(
+            server.broadcast.serve(args.spectate_host, args.spectate_port)))
+    if sink is not None and args.metrics_port is not None:
+        tasks.append(asyncio.create_task(
+            metrics.serve_http(sink, args.metrics_host, args.metrics_port)))
+    if sink is not None and args.metrics_file:
+        tasks.append(asyncio.create_task(
+            _write_metrics(sink, args.metrics_file, args.metrics_interval)))
+    try:
+        await serving
+    finally:
+        for task in tasks:
+            task.cancel()
+
+# ---------------------------
+# Prefork
+# ---------------------------
+# One CPython process runs on one core. With --workers N the parent
+# loads everything static (importing unicorn compiles the story, art,
+# items and enemies, and pre-wraps the narrative), freezes the GC heap
+# and forks N workers. The content pages then stay shared copy-on-write:
+# the collector never walks, and so never writes to, the frozen objects.
+#
+# The parent only accepts. Connection n becomes session n and goes, as
+# its socket, to worker route(n) over a Unix socket pair. A session
+# therefore always lives on one worker, and it rolls from stream n of
+# the seed whatever the worker count.
+
+_HANDOFF = struct.Struct("<Q")  # session id, sent with the socket
+# a closed seqpacket channel reads as empty, so workers notice a dead parent
+_CHANNEL = socket.SOCK_SEQPACKET if sys.platform.startswith("linux") else socket.SOCK_DGRAM
+
+def route(sid, workers):
+    """The worker session `sid` belongs to."""
+    return sid % workers
+
+async def _take_handoffs(server, channel):
+    """Serve the connections the parent hands this worker until it stops."""
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+    running = set()
+
+    async def serve(fd, sid):
+        reader, writer = await asyncio.open_connection(sock=socket.socket(fileno=fd),
+                                                       limit=server.max_line)
+        await server.handle(reader, writer, sid)
+
+    def receive():
+        while True:
+            try:
+                data, fds, _, _ = socket.recv_fds(channel, _HANDOFF.size, 1)
+            except BlockingIOError:
+                return
+            if not data:
+                stopped.set()  # the parent is gone
+                return
+            task = loop.create_task(serve(fds[0], _HANDOFF.unpack(data)[0]))
+            running.add(task)
+            task.add_done_callback(running.discard)
+
+    channel.setblocking(False)
+    loop.add_reader(channel.fileno(), receive)
+    loop.add_signal_handler(signal.SIGTERM, stopped.set)
+    await stopped.wait()
+
+def _worker(index, channel, args, seed):
+    """Body of a forked worker process; never returns."""
+    gc.enable()
+    code = 0
+    try:
+        _run(args, seed, index, lambda server: _take_handoffs(server, channel))
+    except Exception:
+        log.exception("worker %d crashed", index)
+        code = 1
+    finally:
+        logging.shutdown()
+        os._exit(code)
+
+def serve_prefork(args, workers, seed):
+    """Accept on the parent and hand each connection to its worker."""
+    listener = socket.create_server((args.host, args.port), backlog=4096)
+    listener.settimeout(1.0)
+    log.info("listening on %s with %d workers", listener.getsockname(), workers)
+    channels = [None] * workers
+    pids = {}
+
+    def spawn(index):
+        parent_end, child_end = socket.socketpair(socket.AF_UNIX, _CHANNEL)
+        gc.freeze()
+        pid = os.fork()
+        if pid == 0:
+            listener.close()
+            parent_end.close()
+            for other in channels:
+                if other is not None:
+                    other.close()
+            _worker(index, child_end, args, seed)
+        child_end.close()
+        channels[index] = parent_end
+        pids[pid] = index
+
+    # collecting is off while the content loads and until the last fork,
+    # so nothing shared is moved or touched by a collection in between
+    gc.disable()
+    for index in range(workers):
+        spawn(index)
+    gc.enable()
+    started = 0
+    try:
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except socket.timeout:
+                conn = None
+            while True:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if not pid:
+                    break
+                index = pids.pop(pid)
+                log.warning("worker %d exited (%d); its sessions are lost, restarting",
+                            index, os.waitstatus_to_exitcode(status))
+                channels[index].close()
+                spawn(index)
+            if conn is None:
+                continue
+            started += 1
+            try:
+                socket.send_fds(channels[route(started, workers)],
+                                [_HANDOFF.pack(started)], [conn.fileno()])
+            except OSError:
+                log.exception("could not hand session %d to its worker", started)
+            conn.close()
+    finally:
+        listener.close()
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+        for pid in pids:
+            os.waitpid(pid, 0)
+
+# ---------------------------
+# Command line
+# ---------------------------
+
+def _run(args, seed, index, serving):
+    """Build this process's server and run it until interrupted. Worker
+    `index` of a prefork server writes its own files, suffixed .index,
+    and serves metrics and spectators on their ports + index."""
+    suffix = "" if index is None else f".{index}"
+    out = open(args.record + suffix, "ab") if args.record else None
+    recorder = commandlog.Recorder(out) if out else None
+    journal_ = None
+    if args.journal:
+        journal_ = journal.Journal(args.journal + suffix, game=recorder or unicorn)
+        log.info("recovered %d sessions from %s", len(journal_.parked), args.journal + suffix)
+    store = None
+    if args.store:
+        store = sessionstore.SessionStore(
+            args.store + suffix, args.hot_sessions,
+            int(args.hot_mb * 1e6) if args.hot_mb is not None else None, args.evict_after,
+            game=journal_ or recorder or unicorn,
+            session_class=PacedSession if args.typewriter else unicorn.Session)
+        # sessions belong to connections, and those did not survive the restart
+        store.clear()
+    broadcast_ = None
+    if args.spectate_port is not None:
+        broadcast_ = broadcast.Broadcast(int(args.spectator_kb * 1024))
+    sink = None
+    metrics_file = args.metrics_file + suffix if args.metrics_file else None
+    if args.metrics_port is not None or metrics_file:
+        sink = metrics.Metrics()
+        unicorn.use_metrics(sink)
+    scheduler_ = None
+    if args.schedule:
+        scheduler_ = scheduler.Scheduler(args.rate, args.burst, args.max_queue, metrics=sink)
+    server = GameServer(args.idle_timeout, seed=seed, recorder=recorder,
+                        typewriter=args.typewriter, store=store, journal=journal_,
+                        broadcast=broadcast_, scheduler=scheduler_)
+    if journal_ is not None:
+        # new sessions must not take the ids of recovered ones
+        server.started = max(journal_.parked, default=0)
+    options = argparse.Namespace(**vars(args))
+    options.metrics_file = metrics_file
+    if index is not None and args.metrics_port is not None:
+        options.metrics_port = args.metrics_port + index
+    if index is not None and args.spectate_port is not None:
+        options.spectate_port = args.spectate_port + index
+    try:
+        asyncio.run(_serve_all(server, options, sink, serving(server)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if store is not None:
+            store.close()
+        if journal_ is not None:
+            journal_.close()
+        if out:
+            out.close()
+        if sink is not None and metrics_file:
+            sink.write(metrics_file)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Magic Pony Sparkle Land game server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4000)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes forked from one loaded parent (0: one per core)")
+    parser.add_argument("--idle-timeout", type=float, default=None,
+                        help="seconds to wait for a line before dropping the player")
+    parser.add_argument("--seed", type=int, default=None, help="master seed for session dice")
+    parser.add_argument("--typewriter", action="store_true",
+                        help="keep the story's pauses (without blocking other sessions)")
+    parser.add_argument("--record", metavar="PATH",
+                        help="append every session's commands to a command log")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics on http://HOST:PORT/metrics")
+    parser.add_argument("--metrics-host", default="127.0.0.1")
+    parser.add_argument("--metrics-file", metavar="PATH",
+                        help="write Prometheus metrics to PATH periodically and on exit")
+    parser.add_argument("--metrics-interval", type=float, default=15.0)
+    parser.add_argument("--spectate-port", type=int, default=None,
+                        help="let viewers watch live sessions on this port")
+    parser.add_argument("--spectate-host", default="127.0.0.1")
+    parser.add_argument("--spectator-kb", type=float, default=broadcast.MAX_PENDING / 1024,
+                        help="output a viewer may fall behind by before frames are skipped")
+    parser.add_argument("--schedule", action="store_true",
+                        help="play lines in fair turns, with the admission limits below")
+    parser.add_argument("--rate", type=float, default=scheduler.RATE,
+                        help="commands a second each session may keep up (with --schedule)")
+    parser.add_argument("--burst", type=int, default=scheduler.BURST,
+                        help="commands a session may send at once (with --schedule)")
+    parser.add_argument("--max-queue", type=int, default=scheduler.MAX_QUEUE,
+                        help="commands waiting across sessions before lines are refused")
+    parser.add_argument("--hints", action="store_true",
+                        help="solve the game at startup and answer the hint command")
+    parser.add_argument("--store", metavar="PATH",
+                        help="keep sessions in a session store that spills idle ones to PATH")
+    parser.add_argument("--hot-sessions", type=int, default=10000,
+                        help="sessions kept in memory before the least recent are spilled")
+    parser.add_argument("--hot-mb", type=float, default=None,
+                        help="estimated memory for in-memory sessions, in MB")
+    parser.add_argument("--evict-after", type=float, default=300.0,
+                        help="seconds without a command before a session is spilled")
+    parser.add_argument("--flush-interval", type=float, default=1.0,
+                        help="seconds between batched writes of changed sessions")
+    parser.add_argument("--journal", metavar="DIR",
+                        help="journal every session to DIR and recover them after a crash")
+    parser.add_argument("--journal-interval", type=float, default=0.05,
+                        help="seconds between batched, fsynced journal writes")
+    parser.add_argument("--snapshot-interval", type=float, default=300.0,
+                        help="seconds between journal compactions into a snapshot")
+    args = parser.parse_args(argv)
+    if args.journal and args.workers != 1:
+        # a resuming player can land on any worker, and only one holds the session
+        parser.error("--journal needs a single worker (--workers 1)")
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+    seed = args.seed if args.seed is not None else unicorn.Stream().seed
+    log.info("session dice seed %d", seed)
+    if args.hints:
+        # solved before any fork, so every worker shares the one table
+        hints = policysolver.Hints()
+        began = time.perf_counter()
+        states = hints.prepare()
+        log.info("solved %d hint states in %.1fs", states, time.perf_counter() - began)
+        unicorn.use_hints(hints)
+    workers = args.workers or os.cpu_count() or 1
+    if workers == 1:
+        _run(args, seed, None, lambda server: server.serve(args.host, args.port))
+        return 0
+    try:
+        serve_prefork(args, workers, seed)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,323 @@
+"""
+Session store: a hot LRU of live sessions that spills idle ones to disk.
+
+Hosted players can sit at a prompt for hours. A SessionStore keeps the
+sessions in use in memory, up to a session count and an estimated byte
+budget. When the budget is exceeded, or when a session has been idle
+for `idle_after` seconds, it is evicted as a compact snapshot into a
+SQLite file. The next command for an evicted session restores it
+transparently.
+
+A snapshot is the session's save game (unicorn.save(), taken as it
+entered its current story node) plus the commands it has answered since.
+Restoring loads the save and replays those commands. Dice come from the
+session's counter-based stream, so the replay reaches exactly the prompt,
+HP and enemy state the player left, even in the middle of a fight.
+
+Writes are coalesced. A session that answers many commands between two
+flushes is written once, and each flush writes every changed session in
+one transaction with one commit, so a busy server does not sync the
+disk once per turn.
+
+    store = sessionstore.SessionStore("sessions.db", max_sessions=5000)
+    request = store.start(sid, unicorn.Session())
+    request = store.step(sid, "fight")
+    text = store.get(sid).drain()
+    store.flush()          # periodically, e.g. once a second
+"""
+
+import sqlite3
+import struct
+import time
+from collections import OrderedDict
+
+import unicorn
+
+PARKED_BYTES = 2200  # a parked session's generator frames and player (see bench.py)
+BATCH = 256          # evicted snapshots waiting before a flush is forced
+
+_LEN16 = struct.Struct("<H")
+
+class StoreError(ValueError):
+    pass
+
+def pack_snapshot(checkpoint, commands):
+    """A save game plus the commands answered since, as bytes.
+
+    checkpoint (u16 length + bytes), count u16, then each command
+    (u16 length + utf-8).
+    """
+    parts = [_LEN16.pack(len(checkpoint)), checkpoint, _LEN16.pack(len(commands))]
+    for command in commands:
+        data = unicorn.clip_utf8(command, 0xFFFF)
+        parts.append(_LEN16.pack(len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+def unpack_snapshot(data):
+    """(checkpoint, [command, ...]) from pack_snapshot() bytes."""
+    try:
+        size, = _LEN16.unpack_from(data, 0)
+        pos = _LEN16.size + size
+        checkpoint = bytes(data[_LEN16.size:pos])
+        count, = _LEN16.unpack_from(data, pos)
+        pos += _LEN16.size
+        commands = []
+        for _ in range(count):
+            size, = _LEN16.unpack_from(data, pos)
+            pos += _LEN16.size
+            commands.append(bytes(data[pos:pos + size]).decode("utf-8"))
+            pos += size
+    except (struct.error, UnicodeDecodeError) as exc:
+        raise StoreError(f"corrupt snapshot: {exc}") from None
+    return checkpoint, commands
+
+class _Entry:
+    """A hot session and what its snapshot needs: the commands answered
+    since it entered its node (`tail`, reset whenever its checkpoint
+    changes)."""
+    __slots__ = ("session", "checkpoint", "tail", "size", "used", "dirty")
+
+    def __init__(self, session, used):
+        self.session = session
+        self.checkpoint = session.checkpoint
+        self.tail = []
+        self.size = PARKED_BYTES + len(session.checkpoint or b"")
+        self.used = used
+        self.dirty = True
+
+    def snapshot(self):
+        return pack_snapshot(unicorn.save(self.session), self.tail)
+
+class SessionStore:
+    """Sessions by id: an in-memory LRU in front of a SQLite file.
+
+    `game` steps the sessions (unicorn, or a commandlog.Recorder) and
+    `session_class` is what evicted sessions are restored as. `max_bytes`
+    is checked against an estimate: PARKED_BYTES per session plus its
+    snapshot. A session that ends is dropped from both tiers.
+    """
+
+    def __init__(self, path, max_sessions=10000, max_bytes=None, idle_after=None,
+                 game=unicorn, session_class=unicorn.Session, batch=BATCH):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.idle_after = idle_after
+        self.game = game
+        self.session_class = session_class
+        self.batch = batch
+        self.bytes = 0
+        self.evictions = 0
+        self.restores = 0
+        self._hot = OrderedDict()   # sid -> _Entry, least recently used first
+        self._spilled = {}          # sid -> snapshot evicted since the last flush
+        self._deleted = set()       # sids to delete on the next flush
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS sessions "
+                         "(id INTEGER PRIMARY KEY, snapshot BLOB NOT NULL)")
+        self._db.commit()
+
+    def __len__(self):
+        return len(self._hot) + self.cold()
+
+    def __contains__(self, sid):
+        return sid in self._hot or sid in self._spilled or (
+            sid not in self._deleted and self._load(sid) is not None)
+
+    def hot(self):
+        """Number of sessions in memory."""
+        return len(self._hot)
+
+    def cold(self):
+        """Number of sessions on disk (or waiting to be written there)."""
+        stored = self._db.execute("SELECT id FROM sessions").fetchall()
+        on_disk = {sid for sid, in stored} - self._deleted - set(self._hot)
+        return len(on_disk | set(self._spilled))
+
+    def clear(self):
+        """Forget every session, in memory and on disk."""
+        self._hot.clear()
+        self._spilled.clear()
+        self._deleted.clear()
+        self.bytes = 0
+        self._db.execute("DELETE FROM sessions")
+        self._db.commit()
+
+    # stepping
+
+    def start(self, sid, session):
+        """Start a new session under `sid`; returns the Ask it waits on."""
+        request = self.game.start(session)
+        if session.finished:
+            self.discard(sid)
+            return request
+        self.put(sid, session)
+        return request
+
+    def put(self, sid, session, tail=()):
+        """Keep a session that is already running under `sid` (one rebuilt
+        elsewhere, say); `tail` is the commands it answered since entering
+        its node."""
+        self._drop(sid)
+        self._deleted.discard(sid)
+        self._spilled.pop(sid, None)
+        entry = _Entry(session, time.monotonic())
+        entry.tail = list(tail)
+        entry.size += sum(len(c) + _LEN16.size for c in entry.tail)
+        self._put(sid, entry)
+        self._shed(sid)
+
+    def step(self, sid, command):
+        """Answer the prompt session `sid` waits on (restoring it first if it
+        was evicted); returns the next Ask, or None once it has ended."""
+        entry = self._entry(sid)
+        session = entry.session
+        checkpoint, waiting = session.checkpoint, session.waiting
+        request = self.game.step(session, command)
+        if session.finished:
+            self._drop(sid)
+            self._deleted.add(sid)
+            return request
+        if session.checkpoint is not checkpoint:
+            self.bytes -= entry.size
+            entry.checkpoint, entry.tail = session.checkpoint, []
+            entry.size = PARKED_BYTES + len(session.checkpoint)
+            self.bytes += entry.size
+        elif session.waiting is not waiting:
+            # a hint leaves the same prompt waiting and is not replayed
+            entry.tail.append(command)
+            entry.size += len(command) + _LEN16.size
+            self.bytes += len(command) + _LEN16.size
+        entry.used = time.monotonic()
+        entry.dirty = True
+        self._shed(sid)
+        return request
+
+    def get(self, sid):
+        """The session under `sid`, restored if it was evicted (KeyError if
+        there is none)."""
+        return self._entry(sid).session
+
+    def discard(self, sid):
+        """Drop a session for good (the player left)."""
+        self._drop(sid)
+        self._spilled.pop(sid, None)
+        self._deleted.add(sid)
+
+    # eviction
+
+    def evict(self, sid):
+        """Move a hot session to the disk tier; its snapshot is written on
+        the next flush (or kept as is if it is clean)."""
+        entry = self._drop(sid)
+        if entry is None:
+            return
+        if entry.dirty:
+            self._spilled[sid] = entry.snapshot()
+        self.evictions += 1
+
+    def evict_idle(self, now=None):
+        """Evict every session idle for idle_after seconds; returns how many."""
+        if self.idle_after is None:
+            return 0
+        cutoff = (now if now is not None else time.monotonic()) - self.idle_after
+        idle = []
+        for sid, entry in self._hot.items():
+            if entry.used > cutoff:
+                break  # the rest were used more recently
+            idle.append(sid)
+        for sid in idle:
+            self.evict(sid)
+        if len(self._spilled) >= self.batch:
+            self.flush()
+        return len(idle)
+
+    def _shed(self, keep):
+        """Evict least recently used sessions while over a limit."""
+        while len(self._hot) > 1 and (
+                len(self._hot) > self.max_sessions
+                or (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            sid = next(iter(self._hot))
+            if sid == keep:
+                break
+            self.evict(sid)
+        if len(self._spilled) >= self.batch:
+            self.flush()
+
+    # persistence
+
+    def flush(self):
+        """Write every changed session in one transaction; returns how many
+        snapshots were written."""
+        rows = list(self._spilled.items())
+        for sid, entry in self._hot.items():
+            if entry.dirty:
+                rows.append((sid, entry.snapshot()))
+                entry.dirty = False
+        if not rows and not self._deleted:
+            return 0
+        with self._db:
+            self._db.executemany("DELETE FROM sessions WHERE id = ?",
+                                 [(sid,) for sid in self._deleted])
+            self._db.executemany("INSERT OR REPLACE INTO sessions (id, snapshot) VALUES (?, ?)",
+                                 rows)
+        self._spilled.clear()
+        self._deleted.clear()
+        return len(rows)
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+    def _load(self, sid):
+        row = self._db.execute("SELECT snapshot FROM sessions WHERE id = ?", (sid,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _put(self, sid, entry):
+        self._hot[sid] = entry
+        self.bytes += entry.size
+
+    def _drop(self, sid):
+        entry = self._hot.pop(sid, None)
+        if entry is not None:
+            self.bytes -= entry.size
+        return entry
+
+    def _entry(self, sid):
+        entry = self._hot.get(sid)
+        if entry is not None:
+            self._hot.move_to_end(sid)
+            return entry
+        data = self._spilled.pop(sid, None)
+        dirty = data is not None
+        if data is None and sid not in self._deleted:
+            data = self._load(sid)
+        if data is None:
+            raise KeyError(sid)
+        entry = self._restore(data)
+        entry.dirty = dirty
+        self._put(sid, entry)
+        self.restores += 1
+        self._shed(sid)
+        return entry
+
+    def _restore(self, data):
+        checkpoint, commands = unpack_snapshot(data)
+        session = unicorn.load(checkpoint, cls=self.session_class)
+        # replaying what the player already did is not new play: keep it
+        # out of the metrics, and its output out of the next turn
+        metrics = unicorn.use_metrics(None)
+        try:
+            unicorn.start(session)
+            entry = _Entry(session, time.monotonic())
+            for command in commands:
+                unicorn.step(session, command)
+        finally:
+            unicorn.use_metrics(metrics)
+        session.drain()
+        if session.checkpoint != entry.checkpoint:
+            raise StoreError("snapshot does not replay to the same story node")
+        entry.tail = commands
+        entry.size += sum(len(c) + _LEN16.size for c in commands)
+        return entry
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Headless Monte Carlo playthroughs of Magic Pony Sparkle Land.
+
+Runs complete games through unicorn.main() with a scripted choice policy
+instead of a player at the keyboard, spread over a process pool, and
+reports how often each ending comes up per pony type.
+
+    python simulate.py --pony unicorn --runs 1000000 --policy brave
+"""
+
+import argparse
+import math
+import os
+import random
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import unicorn
+
+PONIES = {"earth": "1", "unicorn": "2", "pegasus": "3"}
+ENDINGS = ("good", "jail", "explosion", "dead")
+MAX_PROMPTS = 500  # a policy that never leaves a loop ends the run as "stuck"
+
+# ---------------------------
+# Policies
+# ---------------------------
+# A policy is a plain function policy(site, player, enemy) -> command.
+# It must live at module level so worker processes can unpickle it.
+
+def brave_policy(site, player, enemy):
+    """Fight everything head on, sneak aboard, accept the deal, explain."""
+    return {
+        "fight": "fight",
+        "forest": "fight",
+        "port": "sneak",
+        "offer": "yes",
+        "gates": "explain",
+        "princess": "give",
+    }.get(site, "back")
+
+def careful_policy(site, player, enemy):
+    """Use magic when it is strong, flee when hurt, persuade and explain."""
+    if site == "fight":
+        if player.health <= player.max_health // 4:
+            return "flee"
+        return "magic" if player.magic > player.strength else "fight"
+    return {
+        "forest": "magic" if player.magic >= 5 else "talk",
+        "port": "persuade",
+        "offer": "yes",
+        "gates": "explain",
+        "princess": "explain",
+    }.get(site, "back")
+
+def random_policy(site, player, enemy):
+    """Pick uniformly among the options each prompt advertises."""
+    return unicorn.current_rng().choice({
+        "fight": ("fight", "magic", "flee"),
+        "forest": ("talk", "fight", "magic", "flee"),
+        "port": ("persuade", "sneak"),
+        "offer": ("yes", "no"),
+        "gates": ("explain", "lie", "hand over"),
+        "princess": ("give", "explain"),
+    }.get(site, ("back",)))
+
+POLICIES = {
+    "brave": brave_policy,
+    "careful": careful_policy,
+    "random": random_policy,
+}
+
+# ---------------------------
+# Headless play
+# ---------------------------
+
+class _Stuck(Exception):
+    pass
+
+class PolicyConsole(unicorn.Console):
+    """Console that discards output, never sleeps and asks a policy."""
+    def __init__(self, pony, policy, max_prompts=MAX_PROMPTS, rng=None):
+        self.rng = rng if rng is not None else unicorn.Stream()
+        self.pony = pony
+        self.policy = policy
+        self.max_prompts = max_prompts
+        self.prompts = 0
+
+    def write(self, text):
+        pass
+
+    def pause(self, seconds):
+        pass
+
+    def read(self, site, text="> ", player=None, enemy=None):
+        self.prompts += 1
+        if self.prompts > self.max_prompts:
+            raise _Stuck()
+        if site == "name":
+            return "Sim"
+        if site == "pony":
+            return PONIES[self.pony]
+        return self.policy(site, player, enemy)
+
+def play(pony, policy=brave_policy, max_prompts=MAX_PROMPTS, rng=None):
+    """Play one full game headlessly and return its ending."""
+    console = PolicyConsole(pony, policy, max_prompts, rng)
+    previous = unicorn.use_console(console)
+    try:
+        unicorn.main()
+    except unicorn.GameOver as over:
+        return over.ending
+    except _Stuck:
+        return "stuck"
+    finally:
+        unicorn.use_console(previous)
+    return "unknown"
+
+def _play_chunk(pony, policy, seed, first, runs):
+    # run i always rolls from stream i of the master seed, whichever
+    # worker it lands on, so totals do not depend on the worker count
+    counts = Counter()
+    for run in range(first, first + runs):
+        counts[play(pony, policy, rng=unicorn.Stream(seed, run))] += 1
+    return counts
+
+# ---------------------------
+# Aggregation
+# ---------------------------
+
+def wilson_interval(hits, runs, z=1.96):
+    """Wilson score interval for a proportion (95% by default)."""
+    if runs == 0:
+        return (0.0, 1.0)
+    p = hits / runs
+    denom = 1 + z * z / runs
+    centre = (p + z * z / (2 * runs)) / denom
+    half = z * math.sqrt(p * (1 - p) / runs + z * z / (4 * runs * runs)) / denom
+    return (max(0.0, centre - half), min(1.0, centre + half))
+
+class SimulationResult:
+    def __init__(self, pony, policy_name, counts, seed=None):
+        self.pony = pony
+        self.policy_name = policy_name
+        self.seed = seed
+        self.counts = Counter(counts)
+        self.runs = sum(self.counts.values())
+
+    def probability(self, ending):
+        return self.counts[ending] / self.runs if self.runs else 0.0
+
+    def interval(self, ending, z=1.96):
+        return wilson_interval(self.counts[ending], self.runs, z)
+
+    def report(self):
+        lines = [f"{self.pony} / {self.policy_name}: {self.runs} runs (seed {self.seed})"]
+        endings = list(ENDINGS) + sorted(set(self.counts) - set(ENDINGS))
+        for ending in endings:
+            lo, hi = self.interval(ending)
+            lines.append(f"  {ending:<10} {self.counts[ending]:>10}  "
+                         f"{self.probability(ending):7.4f}  [{lo:.4f}, {hi:.4f}]")
+        return "\n".join(lines)
+
+def simulate(pony, runs, policy=brave_policy, workers=None, chunk_size=5000, seed=None):
+    """Play `runs` games for one pony type across a process pool.
+
+    Run i rolls from unicorn.Stream(seed, i), so the same seed gives the
+    same counts for any number of workers; any single run can be replayed.
+    """
+    if pony not in PONIES:
+        raise ValueError(f"unknown pony {pony!r}; pick one of {', '.join(PONIES)}")
+    if seed is None:
+        seed = random.getrandbits(64)
+    chunks = [(first, min(chunk_size, runs - first)) for first in range(0, runs, chunk_size)]
+    counts = Counter()
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for first, n in chunks:
+            counts.update(_play_chunk(pony, policy, seed, first, n))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_play_chunk, pony, policy, seed, first, n)
+                       for first, n in chunks]
+            for future in futures:
+                counts.update(future.result())
+    name = next((k for k, v in POLICIES.items() if v is policy), policy.__name__)
+    return SimulationResult(pony, name, counts, seed)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless ending-probability simulator.")
+    parser.add_argument("--pony", choices=sorted(PONIES), action="append",
+                        help="pony type to simulate (repeatable, default: all)")
+    parser.add_argument("--runs", type=int, default=100000)
+    parser.add_argument("--policy", choices=sorted(POLICIES), default="brave")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=None,
+                        help="master seed; the same seed reproduces the same counts")
+    args = parser.parse_args(argv)
+    for pony in args.pony or list(PONIES):
+        result = simulate(pony, args.runs, POLICIES[args.policy], args.workers, seed=args.seed)
+        print(result.report())
+
+if __name__ == "__main__":
+    sys.exit(main())
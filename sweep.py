@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""
+Balance-tuning sweeps over pony and enemy stats.
+
+Evaluates a grid, or a random sample, of settings for the ponies' stat
+triples (magic / strength / agility) and the story's enemies (health /
+strength / agility). At every point each pony fights the story's enemies
+in order, HP carried from one fight to the next. A chunk of points is
+resolved in one batchfight pass per fight, and chunks are fanned out over
+a process pool. Rows are streamed to the output as chunks finish, so an
+interrupted sweep picks up where it stopped when run again with the same
+arguments.
+
+    python sweep.py --vary earth.strength=7:11 --vary bulldog.health=18,22,26
+    python sweep.py --random 2000 --vary unicorn.magic=4:10 \\
+        --vary spirit.agility=3:9 --runs 5000 --out sweep.parquet
+
+A .csv output is one file. A .parquet output is a directory with one part
+file per chunk and needs pyarrow. Like batchfight, this needs NumPy.
+
+Every pony fights with the best weapon the story has handed out by then
+and follows one scripted action (fight or magic, fleeing below
+--flee-below HP). Crystals are not used.
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import math
+import os
+import sys
+import time
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+import batchfight
+import simulate
+import unicorn
+
+PONY_STATS = ("magic", "strength", "agility")
+ENEMY_STATS = ("health", "strength", "agility")
+ACTIONS = {"fight": batchfight.FIGHT, "magic": batchfight.MAGIC}
+CHUNK_SIZE = 32  # points per task; a chunk is also the unit of resuming
+
+# ---------------------------
+# Content
+# ---------------------------
+
+def defaults(story=None):
+    """{parameter: value} for every tunable stat, e.g. "earth.strength": 9."""
+    story = story or unicorn.STORY
+    ponies = next(step[7] for node in story.nodes for step in unicorn.walk_steps(node.steps)
+                  if step[0] == unicorn._NEW_PLAYER)
+    params = {}
+    for pony, key in simulate.PONIES.items():
+        _, magic, strength, agility, _ = ponies[key]
+        params.update(zip((f"{pony}.{stat}" for stat in PONY_STATS), (magic, strength, agility)))
+    for key, enemy in story.enemies.items():
+        params.update((f"{key}.{stat}", enemy[stat]) for stat in ENEMY_STATS)
+    return params
+
+def fights(story=None):
+    """[(enemy key, weapon damage)] for each enemy in the order the story
+    meets it, with the best weapon handed out before that point."""
+    story = story or unicorn.STORY
+    best = 0
+    out = []
+    for node in story.nodes:
+        for step in unicorn.walk_steps(node.steps):
+            if step[0] == unicorn._GIVE and step[1].type == "weapon":
+                best = max(best, step[1].base_damage)
+            elif step[0] == unicorn._FIGHT and step[1] not in dict(out):
+                out.append((step[1], best))
+    return out
+
+def parse_values(text):
+    """"7:11" (inclusive), "6:12:2" or "18,22,26" as a tuple of ints."""
+    try:
+        if ":" in text:
+            lo, hi, *rest = (int(x) for x in text.split(":"))
+            if len(rest) > 1:
+                raise ValueError(text)
+            values = tuple(range(lo, hi + 1, rest[0] if rest else 1))
+        else:
+            values = tuple(int(x) for x in text.split(","))
+    except ValueError:
+        raise ValueError(f"bad values {text!r}; use lo:hi, lo:hi:step or a,b,c") from None
+    if not values:
+        raise ValueError(f"no values in {text!r}")
+    return values
+
+# ---------------------------
+# Sweeps
+# ---------------------------
+
+class Sweep:
+    """The points of a sweep and how each is evaluated.
+
+    `vary` maps parameter names to the values they take. As a grid the
+    points are every combination, in order; with `samples` the sweep is a
+    random search of that many points, point i drawing its values from
+    unicorn.Stream(seed, i). Either way point i is the same whatever the
+    chunking, worker count or resume history. Everything here is plain
+    data, so a Sweep pickles to the worker processes.
+    """
+
+    def __init__(self, vary, runs=2000, samples=None, seed=1, action="fight",
+                 flee_below=0, chunk_size=CHUNK_SIZE, story=None):
+        self.base = defaults(story)
+        unknown = set(vary) - set(self.base)
+        if unknown:
+            raise ValueError(f"unknown parameter(s) {', '.join(sorted(unknown))}; "
+                             f"pick from {', '.join(self.base)}")
+        if action not in ACTIONS:
+            raise ValueError(f"unknown action {action!r}")
+        self.vary = {name: tuple(values) for name, values in vary.items()}
+        self.runs = runs
+        self.samples = samples
+        self.seed = seed
+        self.action = action
+        self.flee_below = flee_below
+        self.chunk_size = chunk_size
+        self.fights = fights(story)
+        if samples is None:
+            self.size = math.prod(len(v) for v in self.vary.values())
+        else:
+            self.size = samples
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def key(self):
+        """Identifies the sweep's settings, so a resume never mixes two sweeps."""
+        spec = [self.base, self.vary, self.runs, self.samples, self.seed, self.action,
+                self.flee_below, self.chunk_size, self.fights]
+        return f"{zlib.crc32(json.dumps(spec, sort_keys=True).encode()):08x}"
+
+    @property
+    def chunks(self):
+        return -(-self.size // self.chunk_size)
+
+    def chunk_points(self, chunk):
+        first = chunk * self.chunk_size
+        return range(first, min(first + self.chunk_size, self.size))
+
+    def point(self, i):
+        """{parameter: value} at point i, unvaried parameters at their defaults."""
+        params = dict(self.base)
+        if self.samples is None:
+            for name, values in reversed(self.vary.items()):
+                i, pick = divmod(i, len(values))
+                params[name] = values[pick]
+        else:
+            rng = unicorn.Stream(self.seed, i)
+            for name, values in self.vary.items():
+                params[name] = rng.choice(values)
+        return params
+
+    def columns(self):
+        out = ["sweep", "chunk", "point", "pony"] + list(self.base)
+        for enemy, _ in self.fights:
+            out += [f"{enemy}.victory", f"{enemy}.dead", f"{enemy}.turns"]
+        return out + ["survived", "hp_left", "timeout"]
+
+def evaluate(sweep, chunk):
+    """The result rows of one chunk: one per (point, pony).
+
+    All runs of all points and ponies in the chunk are lanes of the same
+    arrays, so each fight is a single batchfight.resolve() call.
+    """
+    rng = np.random.default_rng([sweep.seed, chunk])
+    points = [(i, sweep.point(i)) for i in sweep.chunk_points(chunk)]
+    lanes = [(i, params, pony) for i, params in points for pony in simulate.PONIES]
+    runs = sweep.runs
+
+    def column(value):
+        return np.repeat(np.array([value(params, pony) for _, params, pony in lanes],
+                                  dtype=np.int64), runs)
+
+    magic, strength, agility = (column(lambda params, pony, stat=stat: params[f"{pony}.{stat}"])
+                                for stat in PONY_STATS)
+    hp = column(lambda params, pony: unicorn.Player(
+        "", pony, params[f"{pony}.magic"], params[f"{pony}.strength"],
+        params[f"{pony}.agility"]).max_health)
+    timeout = np.zeros(len(hp), dtype=bool)
+    results = []
+    for enemy, weapon in sweep.fights:
+        entered = (hp > 0).reshape(-1, runs)
+        res = batchfight.resolve(
+            hp, strength, agility, magic, weapon,
+            *(column(lambda params, pony, stat=stat: params[f"{enemy}.{stat}"])
+              for stat in ENEMY_STATS),
+            action=ACTIONS[sweep.action], flee_below=sweep.flee_below, rng=rng)
+        hp = res.player_hp
+        outcome = res.outcome.reshape(-1, runs)
+        timeout |= res.outcome == batchfight.TIMEOUT
+        fought = np.maximum(entered.sum(axis=1), 1)
+        results.append(((outcome == batchfight.VICTORY).mean(axis=1),
+                         ((outcome == batchfight.DEAD) & entered).mean(axis=1),
+                         res.turns.reshape(-1, runs).sum(axis=1) / fought))
+    alive = (hp > 0).reshape(-1, runs)
+    survivors = alive.sum(axis=1)
+    hp_left = np.where(alive, hp.reshape(-1, runs), 0).sum(axis=1) / np.maximum(survivors, 1)
+    timeouts = timeout.reshape(-1, runs).mean(axis=1)
+
+    rows = []
+    for lane, (i, params, pony) in enumerate(lanes):
+        row = [sweep.key, chunk, i, pony] + list(params.values())
+        for victory, dead, turns in results:
+            row += [float(victory[lane]), float(dead[lane]), float(turns[lane])]
+        rows.append(row + [float(survivors[lane]) / runs, float(hp_left[lane]),
+                           float(timeouts[lane])])
+    return rows
+
+# ---------------------------
+# Output
+# ---------------------------
+
+class SweepError(Exception):
+    pass
+
+class CsvSink:
+    """Rows appended to one CSV file, a chunk per write.
+
+    On opening an existing file, only the rows of complete chunks are
+    kept (a killed sweep may have torn the last write); with `overwrite`
+    a file from another sweep is replaced, otherwise it is an error.
+    """
+
+    def __init__(self, path, sweep, overwrite=False):
+        self.path = path
+        self.done = set()
+        columns = sweep.columns()
+        kept = []
+        if os.path.exists(path) and not overwrite:
+            with open(path, newline="") as f:
+                reader = csv.reader(f)
+                header = next(reader, None)
+                rows = [row for row in reader if len(row) == len(columns)]
+            if header is not None and header != columns:
+                raise SweepError(f"{path} holds a different sweep (use --overwrite)")
+            if any(row[0] != sweep.key for row in rows):
+                raise SweepError(f"{path} holds a different sweep (use --overwrite)")
+            counts = {}
+            for row in rows:
+                chunk = int(row[1])
+                counts[chunk] = counts.get(chunk, 0) + 1
+            self.done = {chunk for chunk, n in counts.items()
+                         if n == len(sweep.chunk_points(chunk)) * len(simulate.PONIES)}
+            kept = [row for row in rows if int(row[1]) in self.done]
+        # rewritten only when something has to go; otherwise appended to
+        if kept and len(kept) == len(rows) and _ends_clean(path):
+            self._file = open(path, "a", newline="")
+            self._writer = csv.writer(self._file)
+        else:
+            self._file = open(path, "w", newline="")
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(columns)
+            self._writer.writerows(kept)
+            self._file.flush()
+
+    def write(self, chunk, rows):
+        self._writer.writerows(rows)
+        self._file.flush()
+        self.done.add(chunk)
+
+    def close(self):
+        self._file.close()
+
+def _ends_clean(path):
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() == 0:
+            return False
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+class ParquetSink:
+    """A directory of Parquet part files, one per chunk.
+
+    Each part is written under a temporary name and renamed into place,
+    so a part that exists is complete. `_sweep.json` records which sweep
+    the directory belongs to.
+    """
+
+    def __init__(self, path, sweep, overwrite=False):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SweepError("Parquet output needs pyarrow; use a .csv output instead") from None
+        self._pa, self._pq = pyarrow, pyarrow.parquet
+        self.path = path
+        self.columns = sweep.columns()
+        meta = os.path.join(path, "_sweep.json")
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(meta):
+            with open(meta) as f:
+                found = json.load(f)
+            if found["sweep"] != sweep.key:
+                if not overwrite:
+                    raise SweepError(f"{path} holds a different sweep (use --overwrite)")
+                for name in os.listdir(path):
+                    if name.startswith("part-"):
+                        os.remove(os.path.join(path, name))
+        with open(meta, "w") as f:
+            json.dump({"sweep": sweep.key, "columns": self.columns}, f)
+        self.done = {int(name[5:-8]) for name in os.listdir(path)
+                     if name.startswith("part-") and name.endswith(".parquet")}
+
+    def write(self, chunk, rows):
+        table = self._pa.table({name: list(values)
+                                for name, values in zip(self.columns, zip(*rows))})
+        part = os.path.join(self.path, f"part-{chunk:06d}.parquet")
+        self._pq.write_table(table, part + ".tmp")
+        os.replace(part + ".tmp", part)
+        self.done.add(chunk)
+
+    def close(self):
+        pass
+
+def open_sink(path, sweep, overwrite=False):
+    """A CsvSink, or a ParquetSink for a path ending in .parquet."""
+    if path.endswith(".parquet"):
+        return ParquetSink(path, sweep, overwrite)
+    return CsvSink(path, sweep, overwrite)
+
+def run_sweep(sweep, sink, workers=None, progress=None):
+    """Evaluate every chunk the sink does not have yet and write each one as
+    it finishes. Returns the number of chunks written."""
+    todo = [chunk for chunk in range(sweep.chunks) if chunk not in sink.done]
+    workers = workers or os.cpu_count() or 1
+    written = 0
+    if workers == 1:
+        for chunk in todo:
+            sink.write(chunk, evaluate(sweep, chunk))
+            written += 1
+            if progress:
+                progress(written, len(todo))
+        return written
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        queue = iter(todo)
+        pending = {}
+        while True:
+            # a few chunks in flight per worker, not the whole sweep at once
+            for chunk in itertools.islice(queue, 2 * workers - len(pending)):
+                pending[pool.submit(evaluate, sweep, chunk)] = chunk
+            if not pending:
+                break
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                sink.write(pending.pop(future), future.result())
+                written += 1
+                if progress:
+                    progress(written, len(todo))
+    return written
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Balance sweep over pony and enemy stats.")
+    parser.add_argument("--vary", action="append", default=[], metavar="NAME=VALUES",
+                        help="parameter to sweep, e.g. earth.strength=7:11 or "
+                             "bulldog.health=18,22,26 (repeatable)")
+    parser.add_argument("--random", type=int, default=None, metavar="N",
+                        help="random search of N points instead of the full grid")
+    parser.add_argument("--runs", type=int, default=2000, help="runs per pony per point")
+    parser.add_argument("--action", choices=sorted(ACTIONS), default="fight")
+    parser.add_argument("--flee-below", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=1,
+                        help="the same seed and arguments give the same results")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--out", default="sweep.csv", help="a .csv file or a .parquet directory")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="replace an output that holds a different sweep")
+    parser.add_argument("--list", action="store_true", help="list the parameters and exit")
+    args = parser.parse_args(argv)
+    if args.list:
+        for name, value in defaults().items():
+            print(f"{name:<20} {value}")
+        return 0
+    try:
+        vary = {}
+        for item in args.vary:
+            name, sep, values = item.partition("=")
+            if not sep:
+                raise ValueError(f"--vary {item!r}: expected NAME=VALUES")
+            vary[name.strip()] = parse_values(values)
+        sweep = Sweep(vary, runs=args.runs, samples=args.random, seed=args.seed,
+                      action=args.action, flee_below=args.flee_below,
+                      chunk_size=args.chunk_size)
+        sink = open_sink(args.out, sweep, args.overwrite)
+    except (ValueError, SweepError) as exc:
+        parser.error(str(exc))
+    skipped = len(sink.done)
+    began = time.perf_counter()
+
+    def progress(done, total):
+        print(f"\r{done}/{total} chunks", end="", file=sys.stderr, flush=True)
+
+    try:
+        written = run_sweep(sweep, sink, args.workers, progress)
+    finally:
+        sink.close()
+    print(file=sys.stderr)
+    print(f"{len(sweep)} points x {len(simulate.PONIES)} ponies x {sweep.runs} runs: "
+          f"{written} chunks in {time.perf_counter() - began:.1f}s, "
+          f"{skipped} already done -> {args.out}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,10 +4,15 @@ Magic Pony Sparkle Land — Text Adventure Game
 Author: ChatGPT (custom script)
 """
 
+import functools
+import json
+import os
 import random
+import struct
 import sys
 import textwrap
 import time
+import zlib
 
 # ---------------------------
 # ASCII ART (unicorns & title)
@@ -61,23 +66,263 @@ PEGASUS_ART = r"""
   `-' `-'
 """
 
+# ---------------------------
+# Console (where text goes, where answers come from)
+# ---------------------------
+
+class GameOver(Exception):
+    """Raised by game_over() so callers can decide whether to exit."""
+    def __init__(self, ending):
+        super().__init__(ending)
+        self.ending = ending
+
+class Ask:
+    """What a scene yields when it needs a line of input.
+
+    Every prompt in the game is tagged with a site name (e.g. "fight",
+    "port", "gates.item") so consoles can answer without a terminal.
+    """
+    __slots__ = ("site", "text", "player", "enemy")
+
+    def __init__(self, site, text="> ", player=None, enemy=None):
+        self.site = site
+        self.text = text
+        self.player = player
+        self.enemy = enemy
+
+class Console:
+    """Terminal console: writes text, sleeps for pacing and reads stdin.
+
+    Text is buffered and written to `out` (stdout by default) in one go
+    whenever the game waits, for an answer or a dramatic pause, so a turn
+    costs one write instead of a print per line. `pacing=False` skips the
+    pauses. `rng` is where the game's dice come from while this console is
+    active; the terminal uses the shared random module. `rejected` is set
+    by reject() when an answer was not understood.
+    """
+    rng = random
+    rejected = False
+
+    def __init__(self, out=None, pacing=True):
+        self.out = out
+        self.pacing = pacing
+        self._pending = []
+
+    def write(self, text):
+        self._pending.append(text)
+
+    def flush(self):
+        out = self.out or sys.stdout
+        if self._pending:
+            self._pending.append("")
+            out.write("\n".join(self._pending))
+            self._pending.clear()
+        out.flush()
+
+    def read(self, site, text="> ", player=None, enemy=None):
+        self.flush()
+        return input(text)
+
+    def pause(self, seconds):
+        self.flush()
+        if self.pacing:
+            time.sleep(seconds)
+
+_console = Console()
+
+def use_console(console):
+    """Install a console for the game and return the previous one."""
+    global _console
+    previous, _console = _console, console
+    return previous
+
+def say(*parts):
+    if len(parts) == 1 and parts[0].__class__ is str:
+        _console.write(parts[0])
+    else:
+        _console.write(" ".join(map(str, parts)))
+
+def reject(*parts):
+    """Say why an answer was not understood (like say()) and mark it
+    rejected, so commands queued behind it are dropped (see pipeline())."""
+    if parts:
+        say(*parts)
+    _console.rejected = True
+
+def ask(site, player=None, enemy=None, text="> "):
+    """Build the Ask a scene yields; the answer comes back from yield."""
+    return Ask(site, text, player, enemy)
+
+def pause(seconds):
+    _console.pause(seconds)
+
+def current_rng():
+    """The random source of the game currently being played."""
+    return _console.rng
+
+def run(game, session=None):
+    """Drive a scene generator to completion with the installed console,
+    answering each Ask it yields; returns whatever the generator returns.
+    A line may hold several commands separated by ";", answering the next
+    prompts in turn (see pipeline()). With a session (the one `game`
+    plays) the player can also ask for hints."""
+    answer = None
+    queue = []
+    while True:
+        _console.rejected = False
+        try:
+            request = game.send(answer)
+        except StopIteration as stop:
+            if queue:
+                say(_dropped(len(queue)))
+            return stop.value
+        if queue and _console.rejected:
+            say(_dropped(len(queue)))
+            queue.clear()
+        while True:
+            if queue:
+                answer = queue.pop(0)
+            else:
+                answer, *queue = split_commands(
+                    _console.read(request.site, request.text, request.player, request.enemy))
+            if not (session is not None and _hints is not None
+                    and answer.strip().lower() == HINT_COMMAND):
+                break
+            say(_hints.hint(session, request))
+
+# ---------------------------
+# Instrumentation
+# ---------------------------
+# An optional metrics sink (see metrics.py) installed with use_metrics().
+# The game calls it at a handful of points:
+#
+#   scene(name, seconds)             a story "scene" block finished
+#   command(site, command, seconds)  one prompt answered through step()
+#   fight_turn(enemy, action)        one choice made in a fight
+#   ending(name)                     the game ended
+#
+# With no sink installed every hook is a single global lookup.
+
+_metrics = None
+
+def use_metrics(metrics):
+    """Install a metrics sink (None to disable) and return the previous one."""
+    global _metrics
+    previous, _metrics = _metrics, metrics
+    return previous
+
+def _timed_scene(metrics, name, game):
+    # wall time from entering the scene to leaving it, player waits included;
+    # an abandoned session never finishes its scene and is not recorded
+    began = time.perf_counter()
+    result = yield from game
+    metrics.scene(name, time.perf_counter() - began)
+    return result
+
+# ---------------------------
+# Journal
+# ---------------------------
+# An optional journal (see journal.py) installed with use_journal(). The
+# game tells it about every change to a player's state, whoever the
+# player is; the journal keeps the changes of the sessions it follows:
+#
+#   item_added(inventory, number, item)  an item was listed under `number`
+#   item_removed(inventory, number)      the item under `number` was removed
+#   charge_used(item)                    a crystal spent a charge
+#   changed(player, field)               a stat or flag was set (health in a
+#                                        fight, has_amulet, shielded, ...)
+#   node(session)                        a session entered a story node
+#
+# With no journal installed every hook is a single global lookup.
+
+_journal = None
+
+def use_journal(journal):
+    """Install a journal (None to disable) and return the previous one."""
+    global _journal
+    previous, _journal = _journal, journal
+    return previous
+
+# ---------------------------
+# Hints
+# ---------------------------
+# An optional hint provider (see policysolver.py) installed with
+# use_hints(). While one is installed, answering any prompt with "hint"
+# calls hint(session, request) and shows the text it returns instead of
+# answering; the same prompt is then asked again.
+
+HINT_COMMAND = "hint"
+
+_hints = None
+
+def use_hints(hints):
+    """Install a hint provider (None to disable) and return the previous one."""
+    global _hints
+    previous, _hints = _hints, hints
+    return previous
+
+# ---------------------------
+# Random streams
+# ---------------------------
+
+_MASK64 = (1 << 64) - 1
+_GOLDEN = 0x9E3779B97F4A7C15
+
+def _mix64(z):
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return z ^ (z >> 31)
+
+class Stream:
+    """Counter-based random stream (SplitMix64 over a key and a counter).
+
+    The n-th draw depends only on (seed, stream, n), so every session or
+    simulated run gets an independent stream from a master seed and its
+    own id, nothing is shared between them, and the whole generator state
+    is the counter. Provides the parts of the random module the game uses.
+    """
+    __slots__ = ("seed", "stream", "counter", "_key")
+
+    def __init__(self, seed=None, stream=0, counter=0):
+        if seed is None:
+            seed = random.getrandbits(64)
+        self.seed = seed & _MASK64
+        self.stream = stream & _MASK64
+        self.counter = counter
+        self._key = _mix64((_mix64(self.seed + _GOLDEN) + self.stream * _GOLDEN) & _MASK64)
+
+    def random(self):
+        self.counter += 1
+        return (_mix64((self._key + self.counter * _GOLDEN) & _MASK64) >> 11) * (1.0 / (1 << 53))
+
+    def randint(self, a, b):
+        return a + int(self.random() * (b - a + 1))
+
+    def choice(self, seq):
+        return seq[int(self.random() * len(seq))]
+
 # ---------------------------
 # Utilities
 # ---------------------------
 
 def slow_print(text, delay=0.01):
     for line in text.splitlines():
-        print(line)
-        time.sleep(0.01)
+        say(line)
+        pause(delay)
 
-def wrapped(text):
-    return textwrap.fill(text, width=75)
+WRAP_WIDTH = 75
+
+@functools.lru_cache(maxsize=1024)
+def wrapped(text, width=WRAP_WIDTH):
+    """textwrap.fill, memoized: the narrative is constant, so each paragraph
+    is wrapped once per width and served from the cache after that."""
+    return textwrap.fill(text, width=width)
 
 def prompt(options):
     """Prompt for input until a valid option selected from list of strings (case-insensitive)."""
     options_lower = [o.lower() for o in options]
     while True:
-        choice = input("> ").strip().lower()
+        choice = (yield ask("prompt")).strip().lower()
         if choice in options_lower:
             return choice
         # allow numeric selection if options are numbers
@@ -85,43 +330,272 @@ def prompt(options):
             idx = int(choice) - 1
             if 0 <= idx < len(options):
                 return options_lower[idx]
-        print("Please enter one of:", ", ".join(options))
+        reject("Please enter one of:", ", ".join(options))
+
+# ---------------------------
+# Combat tuning
+# ---------------------------
+# fight() and the batch/exact combat resolvers all read these, so a
+# balance change here reaches every one of them.
+
+PLAYER_BASE_DAMAGE = 2   # + strength + weapon damage
+MAGIC_BASE_DAMAGE = 1    # + magic, plus randint(0, magic) on a blast
+ENEMY_BASE_DAMAGE = 1    # + strength
+PLAYER_HIT = (0.6, 0.2, 0.95)  # base chance, floor, ceiling
+ENEMY_HIT = (0.5, 0.2, 0.9)
+HIT_PER_AGILITY = 0.03
+FLEE_BASE = 0.25
+FLEE_PER_AGILITY = 0.05
+
+def player_hit_chance(player_agility, enemy_agility):
+    base, lo, hi = PLAYER_HIT
+    return max(lo, min(hi, base + (player_agility - enemy_agility) * HIT_PER_AGILITY))
+
+def enemy_hit_chance(enemy_agility, player_agility):
+    base, lo, hi = ENEMY_HIT
+    return max(lo, min(hi, base + (enemy_agility - player_agility) * HIT_PER_AGILITY))
+
+def flee_chance(player_agility, enemy_agility):
+    return FLEE_BASE + (player_agility - enemy_agility) * FLEE_PER_AGILITY
+
+# ---------------------------
+# Crystal powers
+# ---------------------------
+# A crystal's power text is normalized once, when its ItemKind is built, to
+# one of these codes; scenes then dispatch on the code (see CRYSTAL_EFFECTS).
+
+NO_EFFECT, TELEKINESIS, HEALING, SHIELD, FIRE, PROJECTILE, CHARISMA = range(7)
+
+CRYSTAL_POWERS = {
+    "telekinesis": TELEKINESIS, "lapis": TELEKINESIS,
+    "healing": HEALING, "jade": HEALING,
+    "protection shield": SHIELD, "obsidian": SHIELD,
+    "fire powers": FIRE, "citrine": FIRE, "citrine - fire powers": FIRE,
+    "projectile powers": PROJECTILE, "clear quartz": PROJECTILE,
+    "clear quartz - projectile powers": PROJECTILE, "clear quarts": PROJECTILE,
+    "charisma": CHARISMA, "rose quartz": CHARISMA,
+}
+
+def crystal_effect(power):
+    """Effect code for a crystal power name or alias (NO_EFFECT if unknown)."""
+    return CRYSTAL_POWERS.get(power.strip().lower(), NO_EFFECT) if power else NO_EFFECT
+
+# How strong one use is in a fight: damage dealt, HP healed, or enemy
+# agility removed. Shared by the scenes and the combat solvers.
+CRYSTAL_AMOUNTS = {
+    TELEKINESIS: lambda player: player.magic_power() + 3,
+    HEALING: lambda player: 8 + player.magic,
+    FIRE: lambda player: 6 + player.magic,
+    PROJECTILE: lambda player: 4 + player.magic,
+    CHARISMA: lambda player: 3,
+}
 
 # ---------------------------
 # Game data structures
 # ---------------------------
 
+class ItemKind:
+    """Shared, immutable description of an item (a flyweight).
+
+    Every copy of the same item in every inventory points at one ItemKind;
+    only per-copy state such as a crystal's charges lives on the Item.
+    """
+    __slots__ = ("id", "name", "description", "type", "base_damage",
+                 "weapon_type", "power", "charges", "effect")
+
+    def __init__(self, name, description="No description.", type_="misc",
+                 base_damage=0, weapon_type=None, power=None, charges=0, id_=None):
+        for attr, value in (("id", id_), ("name", name), ("description", description),
+                            ("type", type_), ("base_damage", base_damage),
+                            ("weapon_type", weapon_type), ("power", power), ("charges", charges),
+                            ("effect", crystal_effect(power))):
+            object.__setattr__(self, attr, value)
+
+    def __setattr__(self, attr, value):
+        raise AttributeError("ItemKind is immutable")
+
+    def make(self):
+        """A fresh item of this kind, with full charges for a crystal."""
+        cls = _ITEM_CLASSES.get(self.type, Item)
+        item = object.__new__(cls)
+        item.kind = self
+        if cls is Crystal:
+            item.charges = self.charges
+        return item
+
 class Item:
+    __slots__ = ("kind",)
+
     def __init__(self, name, description="No description.", type_="misc"):
-        self.name = name
-        self.description = description
-        self.type = type_
+        self.kind = ItemKind(name, description, type_)
+
+    name = property(lambda self: self.kind.name)
+    description = property(lambda self: self.kind.description)
+    type = property(lambda self: self.kind.type)
 
     def __str__(self):
         return f"{self.name} ({self.type}) - {self.description}"
 
 class Weapon(Item):
+    __slots__ = ()
+
     def __init__(self, name, base_damage, description="", weapon_type="melee"):
-        super().__init__(name, description, type_="weapon")
-        self.base_damage = base_damage
-        self.weapon_type = weapon_type
+        self.kind = ItemKind(name, description, "weapon", base_damage=base_damage,
+                             weapon_type=weapon_type)
+
+    base_damage = property(lambda self: self.kind.base_damage)
+    weapon_type = property(lambda self: self.kind.weapon_type)
 
 class Crystal(Item):
+    __slots__ = ("charges",)
+
     def __init__(self, name, power, charges, description=""):
-        super().__init__(name, description, type_="crystal")
-        self.power = power
+        self.kind = ItemKind(name, description, "crystal", power=power, charges=charges)
         self.charges = charges
 
+    power = property(lambda self: self.kind.power)
+    effect = property(lambda self: self.kind.effect)
+
     def use(self):
         if self.charges <= 0:
             return False
         self.charges -= 1
+        if _journal is not None:
+            _journal.charge_used(self)
         return True
 
     def __str__(self):
         return f"{self.name} (Crystal, {self.power}, charges: {self.charges}) - {self.description}"
 
+_ITEM_CLASSES = {"weapon": Weapon, "crystal": Crystal}
+
+# Every item the story hands out. An item's catalog ID is its position in
+# this tuple (save games store it), so only ever append.
+CATALOG = tuple(ItemKind(id_=i, **spec) for i, spec in enumerate((
+    dict(name="Bread", description="A small piece of bread to keep you going."),
+    dict(name="Rusty Knife", description="A dull but still useful knife.", type_="weapon",
+         base_damage=2, weapon_type="melee"),
+    dict(name="Wooden Staff", description="Simple staff. Good for channeling magic.", type_="weapon",
+         base_damage=3, weapon_type="melee"),
+    dict(name="Lapis", description="Grainy blue crystal. Lifts things with thought.", type_="crystal",
+         power="Telekinesis", charges=2),
+    dict(name="Short Sword", description="A short, balanced sword.", type_="weapon",
+         base_damage=4, weapon_type="melee"),
+    dict(name="Citrine", description="Warm, golden crystal of flame.", type_="crystal",
+         power="Fire Powers", charges=2),
+    dict(name="Jade", description="Green healing crystal.", type_="crystal",
+         power="Healing", charges=1),
+    dict(name="Rose Quartz", description="Soft pink crystal that warms hearts.", type_="crystal",
+         power="Charisma", charges=1),
+    dict(name="Amethyst Amulet", description="Star-shaped amulet — your family's heirloom.",
+         type_="amulet"),
+)))
+ITEMS = {kind.name: kind for kind in CATALOG}
+
+def new_item(name):
+    """A fresh copy of a catalog item, e.g. new_item("Jade")."""
+    return ITEMS[name].make()
+
+class Inventory:
+    """A player's items under stable numbers, indexed for O(1) lookups.
+
+    The number an item is listed under never shifts when something else is
+    removed. Items are bucketed by type, and crystals with charges left are
+    stacked per effect code, so finding, spending and removing never scan
+    the whole inventory. The indexes are built on the first lookup (most
+    parked sessions never search) and kept up to date from then on; crystals
+    spent or removed behind their back are dropped lazily when looked up.
+    """
+    __slots__ = ("_items", "_buckets", "_charged", "_next")
+
+    def __init__(self, items=()):
+        self._items = {}       # number -> item, in the order added
+        self._buckets = None   # item type -> {number: item}
+        self._charged = None   # crystal effect -> [number, ...], newest last
+        self._next = 1
+        for item in items:
+            self.add(item)
+
+    def _index(self, number, item):
+        bucket = self._buckets.get(item.type)
+        if bucket is None:
+            bucket = self._buckets[item.type] = {}
+        bucket[number] = item
+        if isinstance(item, Crystal) and item.charges > 0:
+            self._charged.setdefault(item.effect, []).append(number)
+
+    def _build(self):
+        self._buckets, self._charged = {}, {}
+        for number, item in self._items.items():
+            self._index(number, item)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items.values())
+
+    def numbered(self):
+        """(number, item) pairs in the order the items were added."""
+        return self._items.items()
+
+    def add(self, item, number=None):
+        """Add an item and return the number it is listed under (`number`,
+        when restoring a saved inventory)."""
+        if number is None:
+            number = self._next
+        self._next = max(self._next, number + 1)
+        self._items[number] = item
+        if self._buckets is not None:
+            self._index(number, item)
+        if _journal is not None:
+            _journal.item_added(self, number, item)
+        return number
+
+    def get(self, number):
+        return self._items.get(number)
+
+    def pop(self, number):
+        """Remove and return the item listed under `number` (None if none)."""
+        item = self._items.pop(number, None)
+        if item is not None and self._buckets is not None:
+            bucket = self._buckets[item.type]
+            del bucket[number]
+            if not bucket:
+                del self._buckets[item.type]
+        if item is not None and _journal is not None:
+            _journal.item_removed(self, number)
+        return item
+
+    def of_type(self, type_):
+        """{number: item} for one item type, e.g. "weapon"."""
+        if self._buckets is None:
+            self._build()
+        return self._buckets.get(type_, {})
+
+    def charged(self, effect):
+        """Number of the newest crystal with charges left for an effect code."""
+        if self._charged is None:
+            self._build()
+        stack = self._charged.get(effect)
+        while stack:
+            number = stack[-1]
+            item = self._items.get(number)
+            if item is not None and item.charges > 0:
+                return number
+            stack.pop()
+        return None
+
+    def use_charge(self, number):
+        """Spend one charge of the crystal listed under `number`."""
+        item = self._items.get(number)
+        return isinstance(item, Crystal) and item.use()
+
 class Player:
+    __slots__ = ("name", "pony_type", "max_health", "health", "magic", "strength",
+                 "agility", "inventory", "weapon", "has_amulet", "charisma_bonus",
+                 "shielded", "location")
+
     def __init__(self, name, pony_type, magic, strength, agility):
         self.name = name
         self.pony_type = pony_type
@@ -130,54 +604,56 @@ class Player:
         self.magic = magic
         self.strength = strength
         self.agility = agility
-        self.inventory = []
+        self.inventory = Inventory()
         self.weapon = None
         self.has_amulet = False
         self.charisma_bonus = 0  # can be raised by rose quartz
+        self.shielded = False    # set by obsidian
         self.location = "Dungeon Cell"
 
     def attack_damage(self):
-        base = 2 + self.strength
+        base = PLAYER_BASE_DAMAGE + self.strength
         if self.weapon:
             base += self.weapon.base_damage
         return base
 
     def magic_power(self):
-        return 1 + self.magic
+        return MAGIC_BASE_DAMAGE + self.magic
 
     def show_inventory(self):
         if not self.inventory:
-            print("Inventory is empty.")
+            say("Inventory is empty.")
             return
-        for i, item in enumerate(self.inventory, 1):
+        for i, item in self.inventory.numbered():
             if isinstance(item, Weapon):
                 extra = f" [Weapon dmg {item.base_damage}]"
             elif isinstance(item, Crystal):
                 extra = f" [Crystal:{item.power} charges:{item.charges}]"
             else:
                 extra = ""
-            print(f"{i}. {item.name} - {item.description}{extra}")
+            say(f"{i}. {item.name} - {item.description}{extra}")
 
     def add_item(self, item):
-        self.inventory.append(item)
-        print(f"Added to inventory: {item.name}")
+        self.inventory.add(item)
+        say(f"Added to inventory: {item.name}")
 
-    def find_crystal(self, power_name):
-        for it in self.inventory:
-            if isinstance(it, Crystal) and it.power.lower() == power_name.lower() and it.charges>0:
-                return it
-        return None
+    def find_crystal(self, power):
+        """First crystal with charges left for an effect code or power name."""
+        effect = crystal_effect(power) if isinstance(power, str) else power
+        number = self.inventory.charged(effect)
+        return None if number is None else self.inventory.get(number)
 
     def remove_item_by_index(self, idx):
-        if 0 <= idx < len(self.inventory):
-            return self.inventory.pop(idx)
-        return None
+        """Remove the item show_inventory() lists as number idx + 1."""
+        return self.inventory.pop(idx + 1)
 
 # ---------------------------
 # Enemies & NPCs
 # ---------------------------
 
 class Enemy:
+    __slots__ = ("name", "health", "strength", "agility", "magic", "description")
+
     def __init__(self, name, health, strength, agility, magic, description=""):
         self.name = name
         self.health = health
@@ -187,630 +663,1047 @@ class Enemy:
         self.description = description
 
     def attack_damage(self):
-        return 1 + self.strength
+        return ENEMY_BASE_DAMAGE + self.strength
 
 # ---------------------------
 # Game Mechanics
 # ---------------------------
 
 def roll(chance):
-    return random.random() < chance
+    return _console.rng.random() < chance
 
 def fight(player, enemy):
-    print(f"\nA battle begins: {player.name} vs {enemy.name}!")
-    print(enemy.description)
+    say(f"\nA battle begins: {player.name} vs {enemy.name}!")
+    say(enemy.description)
     # loop
     while player.health > 0 and enemy.health > 0:
-        print("\nYour HP: {}/{}".format(player.health, player.max_health))
-        print(f"{enemy.name} HP: {enemy.health}")
-        print("Options: [fight] [magic] [use item] [flee] [inv]")
-        choice = input("> ").strip().lower()
+        say("\nYour HP: {}/{}".format(player.health, player.max_health))
+        say(f"{enemy.name} HP: {enemy.health}")
+        say("Options: [fight] [magic] [use item] [flee] [inv]")
+        choice = (yield ask("fight", player, enemy)).strip().lower()
+        if _metrics is not None:
+            _metrics.fight_turn(enemy.name, choice)
         if choice == "inv" or choice == "inventory":
             player.show_inventory()
             continue
         if choice == "use item":
-            use_item_in_fight(player, enemy)
+            yield from use_item_in_fight(player, enemy)
             if enemy.health <= 0:
                 break
         elif choice == "fight":
             # player's attack
-            hit_chance = 0.6 + (player.agility - enemy.agility) * 0.03
-            hit_chance = max(0.2, min(0.95, hit_chance))
-            if roll(hit_chance):
+            if roll(player_hit_chance(player.agility, enemy.agility)):
                 dmg = player.attack_damage()
                 enemy.health -= dmg
-                print(f"You strike {enemy.name} for {dmg} damage!")
+                say(f"You strike {enemy.name} for {dmg} damage!")
             else:
-                print("You miss!")
+                say("You miss!")
         elif choice == "magic":
             # use innate magic or crystals
             if player.magic <= 0:
-                print("You have no magic power.")
+                say("You have no magic power.")
             else:
                 # Simple magic blast damage scaled by magic stat
-                dmg = player.magic_power() + random.randint(0, player.magic)
+                dmg = player.magic_power() + _console.rng.randint(0, player.magic)
                 enemy.health -= dmg
-                print(f"You unleash magical power for {dmg} damage!")
+                say(f"You unleash magical power for {dmg} damage!")
         elif choice == "flee":
-            flee_chance = 0.25 + (player.agility - enemy.agility) * 0.05
-            if roll(flee_chance):
-                print("You flee successfully!")
+            if roll(flee_chance(player.agility, enemy.agility)):
+                say("You flee successfully!")
                 return "fled"
             else:
-                print("You fail to escape!")
+                say("You fail to escape!")
         else:
-            print("Unknown choice — pick fight, magic, use item, flee, or inv.")
+            reject("Unknown choice — pick fight, magic, use item, flee, or inv.")
             continue
 
         # Enemy turn if still alive
         if enemy.health > 0:
-            hit_chance = 0.5 + (enemy.agility - player.agility) * 0.03
-            hit_chance = max(0.2, min(0.9, hit_chance))
-            if roll(hit_chance):
+            if roll(enemy_hit_chance(enemy.agility, player.agility)):
                 dmg = enemy.attack_damage()
                 player.health -= dmg
-                print(f"{enemy.name} hits you for {dmg} damage!")
+                if _journal is not None:
+                    _journal.changed(player, "health")
+                say(f"{enemy.name} hits you for {dmg} damage!")
             else:
-                print(f"{enemy.name} misses!")
+                say(f"{enemy.name} misses!")
     if player.health <= 0:
-        print("\nYou have been defeated...")
+        say("\nYou have been defeated...")
         return "dead"
     else:
-        print(f"\nYou defeated {enemy.name}!")
+        say(f"\nYou defeated {enemy.name}!")
         return "victory"
 
 def use_item_in_fight(player, enemy):
-    print("Choose item to use (number), or 'back':")
+    say("Choose item to use (number), or 'back':")
     player.show_inventory()
-    choice = input("> ").strip().lower()
+    choice = (yield ask("fight.item", player, enemy)).strip().lower()
     if choice == "back":
         return
     if not choice.isdigit():
-        print("That's not a number.")
+        reject("That's not a number.")
         return
-    idx = int(choice) - 1
-    if idx < 0 or idx >= len(player.inventory):
-        print("Invalid selection.")
+    idx = int(choice)
+    item = player.inventory.get(idx)
+    if item is None:
+        reject("Invalid selection.")
         return
-    item = player.inventory[idx]
     if isinstance(item, Crystal):
         # apply crystal effects
         if item.charges <= 0:
-            print(f"{item.name} has no charges left.")
+            reject(f"{item.name} has no charges left.")
             return
         item.use()
-        if item.power.lower() == "telekinesis" or item.power.lower()=="lapis":
-            dmg = player.magic_power() + 3
-            enemy.health -= dmg
-            print(f"You use {item.name} (Telekinesis) to slam the enemy for {dmg} damage!")
-        elif item.power.lower() in ("healing", "jade"):
-            heal = 8 + player.magic
-            player.health = min(player.max_health, player.health + heal)
-            print(f"Jade heals you for {heal} HP!")
-        elif item.power.lower() in ("protection shield","obsidian"):
-            # blocks next hit completely: implement as a temporary buff using a flag
-            player.shielded = True
-            print("A shimmering shield surrounds you, ready to block one attack.")
-        elif item.power.lower() in ("fire powers","citrine","citrine - fire powers","citrine"):
-            dmg = 6 + player.magic
-            enemy.health -= dmg
-            print(f"Flames burst from the crystal, dealing {dmg} fire damage!")
-        elif item.power.lower() in ("projectile powers","clear quartz", "clear quartz - projectile powers", "clear quarts"):
-            dmg = 4 + player.magic
-            enemy.health -= dmg
-            print(f"Projectiles from the crystal hit for {dmg} damage!")
-        elif item.power.lower() in ("charisma","rose quartz"):
-            # increases chance to avoid fighting, maybe charm enemy to skip next turn
-            enemy_agility_backup = enemy.agility
-            enemy.agility = max(0, enemy.agility - 3)
-            print("Rose quartz glows — the enemy's aggression lowers.")
+        effect = FIGHT_EFFECTS.get(item.effect)
+        if effect:
+            effect(player, enemy, item)
         else:
-            print("You used the crystal, but nothing obvious happened.")
+            say("You used the crystal, but nothing obvious happened.")
         # remove crystals with zero charges optionally
         if item.charges <= 0:
-            print(f"{item.name} shatters after use.")
+            say(f"{item.name} shatters after use.")
             player.inventory.pop(idx)
     elif isinstance(item, Weapon):
-        print("You equip the weapon for this fight.")
+        say("You equip the weapon for this fight.")
         player.weapon = item
     else:
-        print(f"You use {item.name} but nothing major happens.")
-
-# ---------------------------
-# Scene handlers
-# ---------------------------
-
-def dungeon_intro(player):
-    print(UNICORN_ART)
-    print(wrapped(
-        "While grazing for berries late at night in the peaceful village of Rainbowtopia, "
-        "you are suddenly seized and find yourself trapped in a dungeon deep inside a crystal cavern."
-    ))
-    time.sleep(1.0)
-    print(wrapped(
-        "You notice your amethyst, star-shaped amulet—given by your great-grandmother—is missing. "
-        "A terrifying bulldog-cerberus creature snarls: the amulet contains royal magic that harnesses crystal power. "
-        "With it he will take over the Crystal Kingdom. Escape and retrieve your amulet!"
-    ))
-    time.sleep(0.8)
-    print("\nYou search your cell...")
-    # give starting item
-    kit = Item("Bread", "A small piece of bread to keep you going.")
-    player.add_item(kit)
-    # find a rusty knife
-    knife = Weapon("Rusty Knife", base_damage=2, description="A dull but still useful knife.", weapon_type="melee")
-    player.add_item(knife)
-
-def find_in_corridor(player):
-    print("\nYou slip into the corridor and find a small wooden staff leaning against the wall.")
-    staff = Weapon("Wooden Staff", base_damage=3, description="Simple staff. Good for channeling magic.")
-    player.add_item(staff)
-    # maybe also find a crystal
-    lapis = Crystal("Lapis", power="Telekinesis", charges=2, description="Grainy blue crystal. Lifts things with thought.")
-    player.add_item(lapis)
-
-def dragon_mountains(player):
-    print("\n--- Dragon Mountains ---")
-    print(wrapped("The path climbs into ash-scented air. Baby dragons glare with ember eyes."))
-    # group of baby dragons
-    dragons = Enemy("Baby Dragon Pack", health=18, strength=4, agility=3, magic=2,
-                    description="A group of small dragons, quick but not very clever.")
-    result = fight(player, dragons)
-    if result == "dead":
-        return "dead"
-    # loot
-    sword = Weapon("Short Sword", base_damage=4, description="A short, balanced sword.")
-    player.add_item(sword)
-    citrine = Crystal("Citrine", power="Fire Powers", charges=2, description="Warm, golden crystal of flame.")
-    player.add_item(citrine)
+        say(f"You use {item.name} but nothing major happens.")
+
+# ---------------------------
+# Crystal effects
+# ---------------------------
+# One table per place a crystal can be used, keyed by effect code. Fight
+# handlers take (player, enemy, item); scene handlers take (player, item)
+# and run after a charge has been spent. Adding a crystal means adding its
+# power to CRYSTAL_POWERS and a handler to the tables where it does something.
+
+def _fight_telekinesis(player, enemy, item):
+    dmg = CRYSTAL_AMOUNTS[TELEKINESIS](player)
+    enemy.health -= dmg
+    say(f"You use {item.name} (Telekinesis) to slam the enemy for {dmg} damage!")
+
+def _fight_heal(player, enemy, item):
+    heal = CRYSTAL_AMOUNTS[HEALING](player)
+    player.health = min(player.max_health, player.health + heal)
+    if _journal is not None:
+        _journal.changed(player, "health")
+    say(f"Jade heals you for {heal} HP!")
+
+def _fight_shield(player, enemy, item):
+    # blocks next hit completely: implement as a temporary buff using a flag
+    player.shielded = True
+    if _journal is not None:
+        _journal.changed(player, "shielded")
+    say("A shimmering shield surrounds you, ready to block one attack.")
+
+def _fight_fire(player, enemy, item):
+    dmg = CRYSTAL_AMOUNTS[FIRE](player)
+    enemy.health -= dmg
+    say(f"Flames burst from the crystal, dealing {dmg} fire damage!")
+
+def _fight_projectile(player, enemy, item):
+    dmg = CRYSTAL_AMOUNTS[PROJECTILE](player)
+    enemy.health -= dmg
+    say(f"Projectiles from the crystal hit for {dmg} damage!")
+
+def _fight_charm(player, enemy, item):
+    # increases chance to avoid fighting, maybe charm enemy to skip next turn
+    enemy.agility = max(0, enemy.agility - CRYSTAL_AMOUNTS[CHARISMA](player))
+    say("Rose quartz glows — the enemy's aggression lowers.")
+
+def _forest_charm(player, item):
+    say("Rose quartz glows warmly and the spirit calms, retreating into the trees.")
     return "ok"
 
-def haunted_forest(player):
-    print("\n--- Haunted Forest ---")
-    print(wrapped("A malicious spirit winds through the trees, whispering doubts and fears."))
-    spirit = Enemy("Malicious Spirit", health=25, strength=3, agility=6, magic=6,
-                   description="Shifting form that feeds on fear.")
-    # You can try to talk (charisma), use rose quartz, fight, or flee
-    while True:
-        print("\nOptions: [talk] [fight] [magic] [use item] [flee] [inv]")
-        choice = input("> ").strip().lower()
-        if choice in ("inv", "inventory"):
-            player.show_inventory()
-            continue
-        if choice == "use item":
-            print("Pick an item to use on the spirit:")
-            player.show_inventory()
-            idx = input("> ").strip()
-            if not idx.isdigit():
-                print("Back.")
-                continue
-            idx = int(idx)-1
-            if idx<0 or idx>=len(player.inventory):
-                print("Invalid.")
-                continue
-            item = player.inventory[idx]
-            if isinstance(item, Crystal) and item.power.lower() in ("charisma","rose quartz"):
-                # charm the spirit
-                if item.use():
-                    print("Rose quartz glows warmly and the spirit calms, retreating into the trees.")
-                    if item.charges <= 0:
-                        print(f"{item.name} crumbles.")
-                        player.inventory.pop(idx)
-                    return "ok"
-            else:
-                print("That doesn't affect the spirit.")
-            continue
-        if choice == "talk":
-            # charisma check: base + luck from rose quartz / player charismabonus
-            charisma = player.charisma_bonus + (player.magic // 2)
-            chance = 0.3 + charisma * 0.1
-            if roll(chance):
-                print("You speak with calm and kindness; the spirit ceases its torment and fades.")
-                return "ok"
-            else:
-                print("The spirit is not convinced; it lashes out.")
-                res = fight(player, spirit)
-                return res
-        if choice == "fight":
-            res = fight(player, spirit)
-            return res
-        if choice == "magic":
-            # magic approach: attempt to dispel
-            if player.magic >= 5:
-                print("Your strong magic pushes the spirit away.")
-                return "ok"
-            else:
-                print("Your magic is insufficient; the spirit attacks.")
-                res = fight(player, spirit)
-                return res
-        if choice == "flee":
-            if roll(0.4 + player.agility * 0.02):
-                print("You escape deeper into the wood and find a safer path.")
-                return "ok"
-            else:
-                print("You cannot escape!")
-                res = fight(player, spirit)
-                return res
-        print("Unknown choice.")
-
-def port_and_coral_sea(player):
-    print("\n--- Port of Shimmering Tides ---")
-    print(wrapped("A worn dock and a merchant stands near a small boat. You need to get a boat across the Coral Sea."))
-    print("Options: [pay] [persuade] [sneak] [look inv]")
-    while True:
-        choice = input("> ").strip().lower()
-        if choice == "look inv" or choice == "inv" or choice == "inventory":
-            player.show_inventory()
-            continue
-        if choice == "pay":
-            # if player has coins? we didn't implement coins; fail gracefully
-            print("You have no coins... the merchant frowns.")
-            continue
-        if choice == "persuade":
-            # persuasion based on charisma and rose quartz
-            charisma = player.charisma_bonus + (player.magic // 2)
-            chance = 0.3 + 0.12 * charisma
-            if roll(chance):
-                print("The merchant smiles and lets you aboard for free.")
-                return "ok"
-            else:
-                print("The merchant refuses. He demands a reason.")
-                # maybe use rose quartz automatically
-                rq = player.find_crystal("Charisma") or player.find_crystal("Rose Quartz")
-                if rq:
-                    rq.use()
-                    print("Your Rose Quartz glows and the merchant becomes sympathetic; he lets you aboard.")
-                    if rq.charges<=0:
-                        print(f"{rq.name} crumbles after use.")
-                        player.inventory.remove(rq)
-                    return "ok"
-                continue
-        if choice == "sneak":
-            if roll(0.4 + player.agility*0.02):
-                print("You slip onto a small fishing boat unnoticed and cross the sea.")
-                return "ok"
+def _gates_charm(player, item):
+    say("Your Rose Quartz glows. The guard relaxes and decides not to arrest you.")
+    return "ok"
+
+def _princess_shield(player, item):
+    player.shielded = True
+    if _journal is not None:
+        _journal.changed(player, "shielded")
+    say("Obsidian forms a protective shell around the amulet, dampening its volatile power.")
+
+def _princess_charm(player, item):
+    player.charisma_bonus += 1
+    if _journal is not None:
+        _journal.changed(player, "charisma_bonus")
+    say("Rose quartz increases your persuasive aura.")
+
+def _inventory_heal(player, item):
+    heal = CRYSTAL_AMOUNTS[HEALING](player)
+    player.health = min(player.max_health, player.health + heal)
+    if _journal is not None:
+        _journal.changed(player, "health")
+    say(f"You heal {heal} HP.")
+
+FIGHT_EFFECTS = {
+    TELEKINESIS: _fight_telekinesis,
+    HEALING: _fight_heal,
+    SHIELD: _fight_shield,
+    FIRE: _fight_fire,
+    PROJECTILE: _fight_projectile,
+    CHARISMA: _fight_charm,
+}
+
+CRYSTAL_EFFECTS = {
+    "fight": FIGHT_EFFECTS,
+    "forest": {CHARISMA: _forest_charm},
+    "gates": {CHARISMA: _gates_charm},
+    "princess": {SHIELD: _princess_shield, CHARISMA: _princess_charm},
+    "inventory": {HEALING: _inventory_heal},
+}
+
+# ---------------------------
+# Story content
+# ---------------------------
+# The adventure itself (scenes, prompts, checks, enemies, loot and endings)
+# lives in story.json. compile_story() turns it, once at import, into a
+# Story: nodes with integer IDs whose steps are small tuples (opcode,
+# args...), menus compiled to answer -> steps tables, narrative pre-wrapped
+# and check formulas compiled to code objects. play_node() interprets one
+# node, so between prompts a session is a node ID, a player and the
+# suspended interpreter.
+#
+# A step is a JSON object, or one of the bare strings "leave" (end the
+# enclosing menu or scene) and "show_inventory":
+#
+#   {"say": text}  {"wrap": text}  {"art": name}  {"pause": seconds}
+#   {"give": item}  {"set": {field: value}}
+#   {"if": expr, "then": [...], "else": [...]}
+#   {"roll": chance expr, "then": [...], "else": [...]}
+#   {"fight": enemy, "outcomes": {"dead": [...], ...}}
+#   {"menu": site, "choices": {"answer|alias": [...]}, "each": text,
+#    "unknown": text, "enemy": enemy}            asks until a choice leaves
+#   {"ask": site, "choices": {...}, "else": [...]}           asks once
+#   {"use_item": effect table, "site": site, "say": text, "miss": text,
+#    "spent": text, "leave": bool, "enemy": enemy}
+#   {"spend": power, "say": text, "spent": text, "then": [...]}
+#   {"scene": name, "do": [...]}                 timed by use_metrics()
+#   {"new_player": {...}}  {"end": ending}  {"goto": node}
+#
+# Expressions are Python expressions over the player's stats (magic,
+# agility, charisma_bonus, has_amulet, ...) and max/min. Text containing
+# {field} placeholders is formatted with the same stats; "spent" text with
+# the crystal's {name}. A node that finishes moves on to the next one.
+
+STORY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "story.json")
+
+ART = {
+    "unicorn": UNICORN_ART,
+    "earth_pony": EARTH_PONY_ART,
+    "unicorn_pony": UNICORN_PONY_ART,
+    "pegasus": PEGASUS_ART,
+}
+
+(_SAY, _SAY_FORMAT, _PAUSE, _GIVE, _SET, _SHOW_INVENTORY, _IF, _ROLL, _FIGHT, _MENU,
+ _ASK, _USE_ITEM, _SPEND, _SCENE, _NEW_PLAYER, _END, _GOTO, _LEAVE) = range(18)
+
+# which key names a step; checked in this order since some steps also
+# carry a "say"
+_STEP_KEYS = ("menu", "ask", "use_item", "spend", "scene", "new_player", "fight",
+              "if", "roll", "end", "goto", "give", "set", "art", "pause", "wrap", "say")
+
+_PLAYER_FIELDS = frozenset(("name", "pony_type", "max_health", "health", "magic", "strength",
+                            "agility", "has_amulet", "charisma_bonus", "shielded"))
+_EXPR_GLOBALS = {"__builtins__": {}, "max": max, "min": min}
+
+_LEFT = object()  # flow value of "leave"
+
+def step_branches(step):
+    """The blocks nested in a compiled step, in story order."""
+    op = step[0]
+    if op == _IF or op == _ROLL:
+        return step[2], step[3]
+    if op == _FIGHT:
+        return tuple(step[2].values())
+    if op == _MENU:
+        return tuple(step[5].values())
+    if op == _ASK:
+        return tuple(step[3].values()) + (step[4],)
+    if op == _SPEND:
+        return (step[4],)
+    if op == _SCENE:
+        return (step[2],)
+    return ()
+
+def walk_steps(steps):
+    """Every compiled step under `steps`, branches included, in story order."""
+    for step in steps:
+        yield step
+        for branch in step_branches(step):
+            yield from walk_steps(branch)
+
+class StoryError(ValueError):
+    pass
+
+class _Fields:
+    """A player's stats as a mapping, for expressions and text formatting."""
+    __slots__ = ("player",)
+
+    def __init__(self, player):
+        self.player = player
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self.player, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+class Node:
+    __slots__ = ("id", "name", "steps", "next")
+
+    def __init__(self, id_, name, steps, next_):
+        self.id = id_
+        self.name = name
+        self.steps = steps
+        self.next = next_
+
+class Story:
+    """A compiled story: its nodes by ID and the tables steps refer to."""
+    __slots__ = ("version", "digest", "nodes", "ids", "enemies", "endings", "game_over")
+
+    def __init__(self, version, digest, nodes, ids, enemies, endings, game_over):
+        self.version = version
+        self.digest = digest
+        self.nodes = nodes
+        self.ids = ids
+        self.enemies = enemies
+        self.endings = endings
+        self.game_over = game_over
+
+    def enemy(self, key):
+        """A fresh Enemy built from the story's enemy table."""
+        return Enemy(**self.enemies[key])
+
+def _compile_expr(source, where):
+    try:
+        code = compile(str(source), f"<{where}>", "eval")
+    except SyntaxError as exc:
+        raise StoryError(f"{where}: {exc.msg} in {source!r}") from None
+    unknown = set(code.co_names) - _PLAYER_FIELDS - set(_EXPR_GLOBALS)
+    if unknown:
+        raise StoryError(f"{where}: unknown name(s) {', '.join(sorted(unknown))} in {source!r}")
+    return code
+
+def compile_story(data, digest=0):
+    """Compile parsed story.json content into a Story (StoryError if invalid)."""
+    names = [node["name"] for node in data["nodes"]]
+    ids = {name: i for i, name in enumerate(names)}
+    if len(ids) != len(names):
+        raise StoryError("node names must be unique")
+    if len(names) > 255:
+        raise StoryError("a story has at most 255 nodes")
+    enemies = data.get("enemies", {})
+    ponies = {key: (p["name"], p["magic"], p["strength"], p["agility"], ART[p["art"]])
+              for key, p in data.get("ponies", {}).items()}
+
+    def text(value, where, wrap=False):
+        if "{" in value:
+            return (_SAY_FORMAT, value, wrap)
+        return (_SAY, wrapped(value) if wrap else value)
+
+    def block(items, where):
+        return tuple(step(item, f"{where}[{i}]") for i, item in enumerate(items or ()))
+
+    def table(choices, where):
+        out = {}
+        for answers, items in choices.items():
+            steps = block(items, f"{where}.{answers}")
+            for answer in answers.split("|"):
+                out[answer.strip().lower()] = steps
+        return out
+
+    def enemy(key, where):
+        if key is not None and key not in enemies:
+            raise StoryError(f"{where}: unknown enemy {key!r}")
+        return key
+
+    def step(item, where):
+        if item == "leave":
+            return (_LEAVE,)
+        if item == "show_inventory":
+            return (_SHOW_INVENTORY,)
+        kind = next((k for k in _STEP_KEYS if isinstance(item, dict) and k in item), None)
+        if kind is None:
+            raise StoryError(f"{where}: unknown step {item!r}")
+        arg = item[kind]
+        if kind == "say":
+            return text(arg, where)
+        if kind == "wrap":
+            return text(arg, where, wrap=True)
+        if kind == "art":
+            return (_SAY, ART[arg])
+        if kind == "pause":
+            return (_PAUSE, float(arg))
+        if kind == "give":
+            if arg not in ITEMS:
+                raise StoryError(f"{where}: unknown item {arg!r}")
+            return (_GIVE, ITEMS[arg])
+        if kind == "set":
+            bad = set(arg) - _PLAYER_FIELDS
+            if bad:
+                raise StoryError(f"{where}: cannot set {', '.join(sorted(bad))}")
+            return (_SET, tuple(arg.items()))
+        if kind in ("if", "roll"):
+            return (_IF if kind == "if" else _ROLL, _compile_expr(arg, where),
+                    block(item.get("then"), f"{where}.then"), block(item.get("else"), f"{where}.else"))
+        if kind == "fight":
+            return (_FIGHT, enemy(arg, where),
+                    {outcome: block(steps, f"{where}.{outcome}")
+                     for outcome, steps in item.get("outcomes", {}).items()})
+        if kind == "menu":
+            return (_MENU, arg, item.get("each"), item.get("unknown"),
+                    enemy(item.get("enemy"), where), table(item["choices"], where))
+        if kind == "ask":
+            return (_ASK, arg, enemy(item.get("enemy"), where), table(item["choices"], where),
+                    block(item.get("else"), f"{where}.else"))
+        if kind == "use_item":
+            if arg not in CRYSTAL_EFFECTS:
+                raise StoryError(f"{where}: no crystal effect table {arg!r}")
+            return (_USE_ITEM, arg, item["site"], enemy(item.get("enemy"), where),
+                    item["say"], item["miss"], item.get("spent"), bool(item.get("leave")))
+        if kind == "spend":
+            return (_SPEND, crystal_effect(arg), item["say"], item["spent"],
+                    block(item.get("then"), f"{where}.then"))
+        if kind == "scene":
+            return (_SCENE, arg, block(item["do"], f"{where}.{arg}"))
+        if kind == "new_player":
+            return (_NEW_PLAYER, arg["site"], arg["text"], arg["default"], arg["pony_site"],
+                    tuple(arg["menu"]), arg["invalid"], ponies)
+        if kind == "end":
+            return (_END, str(arg))
+        if arg not in ids:
+            raise StoryError(f"{where}: unknown node {arg!r}")
+        return (_GOTO, ids[arg])
+
+    nodes = tuple(
+        Node(i, node["name"], block(node["do"], node["name"]),
+             ids[node["next"]] if "next" in node else i + 1)
+        for i, node in enumerate(data["nodes"]))
+    over = data["game_over"]
+    endings = {name: wrapped(text) for name, text in over["endings"].items()}
+    return Story(data.get("version", 0), digest, nodes, ids, enemies, endings,
+                 (over["header"], over["unknown"], over["footer"]))
+
+def load_story(path=STORY_FILE):
+    """Read and compile a story file."""
+    with open(path, "rb") as f:
+        raw = f.read()
+    return compile_story(json.loads(raw), zlib.crc32(raw))
+
+# ---------------------------
+# Story engine
+# ---------------------------
+
+class _Run:
+    """One pass through a node: its session and the enemy it last met.
+
+    Steps naming the same enemy in a row (a menu and the fight it leads
+    to) share one Enemy, so its wounds carry over. `at` is the step whose
+    prompt is being asked, so hint providers know where the player stands.
+    """
+    __slots__ = ("session", "story", "foe_key", "foe", "at")
+
+    def __init__(self, session, story):
+        self.session = session
+        self.story = story
+        self.foe_key = self.foe = self.at = None
+
+    def enemy(self, key):
+        if key is None:
+            return None
+        if key != self.foe_key:
+            self.foe_key, self.foe = key, self.story.enemy(key)
+        return self.foe
+
+def play_node(session, node, story=None):
+    """Run one node for a session, yielding an Ask at every prompt.
+
+    Returns None to go on to node.next, an ending name, or a node ID.
+    """
+    flow = yield from _run(node.steps, _Run(session, story or STORY))
+    return None if flow is _LEFT else flow
+
+def _run(steps, run):
+    for step in steps:
+        op = step[0]
+        if op == _SAY:
+            say(step[1])
+        elif op == _SAY_FORMAT:
+            text = step[1].format_map(_Fields(run.session.player))
+            say(wrapped(text) if step[2] else text)
+        elif op == _PAUSE:
+            pause(step[1])
+        elif op == _GIVE:
+            run.session.player.add_item(step[1].make())
+        elif op == _SET:
+            for field, value in step[1]:
+                setattr(run.session.player, field, value)
+                if _journal is not None:
+                    _journal.changed(run.session.player, field)
+        elif op == _SHOW_INVENTORY:
+            run.session.player.show_inventory()
+        elif op == _IF or op == _ROLL:
+            value = eval(step[1], _EXPR_GLOBALS, _Fields(run.session.player))
+            branch = step[2] if (roll(value) if op == _ROLL else value) else step[3]
+            if branch:
+                flow = yield from _run(branch, run)
+                if flow is not None:
+                    return flow
+        elif op == _FIGHT:
+            run.at = step
+            outcome = yield from fight(run.session.player, run.enemy(step[1]))
+            branch = step[2].get(outcome)
+            if branch:
+                flow = yield from _run(branch, run)
+                if flow is not None:
+                    return flow
+        elif op == _MENU:
+            flow = yield from _menu(step, run)
+            if flow is not None:
+                return flow
+        elif op == _ASK:
+            run.at = step
+            player = run.session.player
+            choice = (yield ask(step[1], player, run.enemy(step[2]))).strip().lower()
+            flow = yield from _run(step[3].get(choice, step[4]), run)
+            if flow is not None:
+                return flow
+        elif op == _USE_ITEM:
+            flow = yield from _use_item(step, run)
+            if flow is not None:
+                return flow
+        elif op == _SPEND:
+            flow = yield from _spend(step, run)
+            if flow is not None:
+                return flow
+        elif op == _SCENE:
+            if _metrics is None:
+                flow = yield from _run(step[2], run)
             else:
-                print("You are caught and the port guards make you pay a fine you don't have. The merchant refuses service.")
-                continue
-        print("Choose pay / persuade / sneak / look inv")
-
-def crystal_empire_guards(player):
-    print("\n--- Gates of the Crystal Empire ---")
-    print(wrapped("Massive faceted gates stand watch. The royal guards glance at you as you approach with an amulet in hand."))
-    # guards check: if player has amulet, they may suspect you
-    if not player.has_amulet:
-        print("You approach without the amulet. The guards let you through after a brief inspection.")
-        return "ok"
-    # if has amulet:
-    print("A stern guard asks: 'Where did you get that amulet?'")
-    # options: tell truth, lie, hand over
+                flow = yield from _timed_scene(_metrics, step[1], _run(step[2], run))
+            if flow is not None and flow is not _LEFT:
+                return flow
+        elif op == _NEW_PLAYER:
+            yield from _new_player(step, run)
+        elif op == _LEAVE:
+            return _LEFT
+        else:  # _END, _GOTO
+            return step[1]
+    return None
+
+def _menu(step, run):
+    _, site, each, unknown, enemy, choices = step
+    player = run.session.player
+    foe = run.enemy(enemy)
     while True:
-        print("Options: [explain] [lie] [hand over] [use item] [inv]")
-        choice = input("> ").strip().lower()
-        if choice in ("inv", "inventory"):
-            player.show_inventory()
-            continue
-        if choice == "use item":
-            print("Try using a crystal to charm or persuade:")
-            player.show_inventory()
-            idx = input("> ").strip()
-            if not idx.isdigit():
-                print("Back.")
-                continue
-            idx = int(idx)-1
-            if idx<0 or idx>=len(player.inventory):
-                print("Invalid.")
-                continue
-            item = player.inventory[idx]
-            if isinstance(item, Crystal) and item.power.lower() in ("charisma","rose quartz"):
-                if item.use():
-                    print("Your Rose Quartz glows. The guard relaxes and decides not to arrest you.")
-                    if item.charges<=0:
-                        player.inventory.pop(idx)
-                    return "ok"
+        if each:
+            say(each)
+        run.at = step
+        choice = (yield ask(site, player, foe)).strip().lower()
+        branch = choices.get(choice)
+        if branch is None:
+            if unknown:
+                reject(unknown)
             else:
-                print("That doesn't sway the guard.")
+                reject()
             continue
-        if choice == "explain":
-            # charisma / magic checks
-            base = 0.2 + (player.charisma_bonus * 0.1) + (player.magic * 0.03)
-            if roll(base + 0.2):
-                print("Your explanation sounds honest—guards decide not to arrest you.")
-                return "ok"
-            else:
-                print("They are suspicious and call for arrest.")
-                return "jail"
-        if choice == "lie":
-            chance = 0.15 + player.charisma_bonus*0.08 + (player.agility*0.02)
-            if roll(chance):
-                print("Your lie is convincing; they wave you through.")
-                return "ok"
-            else:
-                print("They see through your lie and move to detain you.")
-                return "jail"
-        if choice == "hand over":
-            # handing to guard — slight chance to go bad => explosion ending
-            print("You step forward to hand the amulet to the guard...")
-            # risk depends on agility — lower agility increases chance to fumble
-            fumble_chance = 0.1 + max(0, 5 - player.agility)*0.05
-            if roll(fumble_chance):
-                print("You fumble the amulet! It slips from your hooves...")
-                print("The amulet detonates in terrible crystal energy.")
-                return "explosion"
-            else:
-                print("You hand the amulet over carefully; the guard inspects it and nods.")
-                return "ok"
-        print("Choose a valid option.")
-
-def final_princess_scene(player):
-    print("\n--- Throne Room, Crystal Palace ---")
-    print(wrapped("You approach the princess of the Crystal Kingdom, amulet in hand. Will you return it?"))
-    print("Options: [give] [explain] [use item] [inv]")
+        flow = yield from _run(branch, run)
+        if flow is _LEFT:
+            return None
+        if flow is not None:
+            return flow
+
+def _use_item(step, run):
+    _, effects, site, enemy, intro, miss, spent, leave = step
+    player = run.session.player
+    say(intro)
+    player.show_inventory()
+    run.at = step
+    idx = (yield ask(site, player, run.enemy(enemy))).strip()
+    if not idx.isdigit():
+        if idx.lower() == "back":
+            say("Back.")
+        else:
+            reject("Back.")
+        return None
+    idx = int(idx)
+    item = player.inventory.get(idx)
+    if item is None:
+        reject("Invalid.")
+        return None
+    effect = CRYSTAL_EFFECTS[effects].get(item.effect) if isinstance(item, Crystal) else None
+    if effect is None:
+        say(miss)
+        return None
+    if item.use():
+        effect(player, item)
+        if item.charges <= 0:
+            if spent:
+                say(spent.format(name=item.name))
+            player.inventory.pop(idx)
+        if leave:
+            return _LEFT
+    return None
+
+def _spend(step, run):
+    _, effect, text, spent, then = step
+    inventory = run.session.player.inventory
+    number = inventory.charged(effect)
+    if number is None:
+        return None
+    item = inventory.get(number)
+    inventory.use_charge(number)
+    say(text)
+    if item.charges <= 0:
+        say(spent.format(name=item.name))
+        inventory.pop(number)
+    return (yield from _run(then, run))
+
+def _new_player(step, run):
+    _, site, text, default, pony_site, menu, invalid, ponies = step
+    run.at = step
+    name = (yield ask(site, text=text)).strip() or default
+    for line in menu:
+        say(line)
     while True:
-        choice = input("> ").strip().lower()
-        if choice in ("inv", "inventory"):
-            player.show_inventory()
-            continue
-        if choice == "use item":
-            print("You can use items before giving the amulet (for safety or persuasion).")
-            player.show_inventory()
-            idx = input("> ").strip()
-            if not idx.isdigit():
-                print("Back.")
-                continue
-            idx = int(idx)-1
-            if idx<0 or idx>=len(player.inventory):
-                print("Invalid.")
-                continue
-            item = player.inventory[idx]
-            if isinstance(item, Crystal) and item.power.lower() in ("protection shield","obsidian"):
-                if item.use():
-                    player.shielded = True
-                    print("Obsidian forms a protective shell around the amulet, dampening its volatile power.")
-                    if item.charges<=0:
-                        player.inventory.pop(idx)
-            elif isinstance(item, Crystal) and item.power.lower() in ("charisma","rose quartz"):
-                if item.use():
-                    player.charisma_bonus += 1
-                    print("Rose quartz increases your persuasive aura.")
-                    if item.charges<=0:
-                        player.inventory.pop(idx)
-            else:
-                print("That won't help here.")
-            continue
-        if choice == "explain":
-            # persuasion to hand over to princess gracefully
-            chance = 0.3 + player.charisma_bonus*0.1 + player.magic*0.03
-            if roll(chance):
-                print("You explain the amulet's history and the princess gratefully accepts it.")
-                return "good"
-            else:
-                print("The princess is suspicious; she orders guards to take you.")
-                return "jail"
-        if choice == "give":
-            print("You step forward and place the amulet in the princess's hands...")
-            # if shielded, safe
-            if getattr(player, "shielded", False):
-                print("Thanks to the Obsidian protection, nothing explodes.")
-                return "good"
-            # otherwise chance of explosion depending on agility/handling
-            fumble_chance = 0.05 + max(0, 5 - player.agility) * 0.06
-            if roll(fumble_chance):
-                print("A tragic slip! The amulet sparks and releases raw crystal energy...")
-                return "explosion"
-            # otherwise maybe princess accepts but guards still suspicious
-            # final persuasion by charisma
-            if roll(0.7 + player.charisma_bonus*0.05):
-                print("The princess accepts the amulet and recognizes your bravery.")
-                return "good"
-            else:
-                print("Even as you hand it over, someone cries theft and the guards step forward.")
-                return "jail"
-        print("Choose give / explain / use item / inv")
+        pony = ponies.get((yield ask(pony_site)).strip())
+        if pony is not None:
+            break
+        reject(invalid)
+    pony_type, magic, strength, agility, art = pony
+    say(art)
+    run.session.player = Player(name, pony_type, magic=magic, strength=strength, agility=agility)
+
+STORY = load_story()
+
+def use_story(story):
+    """Play a different compiled Story from now on; returns the previous one."""
+    global STORY
+    previous, STORY = STORY, story
+    return previous
 
 # ---------------------------
 # Game Flow
 # ---------------------------
 
-def choose_pony():
-    print("Choose your pony:")
-    print("1) Earth pony: Magic 2, Strength 9, Agility 5")
-    print("2) Unicorn: Magic 8, Strength 3, Agility 6")
-    print("3) Pegasus: Magic 6, Strength 4, Agility 4")
-    while True:
-        c = input("> ").strip()
-        if c in ("1","2","3"):
-            if c=="1":
-                print(EARTH_PONY_ART)
-                return ("Earth Pony", 2, 9, 5)
-            elif c=="2":
-                print(UNICORN_PONY_ART)
-                return ("Unicorn", 8, 3, 6)
-            else:
-                print(PEGASUS_ART)
-                return ("Pegasus", 6, 4, 4)
-        else:
-            print("Enter 1, 2, or 3.")
-
 def manage_inventory(player):
     while True:
-        print("\nInventory Menu: [view] [use] [discard] [equip] [back]")
-        choice = input("> ").strip().lower()
+        say("\nInventory Menu: [view] [use] [discard] [equip] [back]")
+        choice = (yield ask("inventory", player)).strip().lower()
         if choice == "view":
             player.show_inventory()
         elif choice == "use":
             player.show_inventory()
-            print("Enter number to use or 'back'")
-            idx = input("> ").strip()
+            say("Enter number to use or 'back'")
+            idx = (yield ask("inventory.use", player)).strip()
             if idx=="back":
                 continue
             if not idx.isdigit():
-                print("Invalid.")
+                reject("Invalid.")
                 continue
-            idx=int(idx)-1
-            if idx<0 or idx>=len(player.inventory):
-                print("Invalid.")
+            idx=int(idx)
+            item = player.inventory.get(idx)
+            if item is None:
+                reject("Invalid.")
                 continue
-            item = player.inventory[idx]
             if isinstance(item, Crystal):
                 if item.use():
-                    print(f"You use {item.name} ({item.power}). Charges left: {item.charges}")
+                    say(f"You use {item.name} ({item.power}). Charges left: {item.charges}")
                     # immediate effects (healing only)
-                    if item.power.lower() in ("healing","jade"):
-                        heal = 8 + player.magic
-                        player.health = min(player.max_health, player.health + heal)
-                        print(f"You heal {heal} HP.")
+                    effect = CRYSTAL_EFFECTS["inventory"].get(item.effect)
+                    if effect:
+                        effect(player, item)
                     if item.charges<=0:
-                        print(f"{item.name} shatters.")
+                        say(f"{item.name} shatters.")
                         player.inventory.pop(idx)
                 else:
-                    print("No charges left.")
+                    reject("No charges left.")
             elif isinstance(item, Weapon):
                 player.weapon = item
-                print(f"You equip {item.name}.")
+                say(f"You equip {item.name}.")
             else:
-                print(f"You use {item.name}. Nothing dramatic happened.")
+                say(f"You use {item.name}. Nothing dramatic happened.")
         elif choice == "discard":
             player.show_inventory()
-            print("Enter number to discard or 'back'")
-            idx = input("> ").strip()
+            say("Enter number to discard or 'back'")
+            idx = (yield ask("inventory.discard", player)).strip()
             if idx=="back":
                 continue
             if not idx.isdigit():
-                print("Invalid.")
-                continue
-            idx=int(idx)-1
-            if idx<0 or idx>=len(player.inventory):
-                print("Invalid.")
+                reject("Invalid.")
                 continue
+            idx=int(idx)
             item = player.inventory.pop(idx)
-            print(f"You discard {item.name}.")
+            if item is None:
+                reject("Invalid.")
+                continue
+            say(f"You discard {item.name}.")
         elif choice=="equip":
             player.show_inventory()
-            print("Enter weapon number to equip:")
-            idx = input("> ").strip()
+            say("Enter weapon number to equip:")
+            idx = (yield ask("inventory.equip", player)).strip()
             if not idx.isdigit():
-                print("Invalid.")
+                reject("Invalid.")
                 continue
-            idx=int(idx)-1
-            if idx<0 or idx>=len(player.inventory):
-                print("Invalid.")
+            idx=int(idx)
+            item = player.inventory.get(idx)
+            if item is None:
+                reject("Invalid.")
                 continue
-            item = player.inventory[idx]
             if isinstance(item, Weapon):
                 player.weapon = item
-                print(f"You equip {item.name}.")
+                say(f"You equip {item.name}.")
             else:
-                print("Not a weapon.")
+                reject("Not a weapon.")
         elif choice == "back":
             return
         else:
-            print("Unknown choice.")
+            reject("Unknown choice.")
 
 def game_over(ending):
-    print("\n--- GAME OVER ---")
-    if ending == "good":
-        print(wrapped("Good Ending: You return the amulet and the princess rewards you with your own place in the empire."))
-    elif ending == "jail":
-        print(wrapped("Jail Ending: Guards arrest you for possessing the amulet. You are held in a crystal cell."))
-    elif ending == "explosion":
-        print(wrapped("Explosion Ending: The amulet's energy explodes. A tragic end."))
-    elif ending == "dead":
-        print(wrapped("You died in battle. Your story ends here."))
-    else:
-        print("Unknown ending.")
-    print("Thank you for playing Magic Pony Sparkle Land.")
-    sys.exit(0)
+    if _metrics is not None:
+        _metrics.ending(ending)
+    header, unknown, footer = STORY.game_over
+    say(header)
+    say(STORY.endings.get(ending, unknown))
+    say(footer)
+    raise GameOver(ending)
+
+# ---------------------------
+# Sessions
+# ---------------------------
+
+class Session:
+    """Everything one game needs between prompts.
+
+    A session is advanced with start() and step(); while it is being
+    stepped it also serves as the console, collecting output in `output`
+    and rolling dice from its own `rng` stream. Between prompts it holds
+    only the player, `stage` (the ID of the story node it is in), the
+    stream position and the suspended interpreter of that node (`visit`
+    is that interpreter's pass through the node).
+    """
+    __slots__ = ("player", "stage", "rng", "ending", "waiting", "output", "checkpoint",
+                 "visit", "rejected", "_game")
+
+    def __init__(self, player=None, stage=0, rng=None):
+        self.player = player
+        self.stage = stage
+        self.rng = rng if rng is not None else Stream()
+        self.ending = None
+        self.waiting = None
+        self.output = []
+        self.checkpoint = None
+        self.visit = None
+        self.rejected = False
+        self._game = None
+
+    def write(self, text):
+        self.output.append(text)
+
+    def pause(self, seconds):
+        pass
+
+    def read(self, site, text="> ", player=None, enemy=None):
+        raise RuntimeError("sessions are answered through step()")
+
+    def drain(self):
+        """Return and clear the text written since the last drain."""
+        text = "\n".join(self.output)
+        self.output.clear()
+        return text
+
+    @property
+    def finished(self):
+        return self.ending is not None
+
+def story(session=None):
+    """The whole adventure as a generator: yields an Ask at every prompt
+    and expects the player's answer to be sent back in. Resumes from
+    session.stage (a node ID) when handed an existing session."""
+    session = session if session is not None else Session()
+    nodes = STORY.nodes
+    while session.stage < len(nodes):
+        session.checkpoint = _pack_session(session)
+        if _journal is not None:
+            _journal.node(session)
+        node = nodes[session.stage]
+        # the node runs inline rather than through play_node(), one
+        # generator frame less for every parked session
+        session.visit = _Run(session, STORY)
+        flow = yield from _run(node.steps, session.visit)
+        if flow.__class__ is str:
+            game_over(flow)
+        session.stage = flow if flow.__class__ is int else node.next
+
+def start(session):
+    """Run a fresh (or restored) session up to its first prompt."""
+    session._game = story(session)
+    return _advance(session, None)
+
+def replay(commands, seed, stream=0):
+    """Rebuild a game from its seed and command log.
+
+    Returns the Session after answering each prompt in turn; the same seed,
+    stream and commands always reach the same state and output.
+    """
+    session = Session(rng=Stream(seed, stream))
+    start(session)
+    for command in commands:
+        if step(session, command) is None:
+            break
+    return session
+
+def step(session, command):
+    """Answer the prompt a session is waiting on and run to the next one.
+
+    Returns the Ask the session now waits on, or None once it has ended
+    (session.ending then names the ending). Output goes to session.output.
+    With a hint provider installed, "hint" writes a hint instead and the
+    session keeps waiting on the same prompt. session.rejected tells
+    whether the game did not understand the command.
+    """
+    if session.finished:
+        return None
+    if session._game is None:
+        start(session)
+    session.rejected = False
+    if _hints is not None and command.strip().lower() == HINT_COMMAND:
+        session.write(_hints.hint(session, session.waiting))
+        return session.waiting
+    return _advance(session, command)
+
+COMMAND_SEPARATOR = ";"
+
+def split_commands(line):
+    """The commands in one pipelined line: "use item;2;fight" -> three."""
+    commands = line.split(COMMAND_SEPARATOR)
+    if len(commands) > 1 and not commands[-1].strip():
+        commands.pop()  # "fight;" is one command
+    return commands
+
+def pipeline(session, line, step_one=None):
+    """Answer successive prompts with the commands of a pipelined line.
+
+    The commands are queued and each is consumed by the next prompt, with
+    no round trip to the player in between. When the game rejects one
+    (an unknown choice, a bad item number) or ends, the rest are dropped
+    and a note says so. `step_one(command)` answers one prompt (default:
+    step() on `session`). Returns the Ask the session now waits on, or
+    None once it has ended.
+    """
+    if step_one is None:
+        step_one = functools.partial(step, session)
+    queue = split_commands(line)
+    request = session.waiting
+    for n, command in enumerate(queue, 1):
+        request = step_one(command)
+        left = len(queue) - n
+        if left and (request is None or session.rejected):
+            session.write(_dropped(left))
+            break
+    return request
+
+def _dropped(count):
+    return f"({count} queued command{'s' if count != 1 else ''} dropped)"
+
+def _advance(session, command):
+    metrics = _metrics
+    if metrics is not None:
+        site = session.waiting.site if session.waiting is not None else "start"
+        began = time.perf_counter()
+    previous = use_console(session)
+    try:
+        session.waiting = session._game.send(command)
+    except GameOver as over:
+        session.ending = over.ending
+        session.waiting = session._game = None
+    except StopIteration:
+        session.ending = "unknown"
+        session.waiting = session._game = None
+    finally:
+        use_console(previous)
+        if metrics is not None:
+            metrics.command(site, command, time.perf_counter() - began)
+    return session.waiting
+
+# ---------------------------
+# Save games
+# ---------------------------
+# A save is the session as it entered its current story node (its stage),
+# packed into a few dozen bytes; loading it resumes at the start of that
+# node, with the dice stream rewound to where it was then.
+#
+#   header   version u8, stage u8, flags u8 (player, amulet, shielded, numbered)
+#   rng      seed u64, stream u64, counter u32           (version 2 and up)
+#   player   pony u8, magic i8, strength i8, agility i8, max_health i16,
+#            health i16, charisma_bonus i8, weapon item id u8,
+#            name (u8 length + utf-8), [pony type string if pony is 255]
+#   items    count u8, then catalog id u8 (+ charges u8 for crystals)
+#   numbers  only when flagged (something was removed): the number the
+#            next item gets u8, then each item's inventory number u8
+
+SAVE_VERSION = 2
+
+_SAVE_PONIES = ("Earth Pony", "Unicorn", "Pegasus")
+_NO_ITEM = 0xFF
+
+_HEADER = struct.Struct("<BBB")
+_RNG = struct.Struct("<QQI")
+_STATS = struct.Struct("<BbbbhhbB")
+
+_FLAG_PLAYER, _FLAG_AMULET, _FLAG_SHIELDED, _FLAG_NUMBERED = 1, 2, 4, 8
+
+class SaveError(ValueError):
+    pass
+
+def _item_id(item):
+    if item.kind.id is None:
+        raise SaveError(f"{item.name!r} is not a catalog item")
+    return item.kind.id
+
+def clip_utf8(text, limit):
+    """`text` as UTF-8, cut to at most `limit` bytes without splitting a
+    character, so the bytes always decode again."""
+    data = text.encode("utf-8")
+    if len(data) <= limit:
+        return data
+    return data[:limit].decode("utf-8", "ignore").encode("utf-8")
+
+def _pack_text(text):
+    data = clip_utf8(text, 255)
+    return bytes((len(data),)) + data
+
+def _pack_session(session):
+    player = session.player
+    rng = session.rng
+    rng_state = _RNG.pack(rng.seed, rng.stream, rng.counter)
+    if player is None:
+        return _HEADER.pack(SAVE_VERSION, session.stage, 0) + rng_state
+    flags = _FLAG_PLAYER
+    if player.has_amulet:
+        flags |= _FLAG_AMULET
+    if player.shielded:
+        flags |= _FLAG_SHIELDED
+    # items keep their numbers when others are removed; a save only spells
+    # them out when they are no longer simply 1..n
+    inventory = player.inventory
+    numbers = tuple(number for number, _ in inventory.numbered())
+    if inventory._next != len(numbers) + 1 or numbers != tuple(range(1, len(numbers) + 1)):
+        if inventory._next > 0xFF:
+            raise SaveError("too many items for a save")
+        flags |= _FLAG_NUMBERED
+    pony = _SAVE_PONIES.index(player.pony_type) if player.pony_type in _SAVE_PONIES else 255
+    weapon = _item_id(player.weapon) if player.weapon else _NO_ITEM
+    parts = [
+        _HEADER.pack(SAVE_VERSION, session.stage, flags),
+        rng_state,
+        _STATS.pack(pony, player.magic, player.strength, player.agility,
+                    player.max_health, player.health, player.charisma_bonus, weapon),
+        _pack_text(player.name),
+    ]
+    if pony == 255:
+        parts.append(_pack_text(player.pony_type))
+    if len(inventory) > 0xFF:
+        raise SaveError("too many items for a save")
+    items = bytearray((len(inventory),))
+    for item in player.inventory:
+        items.append(_item_id(item))
+        if isinstance(item, Crystal):
+            items.append(item.charges)
+    if flags & _FLAG_NUMBERED:
+        items.append(inventory._next)
+        items.extend(numbers)
+    parts.append(bytes(items))
+    return b"".join(parts)
+
+def save(session):
+    """Snapshot a session as bytes (its state on entering the current stage)."""
+    if session.checkpoint is None:
+        session.checkpoint = _pack_session(session)
+    return session.checkpoint
+
+def load(data, cls=Session):
+    """Rebuild a Session (or a `cls` subclass of it) from save() bytes;
+    start() or step() resumes it."""
+    try:
+        version, stage, flags = _HEADER.unpack_from(data, 0)
+        pos = _HEADER.size
+        if version == 1:
+            rng = None  # saved before sessions had their own streams
+        elif version == SAVE_VERSION:
+            rng = Stream(*_RNG.unpack_from(data, pos))
+            pos += _RNG.size
+        else:
+            raise SaveError(f"unsupported save version {version}")
+        session = cls(stage=stage, rng=rng)
+        if not flags & _FLAG_PLAYER:
+            return session
+        pony, magic, strength, agility, max_health, health, charisma, weapon = \
+            _STATS.unpack_from(data, pos)
+        pos += _STATS.size
+        name = data[pos + 1:pos + 1 + data[pos]].decode("utf-8")
+        pos += 1 + data[pos]
+        if pony == 255:
+            pony_type = data[pos + 1:pos + 1 + data[pos]].decode("utf-8")
+            pos += 1 + data[pos]
+        else:
+            pony_type = _SAVE_PONIES[pony]
+        player = Player(name, pony_type, magic=magic, strength=strength, agility=agility)
+        player.max_health = max_health
+        player.health = health
+        player.charisma_bonus = charisma
+        player.has_amulet = bool(flags & _FLAG_AMULET)
+        if flags & _FLAG_SHIELDED:
+            player.shielded = True
+        count = data[pos]
+        pos += 1
+        items = []
+        for _ in range(count):
+            item = CATALOG[data[pos]].make()
+            pos += 1
+            if isinstance(item, Crystal):
+                item.charges = data[pos]
+                pos += 1
+            items.append(item)
+        if flags & _FLAG_NUMBERED:
+            next_ = data[pos]
+            numbers = data[pos + 1:pos + 1 + count]
+            if len(numbers) != count:
+                raise IndexError("item numbers cut short")
+            for number, item in zip(numbers, items):
+                player.inventory.add(item, number)
+            player.inventory._next = next_
+        else:
+            for item in items:
+                player.inventory.add(item)
+        if weapon != _NO_ITEM:
+            player.weapon = next((it for it in player.inventory if it.kind.id == weapon),
+                                 None) or CATALOG[weapon].make()
+    except (struct.error, IndexError, UnicodeDecodeError) as exc:
+        raise SaveError(f"corrupt save: {exc}") from None
+    session.player = player
+    session.checkpoint = bytes(data) if version == SAVE_VERSION else None
+    return session
 
 def main():
-    print(UNICORN_ART)
-    print("#" * 60)
-    print("WELCOME TO MAGIC PONY SPARKLE LAND")
-    print("#" * 60)
-    name = input("Your name, brave pony: ").strip() or "Player"
-    pony, mag, strg, agi = choose_pony()
-    player = Player(name, pony, magic=mag, strength=strg, agility=agi)
-    print(f"Welcome, {player.name} the {player.pony_type}!")
-    print("\n(Commands during exploration: inventory, manage inv, status, help)\n")
-    dungeon_intro(player)
-
-    # Simple linear progression with choices and small branching
-    find_in_corridor(player)
-
-    # First fight: miniboss - guard dog
-    bulldog = Enemy("Bulldog Cerberus", health=22, strength=6, agility=3, magic=2,
-                    description="The dreadful captor who stole your amulet roams the cavern.")
-    print("\nAs you proceed, you confront a snarling guard — perhaps involved in your kidnapping.")
-    res = fight(player, bulldog)
-    if res == "dead":
-        game_over("dead")
-    # chance to find an amulet? Not yet — captor may have hidden it.
-    # give a healing crystal
-    jade = Crystal("Jade", power="Healing", charges=1, description="Green healing crystal.")
-    player.add_item(jade)
-
-    print("\nYou trek onward from the cavern, into the Dragon Mountains...")
-    res = dragon_mountains(player)
-    if res == "dead":
-        game_over("dead")
-
-    print("\nNext, you arrive at a haunted forest.")
-    res = haunted_forest(player)
-    if res == "dead":
-        game_over("dead")
-
-    print("\nAt the forest's edge, you find a clue: a glimmering shard — a Rose Quartz.")
-    rose = Crystal("Rose Quartz", power="Charisma", charges=1, description="Soft pink crystal that warms hearts.")
-    player.add_item(rose)
-
-    print("\nYou reach the Port and must get across the Coral Sea.")
-    res = port_and_coral_sea(player)
-    if res == "dead":
-        game_over("dead")
-
-    # After sea, chance to meet a trader who returns the amulet to you in exchange for a favor
-    print("\nOn the far shore, a cloaked figure beckons. He offers you a deal: help steal back a guard's keys and he will reveal the amulet's location.")
-    print("Do you accept? [yes/no]")
-    if input("> ").strip().lower() in ("yes","y"):
-        print("You retrieve a simple keychain and the cloaked figure keeps his promise.")
-        # Receive amulet
-        print("You recover an amethyst star-shaped amulet hidden inside a secret box!")
-        player.has_amulet = True
-        amulet = Item("Amethyst Amulet", "Star-shaped amulet — your family's heirloom.", type_="amulet")
-        player.add_item(amulet)
-    else:
-        print("You decline. You keep moving, but the amulet remains lost for now.")
-        # maybe find it later — for simplicity, we give it later via chance
-        if roll(0.4):
-            print("By chance you find the amulet in a cave. You pick it up.")
-            player.has_amulet = True
-            amulet = Item("Amethyst Amulet", "Star-shaped amulet — your family's heirloom.", type_="amulet")
-            player.add_item(amulet)
-
-    print("\nYou approach the glittering gates of the Crystal Empire.")
-    res = crystal_empire_guards(player)
-    if res == "dead":
-        game_over("dead")
-    if res == "jail":
-        game_over("jail")
-    if res == "explosion":
-        game_over("explosion")
-
-    # If allowed through, head to princess
-    print("\nYou are escorted into the palace and find the princess awaiting.")
-    ending = final_princess_scene(player)
-    if ending == "good":
-        game_over("good")
-    elif ending == "jail":
-        game_over("jail")
-    elif ending == "explosion":
-        game_over("explosion")
-    else:
-        game_over("dead")
+    session = Session()
+    run(story(session), session)
 
 if __name__ == "__main__":
+    if sys.argv[1:] == ["--hints"]:
+        # the solver imports this file as "unicorn", so the game is played there
+        import policysolver
+        sys.exit(policysolver.main(["--play"]))
     try:
         main()
+    except GameOver:
+        _console.flush()
+        sys.exit(0)
     except KeyboardInterrupt:
-        print("\nGame interrupted. Goodbye.")
+        say("\nGame interrupted. Goodbye.")
+        _console.flush()
         sys.exit(0)